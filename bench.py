@@ -0,0 +1,462 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the cachefs cache engine.  These drive CacheFile and
+FileDataCache directly, without FUSE, so they can run anywhere.
+
+    ./bench.py suite [--workloads seq,random,hot,tree,append] [--latency 0.005] [--bandwidth 20M] [--chunk-size 256K [--compress zlib] [--dedup]] [--ram-cache 64M] [--small-file 64K] [--idle-handles 256]
+    ./bench.py threads [--latency 0.02] [--threads 1,2,4,8,16]
+    ./bench.py misses [--count 5000] [--size 4096]
+    ./bench.py hits [--sizes 4K,64K,128K,1M] [--ops 5000]
+
+The target is slowed down by a SlowTarget to look like sshfs or s3fs.
+Each result is printed as one JSON object per line.
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from cachefs import make_file_class, create_db, open_db, parse_size, FileDataCache, BlockWriter, RamCache, Mappings, Stats
+
+
+class BenchFS(object):
+    """Stands in for CacheFS, wiring CacheFile to a target and cache dir"""
+    def __init__(self, base, chunk_size = 0, compress = '', dedup = False):
+        self.target = os.path.join(base, 'target')
+        self.cache = os.path.join(base, 'cache')
+        os.makedirs(self.target)
+        os.makedirs(self.cache)
+        db = create_db(self.cache)
+        with db:
+            db.execute("INSERT INTO settings VALUES ('chunk_size', ?)", (str(chunk_size),))
+            db.execute("INSERT INTO settings VALUES ('compression', ?)", (compress,))
+            db.execute("INSERT INTO settings VALUES ('dedup', ?)", (dedup and '1' or '0',))
+        db.close()
+        self.readahead = None
+        self.writeback = None
+        self.verify = 'stat'
+        self.stats = Stats()
+        self.monitor = None
+        self.access_log = None
+        self.prewarm = None
+        self.small_file = 0
+        self.file_class = make_file_class(self)
+
+    def _physical_path(self, path):
+        return os.path.join(self.target, path.lstrip('/'))
+
+    def start_writing(self, path):
+        pass
+
+    def stop_writing(self, path):
+        pass
+
+    def make_file(self, path, size):
+        with open(self._physical_path(path), 'wb') as f:
+            f.write(os.urandom(size))
+
+
+class SlowTarget(object):
+    """
+    Makes the target behave like a network file system: every operation
+    on it takes latency seconds more, and data crosses it at no more than
+    bandwidth bytes a second.  Counts what went across.
+    """
+    def __init__(self, latency = 0.0, bandwidth = None):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.lock = threading.Lock()
+        self.ops = 0
+        self.read_bytes = 0
+        self.written_bytes = 0
+
+    def op(self, read = 0, written = 0):
+        delay = self.latency
+        if self.bandwidth:
+            delay += float(read + written) / self.bandwidth
+        if delay:
+            time.sleep(delay)
+        with self.lock:
+            self.ops += 1
+            self.read_bytes += read
+            self.written_bytes += written
+
+    def counters(self):
+        with self.lock:
+            return self.ops, self.read_bytes, self.written_bytes
+
+
+def slow_file_class(file_class, target):
+    """CacheFile whose every trip to the target goes through target (a SlowTarget)"""
+    class SlowFile(file_class):
+        def __init__(self, path, flags, *mode):
+            # open and fstat
+            target.op()
+            target.op()
+            file_class.__init__(self, path, flags, *mode)
+
+        def __read_target__(self, size, offset):
+            buf = file_class.__read_target__(self, size, offset)
+            target.op(read=len(buf))
+            return buf
+
+        def write(self, buf, offset):
+            if not self.writeback:
+                target.op(written=len(buf))
+            return file_class.write(self, buf, offset)
+    return SlowFile
+
+
+def percentile(samples, p):
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+
+def bench_threads(args):
+    """
+    Concurrent readers over one file whose first half is cached.  Hits
+    should keep flowing at cache speed however many misses are waiting
+    on the target, so hit latency stays flat as threads are added.
+    """
+    request = 64 * 1024
+    file_size = 64 * 1024 * 1024
+    for threads in [int(t) for t in args.threads.split(',')]:
+        base = tempfile.mkdtemp(prefix='cachefs-bench-')
+        try:
+            fs = BenchFS(base)
+            fs.make_file('/data', file_size)
+            SlowFile = slow_file_class(fs.file_class, SlowTarget(args.latency))
+
+            warm = SlowFile('/data', os.O_RDONLY)
+            offset = 0
+            while offset < file_size / 2:
+                warm.read(1024 * 1024, offset)
+                offset += 1024 * 1024
+            warm.release(0)
+
+            hit_times, miss_times = [], []
+            lock = threading.Lock()
+            deadline = time.time() + args.duration
+
+            def reader(seed):
+                rand = random.Random(seed)
+                f = SlowFile('/data', os.O_RDONLY)
+                hits, misses = [], []
+                while time.time() < deadline:
+                    offset = rand.randrange(0, file_size / request) * request
+                    start = time.time()
+                    f.read(request, offset)
+                    (hits if offset + request <= file_size / 2 else misses).append(time.time() - start)
+                f.release(0)
+                with lock:
+                    hit_times.extend(hits)
+                    miss_times.extend(misses)
+
+            workers = [threading.Thread(target=reader, args=(i,)) for i in range(threads)]
+            start = time.time()
+            for w in workers:
+                w.start()
+            for w in workers:
+                w.join()
+            elapsed = time.time() - start
+
+            ops = len(hit_times) + len(miss_times)
+            print json.dumps({'bench': 'threads',
+                              'threads': threads,
+                              'ops_per_sec': ops / elapsed,
+                              'mib_per_sec': ops * request / elapsed / 2 ** 20,
+                              'hit_ops_per_sec': len(hit_times) / elapsed,
+                              'hit_p50_ms': percentile(hit_times, 0.5) * 1000,
+                              'hit_p99_ms': percentile(hit_times, 0.99) * 1000,
+                              'miss_p99_ms': percentile(miss_times, 0.99) * 1000})
+        finally:
+            shutil.rmtree(base)
+
+
+class Pass(object):
+    """Times the operations of one pass over a workload"""
+    def __init__(self):
+        self.times = []
+        self.bytes = 0
+
+    def time(self, f, *args):
+        start = time.time()
+        ret = f(*args)
+        self.times.append(time.time() - start)
+        self.bytes += len(ret) if isinstance(ret, str) else ret
+        return ret
+
+
+def seq_workload(fs, File, args):
+    """One reader streaming a large file start to end"""
+    fs.make_file('/seq', args.file_size)
+    def run(rand, timer):
+        f = File('/seq', os.O_RDONLY)
+        for offset in xrange(0, args.file_size, args.request):
+            timer.time(f.read, args.request, offset)
+        f.release(0)
+    return run
+
+
+def random_workload(fs, File, args):
+    """4K reads scattered over a large file, the same ones every pass"""
+    fs.make_file('/random', args.file_size)
+    def run(rand, timer):
+        f = File('/random', os.O_RDONLY)
+        for i in xrange(args.ops):
+            timer.time(f.read, 4096, rand.randrange(0, args.file_size / 4096) * 4096)
+        f.release(0)
+    return run
+
+
+def hot_workload(fs, File, args):
+    """4K reads, nine in ten of them from a hot tenth of the file"""
+    fs.make_file('/hot', args.file_size)
+    blocks = args.file_size / 4096
+    def run(rand, timer):
+        f = File('/hot', os.O_RDONLY)
+        for i in xrange(args.ops):
+            if rand.random() < 0.9:
+                block = rand.randrange(0, max(1, blocks / 10))
+            else:
+                block = rand.randrange(0, blocks)
+            timer.time(f.read, 4096, block * 4096)
+        f.release(0)
+    return run
+
+
+def tree_workload(fs, File, args):
+    """Opening and reading every file of a tree of small files"""
+    paths = []
+    for d in range(args.dirs):
+        os.makedirs(fs._physical_path('/tree/%d' % d))
+        for i in range(args.files):
+            path = '/tree/%d/%d' % (d, i)
+            fs.make_file(path, args.small_size)
+            paths.append(path)
+    def read_file(path):
+        f = File(path, os.O_RDONLY)
+        n = len(f.read(args.small_size, 0))
+        f.release(0)
+        return n
+    def run(rand, timer):
+        for path in paths:
+            timer.time(read_file, path)
+    return run
+
+
+def append_workload(fs, File, args):
+    """A log being written 4K at a time, a new one every pass"""
+    logs = itertools.count()
+    buf = os.urandom(4096)
+    def run(rand, timer):
+        path = '/log.%d' % next(logs)
+        f = File(path, os.O_WRONLY | os.O_CREAT, 0644)
+        for i in xrange(args.ops):
+            timer.time(f.write, buf, i * len(buf))
+        f.fsync(False)
+        f.release(0)
+    return run
+
+workloads = OrderedDict([('seq', seq_workload),
+                         ('random', random_workload),
+                         ('hot', hot_workload),
+                         ('tree', tree_workload),
+                         ('append', append_workload)])
+
+
+def bench_suite(args):
+    """
+    Each workload against a fresh cache in front of a slow target, for
+    a number of passes: the first one cold, the rest showing what the
+    cache saved.
+    """
+    for name in args.workloads.split(','):
+        base = tempfile.mkdtemp(prefix='cachefs-bench-')
+        try:
+            fs = BenchFS(base, args.chunk_size, args.compress, args.dedup)
+            fs.small_file = args.small_file
+            FileDataCache.handles.capacity = args.idle_handles
+            if args.ram_cache:
+                FileDataCache.ram_caches[fs.cache] = RamCache(args.ram_cache)
+            target = SlowTarget(args.latency, parse_size(args.bandwidth) if args.bandwidth else None)
+            File = slow_file_class(fs.file_class, target)
+            run = workloads[name](fs, File, args)
+
+            for n in range(args.passes):
+                timer = Pass()
+                before = target.counters()
+                start = time.time()
+                run(random.Random(args.seed), timer)
+                elapsed = time.time() - start
+                ops, read_bytes, written_bytes = [b - a for a, b in zip(before, target.counters())]
+                print json.dumps({'bench': 'suite',
+                                  'workload': name,
+                                  'chunk_size': args.chunk_size,
+                                  'ram_cache': args.ram_cache,
+                                  'compress': args.compress,
+                                  'dedup': args.dedup,
+                                  'small_file': args.small_file,
+                                  'idle_handles': args.idle_handles,
+                                  'pass': n + 1,
+                                  'ops': len(timer.times),
+                                  'ops_per_sec': len(timer.times) / elapsed,
+                                  'mib_per_sec': timer.bytes / elapsed / 2 ** 20,
+                                  'p50_ms': percentile(timer.times, 0.5) * 1000,
+                                  'p99_ms': percentile(timer.times, 0.99) * 1000,
+                                  'target_ops': ops,
+                                  'target_read_bytes': read_bytes,
+                                  'target_written_bytes': written_bytes})
+                sys.stdout.flush()
+        finally:
+            FileDataCache.ram_caches.pop(fs.cache, None)
+            FileDataCache.codecs.pop(fs.cache, None)
+            FileDataCache.stores.pop(fs.cache, None)
+            FileDataCache.handles.clear()
+            shutil.rmtree(base)
+
+
+def bench_misses(args):
+    """
+    Cost of recording a streamed read miss in the block map, committed
+    one at a time versus batched by a BlockWriter.
+    """
+    for mode in ('sync', 'batched'):
+        base = tempfile.mkdtemp(prefix='cachefs-bench-')
+        try:
+            fs = BenchFS(base)
+            fs.make_file('/data', 0)
+            db = open_db(fs.cache)
+            if mode == 'batched':
+                FileDataCache.block_writers[fs.cache] = BlockWriter(fs.cache)
+            cache = FileDataCache(db, fs.cache, '/data', os.O_RDWR, 1)
+            buf = os.urandom(args.size)
+
+            start = time.time()
+            for i in range(args.count):
+                cache.update(buf, i * args.size)
+            elapsed = time.time() - start
+
+            writer = FileDataCache.block_writers.pop(fs.cache, None)
+            if writer:
+                writer.stop(db)
+            print json.dumps({'bench': 'misses',
+                              'mode': mode,
+                              'count': args.count,
+                              'us_per_miss': elapsed / args.count * 1e6})
+        finally:
+            shutil.rmtree(base)
+
+
+def bench_hits(args):
+    """
+    Cost of a cache hit read from the cache file with pread versus
+    sliced out of a memory mapping of it (mmap_reads), for sequential
+    and random reads of a fully cached file at each request size.
+    """
+    for mode in ('pread', 'mmap'):
+        base = tempfile.mkdtemp(prefix='cachefs-bench-')
+        try:
+            fs = BenchFS(base)
+            fs.make_file('/data', args.file_size)
+            if mode == 'mmap':
+                FileDataCache.mappings[fs.cache] = Mappings(1)
+            f = fs.file_class('/data', os.O_RDONLY)
+            for offset in xrange(0, args.file_size, 1024 * 1024):
+                f.read(1024 * 1024, offset)
+
+            for request in [parse_size(size) for size in args.sizes.split(',')]:
+                requests = args.file_size / request
+                for pattern in ('seq', 'random'):
+                    rand = random.Random(args.seed)
+                    timer = Pass()
+                    start = time.time()
+                    for i in xrange(args.ops):
+                        if pattern == 'seq':
+                            offset = i % requests * request
+                        else:
+                            offset = rand.randrange(0, requests) * request
+                        timer.time(f.read, request, offset)
+                    elapsed = time.time() - start
+                    print json.dumps({'bench': 'hits',
+                                      'mode': mode,
+                                      'pattern': pattern,
+                                      'request': request,
+                                      'ops_per_sec': args.ops / elapsed,
+                                      'mib_per_sec': timer.bytes / elapsed / 2 ** 20,
+                                      'p50_us': percentile(timer.times, 0.5) * 1e6,
+                                      'p99_us': percentile(timer.times, 0.99) * 1e6})
+                    sys.stdout.flush()
+            f.release(0)
+        finally:
+            FileDataCache.mappings.pop(fs.cache, None)
+            FileDataCache.handles.clear()
+            shutil.rmtree(base)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='cachefs benchmarks')
+    sub = parser.add_subparsers()
+
+    suite = sub.add_parser('suite', help='common workloads against a slow target')
+    suite.add_argument('--workloads', default=','.join(workloads))
+    suite.add_argument('--latency', type=float, default=0.005,
+                       help='seconds added to every target operation')
+    suite.add_argument('--bandwidth', default='20M',
+                       help='target bytes per second, empty for unlimited')
+    suite.add_argument('--passes', type=int, default=2)
+    suite.add_argument('--seed', type=int, default=0)
+    suite.add_argument('--chunk-size', type=parse_size, default=0,
+                       help='store the cache in chunks of this size rather than byte ranges')
+    suite.add_argument('--ram-cache', type=parse_size, default=0,
+                       help='keep this much of the cache in memory too')
+    suite.add_argument('--compress', default='',
+                       help='compress cached chunks with this codec (zlib or lz4), needs --chunk-size')
+    suite.add_argument('--small-file', type=parse_size, default=0,
+                       help='read files up to this size whole on open')
+    suite.add_argument('--idle-handles', type=int, default=256,
+                       help='handles of closed files kept ready for the next open')
+    suite.add_argument('--dedup', action='store_true',
+                       help='store chunks with the same contents once, needs --chunk-size')
+    suite.add_argument('--file-size', type=parse_size, default=parse_size('32M'))
+    suite.add_argument('--request', type=parse_size, default=parse_size('128K'))
+    suite.add_argument('--ops', type=int, default=1000)
+    suite.add_argument('--dirs', type=int, default=10)
+    suite.add_argument('--files', type=int, default=50)
+    suite.add_argument('--small-size', type=parse_size, default=parse_size('4K'))
+    suite.set_defaults(func=bench_suite)
+
+    threads = sub.add_parser('threads', help='concurrent reader scaling')
+    threads.add_argument('--threads', default='1,2,4,8,16')
+    threads.add_argument('--latency', type=float, default=0.02,
+                         help='seconds added to every target read')
+    threads.add_argument('--duration', type=float, default=5.0)
+    threads.set_defaults(func=bench_threads)
+
+    misses = sub.add_parser('misses', help='per-miss block map overhead')
+    misses.add_argument('--count', type=int, default=5000)
+    misses.add_argument('--size', type=int, default=4096)
+    misses.set_defaults(func=bench_misses)
+
+    hits = sub.add_parser('hits', help='cache hits read with pread versus mmap')
+    hits.add_argument('--sizes', default='4K,64K,128K,1M',
+                      help='request sizes to try')
+    hits.add_argument('--ops', type=int, default=5000)
+    hits.add_argument('--seed', type=int, default=0)
+    hits.add_argument('--file-size', type=parse_size, default=parse_size('64M'))
+    hits.set_defaults(func=bench_hits)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
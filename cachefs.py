@@ -7,8 +7,35 @@ import stat
 import errno
 import sys
 import sqlite3
+import threading
+import Queue
+import json
+import hashlib
+import heapq
+import struct
+import zlib
+import array
+import math
+import signal
+import inspect
+import functools
+import fcntl
+import mmap
+from contextlib import contextmanager
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque
 
 CACHE_FS_VERSION = '0.0.1'
+
+# How chunks can be compressed in the cache: name -> (compress, decompress,
+# what decompress raises on data it can't make sense of)
+CODECS = {'zlib': (lambda data: zlib.compress(data, 1), zlib.decompress, zlib.error)}
+try:
+    import lz4.block
+    CODECS['lz4'] = (lz4.block.compress, lz4.block.decompress, getattr(lz4.block, 'LZ4BlockError', ValueError))
+except ImportError:
+    pass
+
 import fuse
 fuse.fuse_python_api = (0, 2)
 
@@ -22,13 +49,2237 @@ def debug(text):
 
 cache = None
 
+# Read-only virtual file under the mount point with live statistics
+STATS_DIR = '/.cachefs'
+STATS_PATH = STATS_DIR + '/stats'
+
+# The Tracer timing operations when -o trace is given, None otherwise
+tracer = None
+
+
+class Tracer(object):
+    """
+    Times operations and their phases.  Each name gets a histogram of
+    log-spaced buckets (four per doubling, from a microsecond up) that
+    p50/p99/p999 are read from, and the most recent spans are kept for
+    dumping as a Chrome trace, which chrome://tracing and
+    ui.perfetto.dev open.
+    """
+    buckets = 128
+    per_doubling = 4
+
+    def __init__(self, max_events = 200000):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.events = deque(maxlen=max_events)
+        self.started = time.time()
+
+    def span(self, name):
+        return Span(self, name)
+
+    def record(self, name, start, duration):
+        if duration > 1e-6:
+            bucket = min(self.buckets - 1, int(math.log(duration * 1e6, 2) * self.per_doubling))
+        else:
+            bucket = 0
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram == None:
+                histogram = self.histograms[name] = [0] * self.buckets
+            histogram[bucket] += 1
+            self.events.append((name, start, duration, threading.current_thread().ident))
+
+    def latencies(self):
+        """{name: {count, p50_ms, p99_ms, p999_ms}}, from bucket upper bounds"""
+        with self.lock:
+            histograms = dict((name, list(h)) for name, h in self.histograms.items())
+        ret = {}
+        for name, histogram in histograms.items():
+            count = sum(histogram)
+            summary = {'count': count}
+            for label, p in (('p50_ms', 0.5), ('p99_ms', 0.99), ('p999_ms', 0.999)):
+                seen = 0
+                for bucket, n in enumerate(histogram):
+                    seen += n
+                    if seen >= count * p:
+                        break
+                summary[label] = 2 ** (float(bucket + 1) / self.per_doubling) / 1000
+            ret[name] = summary
+        return ret
+
+    def dump(self, path):
+        """Writes the recorded spans to path in the Chrome trace event format"""
+        with self.lock:
+            events = list(self.events)
+        pid = os.getpid()
+        trace = {'traceEvents': [{'name': name, 'cat': name.split('.')[0], 'ph': 'X',
+                                  'ts': (start - self.started) * 1e6, 'dur': duration * 1e6,
+                                  'pid': pid, 'tid': tid}
+                                 for name, start, duration, tid in events],
+                 'displayTimeUnit': 'ms',
+                 'otherData': {'latencies': self.latencies()}}
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(trace, f)
+        os.rename(tmp, path)
+
+
+class Span(object):
+    def __init__(self, tracer, name):
+        self.tracer = tracer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer.record(self.name, self.start, time.time() - self.start)
+
+
+class NoSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+no_span = NoSpan()
+
+
+def span(name):
+    """Times the body of a with block as name, if tracing is on"""
+    if tracer == None:
+        return no_span
+    return tracer.span(name)
+
+
+def traced(name):
+    """Decorates a file system operation to be timed as name"""
+    def decorate(f):
+        if inspect.isgeneratorfunction(f):
+            def wrapper(*args, **kwargs):
+                with span(name):
+                    for item in f(*args, **kwargs):
+                        yield item
+        else:
+            def wrapper(*args, **kwargs):
+                with span(name):
+                    return f(*args, **kwargs)
+        return functools.wraps(f)(wrapper)
+    return decorate
+
 
 class CacheMiss(Exception):
     def __init__(self):
         debug(">> CACHE MISS")
     pass
 
-class FileDataCache:
+class BlockMap(object):
+    """
+    In-memory index of the byte ranges cached for a single node.
+
+    Ranges are kept non-overlapping in three parallel lists sorted by
+    offset, so lookups and merges are bisections rather than queries
+    against the blocks table.  The table is only read when the map is
+    first loaded; after that it is just the persistence layer.
+    """
+    def __init__(self, rows=()):
+        self.lock = threading.Lock()
+        # Held by writers across a change and persisting it
+        self.write_lock = threading.RLock()
+        # Of the node in a SharedCache when the map was last brought up to date
+        self.generation = None
+        # Mapping of the node's cache file, see Mappings
+        self.mapped = None
+        # Open FileDataCaches of the node sharing the map, see FileDataCache.__block_map__()
+        self.users = 0
+        self.starts = []
+        self.ends = []
+        self.lasts = []
+        for offset, end, last in sorted(rows):
+            if self.ends and offset <= self.ends[-1]:
+                # Tolerate overlapping rows left behind by older versions
+                self.ends[-1] = max(self.ends[-1], end)
+                self.lasts[-1] = self.lasts[-1] or bool(last)
+                continue
+            self.starts.append(offset)
+            self.ends.append(end)
+            self.lasts.append(bool(last))
+        self.size = self.__size__()
+
+    def __size__(self):
+        return sum(self.ends) - sum(self.starts)
+
+    @classmethod
+    def load(cls, db, node_id):
+        return cls(db.execute('SELECT offset, end, last_block FROM blocks WHERE node_id = ?', (node_id,)))
+
+    def __len__(self):
+        return len(self.starts)
+
+    def find(self, offset):
+        """Returns (offset, length, last) of the block holding offset"""
+        with self.lock:
+            i = bisect_right(self.starts, offset) - 1
+            if i >= 0 and self.ends[i] > offset:
+                return (self.starts[i], self.ends[i] - self.starts[i], self.lasts[i])
+            return (None, None, False)
+
+    def add(self, offset, end, last):
+        """
+        Merges [offset, end) with every block it overlaps or touches.
+        Returns the merged (offset, end, last) and the offsets of the
+        blocks it replaced, or None if there was nothing to record.
+        """
+        with self.lock:
+            return self.__merge__(offset, end, last)
+
+    def __merge__(self, offset, end, last):
+        lo = bisect_left(self.ends, offset)
+        hi = bisect_right(self.starts, end)
+        if lo == hi and offset == end:
+            return None
+
+        replaced = self.starts[lo:hi]
+        self.size -= sum(self.ends[lo:hi]) - sum(replaced)
+        if lo < hi:
+            if self.ends[hi - 1] > end:
+                last = self.lasts[hi - 1]
+            elif self.ends[hi - 1] == end:
+                last = last or self.lasts[hi - 1]
+            offset = min(offset, self.starts[lo])
+            end = max(end, self.ends[hi - 1])
+
+        self.starts[lo:hi] = [offset]
+        self.ends[lo:hi] = [end]
+        self.lasts[lo:hi] = [bool(last)]
+        self.size += end - offset
+        if lo > 0 and self.lasts[lo - 1]:
+            # The node goes on past what was its end
+            self.lasts[lo - 1] = False
+        return (offset, end, bool(last)), replaced
+
+    def segments(self, offset, end):
+        """
+        Splits [offset, end) into (offset, length, cached) pieces.  Stops
+        early at the end of a last block since nothing exists past it.
+        """
+        with self.lock:
+            return self.__segments__(offset, end)
+
+    def __segments__(self, offset, end):
+        segs = []
+        i = max(bisect_right(self.starts, offset) - 1, 0)
+        pos = offset
+        while pos < end:
+            if i < len(self.starts) and self.ends[i] <= pos:
+                i += 1
+            elif i < len(self.starts) and self.starts[i] <= pos:
+                seg_end = min(end, self.ends[i])
+                segs.append((pos, seg_end - pos, True))
+                pos = seg_end
+                if self.lasts[i]:
+                    break
+                i += 1
+            else:
+                seg_end = end
+                if i < len(self.starts):
+                    seg_end = min(end, self.starts[i])
+                segs.append((pos, seg_end - pos, False))
+                pos = seg_end
+        return segs
+
+    def truncate(self, l):
+        """
+        Drops everything at or past l, the block reaching l becomes the
+        last one.  If none does the node grew, and what lies between the
+        end of the last block and l has to be read like any other gap.
+        """
+        with self.lock:
+            i = bisect_left(self.starts, l)
+            del self.starts[i:], self.ends[i:], self.lasts[i:]
+            if self.ends and self.ends[-1] >= l:
+                self.ends[-1] = l
+                self.lasts[-1] = True
+            elif self.lasts:
+                self.lasts[-1] = False
+            self.size = self.__size__()
+
+    def rows(self):
+        with self.lock:
+            return zip(self.starts, self.ends, self.lasts)
+
+    def known(self):
+        with self.lock:
+            return dict((offset, end - offset) for offset, end in zip(self.starts, self.ends))
+
+    def align(self, offset, end):
+        """The range to fetch to cache [offset, end), any range will do"""
+        return offset, end
+
+    def partial(self, offset, end):
+        """Uncached ranges a write of [offset, end) would leave untracked, none here"""
+        return []
+
+    def replace(self, fresh):
+        """Takes on what fresh, a later load of the same node, holds"""
+        with self.lock:
+            self.starts, self.ends, self.lasts, self.size = fresh.starts, fresh.ends, fresh.lasts, fresh.size
+
+    def save(self, db, node_id):
+        db.execute("DELETE FROM blocks WHERE node_id = ?", (node_id,))
+        db.executemany('INSERT INTO blocks VALUES (?, ?, ?, ?)',
+                       [(node_id, offset, end, last) for offset, end, last in self.rows()])
+
+    def save_add(self, db, node_id, merged):
+        """Persists what add() returned, touching only the rows that changed"""
+        (offset, end, last), replaced = merged
+        db.executemany("DELETE FROM blocks WHERE node_id = ? AND offset = ?",
+                       [(node_id, o) for o in replaced])
+        db.execute("UPDATE blocks SET last_block = 0 WHERE node_id = ? AND end < ? AND last_block = 1",
+                   (node_id, offset))
+        db.execute('INSERT INTO blocks VALUES (?, ?, ?, ?)', (node_id, offset, end, last))
+
+    def save_truncate(self, db, node_id, l):
+        db.execute("DELETE FROM blocks WHERE node_id = ? AND offset >= ?", (node_id, l))
+        db.execute("UPDATE blocks SET last_block = 0 WHERE node_id = ? AND end < ?", (node_id, l))
+        db.execute("UPDATE blocks SET end = ?, last_block = 1 WHERE node_id = ? AND end >= ?", (l, node_id, l))
+
+
+class ChunkMap(object):
+    """
+    In-memory index of the data cached for a single node, in fixed size
+    chunks of a power of two bytes: one bit per chunk, plus where the
+    node ends once that is known.  Lookups are a shift and a bit test,
+    misses are fetched in whole chunks, and the map is persisted as one
+    row of the chunks table with the bits as a blob.
+
+    A chunk is only marked once all of it, up to the end of the node, is
+    in the cache file, so part of a chunk written on its own stays
+    unmarked.
+
+    In a compressed cache each chunk is stored compressed at its own
+    offset in the cache file, which stays sparse, and stored keeps the
+    bytes it takes there, negated for chunks that didn't compress and
+    are stored as is.  size is then what the node takes up on disk.  In
+    a deduplicating cache chunks live in the ChunkStore instead, and
+    hashes keeps the digest each one is stored under.  Digests a chunk
+    stops referring to pile up in released until the map is saved,
+    which gives the references back in the same transaction.
+    """
+    def __init__(self, chunk_size, bitmap = '', eof = None, lengths = None, packed = False, hashes = None):
+        self.lock = threading.Lock()
+        # Held by writers across a change and persisting it
+        self.write_lock = threading.RLock()
+        # Of the node in a SharedCache when the map was last brought up to date
+        self.generation = None
+        # Mapping of the node's cache file, see Mappings
+        self.mapped = None
+        # Open FileDataCaches of the node sharing the map, see FileDataCache.__block_map__()
+        self.users = 0
+        self.chunk_size = chunk_size
+        self.shift = chunk_size.bit_length() - 1
+        self.bits = bytearray(bitmap or '')
+        self.eof = eof
+        self.count = sum(bin(b).count('1') for b in self.bits)
+        self.stored = None
+        self.hashes = None
+        self.released = []
+        if packed:
+            self.stored = {}
+            if lengths:
+                for chunk, length in enumerate(array.array('i', str(lengths))):
+                    if length and self.__has__(chunk):
+                        self.stored[chunk] = length
+            self.stored_bytes = sum(abs(length) for length in self.stored.values())
+        if hashes != None:
+            self.hashes = {}
+            hashes = str(hashes)
+            for chunk in self.stored:
+                digest = hashes[chunk * 20:chunk * 20 + 20]
+                if digest.strip('\0'):
+                    self.hashes[chunk] = digest
+        self.size = self.__size__()
+
+    @classmethod
+    def load(cls, db, node_id, chunk_size, packed = False, dedup = False):
+        row = db.execute('SELECT bitmap, eof, lengths, hashes FROM chunks WHERE node_id = ?', (node_id,)).fetchone()
+        if row == None:
+            return cls(chunk_size, packed=packed, hashes='' if dedup else None)
+        return cls(chunk_size, str(row[0]), row[1], row[2], packed, (row[3] or '') if dedup else None)
+
+    def __size__(self):
+        if self.stored != None:
+            return self.stored_bytes
+        size = self.count << self.shift
+        if self.eof != None and self.eof & (self.chunk_size - 1) and self.__has__(self.eof >> self.shift):
+            size -= self.chunk_size - (self.eof & (self.chunk_size - 1))
+        return size
+
+    def __len__(self):
+        return self.count
+
+    def __has__(self, chunk):
+        byte = chunk >> 3
+        return byte < len(self.bits) and bool(self.bits[byte] & (1 << (chunk & 7)))
+
+    def __set__(self, chunk):
+        byte = chunk >> 3
+        if byte >= len(self.bits):
+            self.bits.extend('\0' * (byte + 1 - len(self.bits)))
+        if not self.bits[byte] & (1 << (chunk & 7)):
+            self.bits[byte] |= 1 << (chunk & 7)
+            self.count += 1
+            return True
+        return False
+
+    def __clear__(self, chunk):
+        byte = chunk >> 3
+        if byte < len(self.bits) and self.bits[byte] & (1 << (chunk & 7)):
+            self.bits[byte] &= ~(1 << (chunk & 7))
+            self.count -= 1
+            if self.stored != None:
+                self.stored_bytes -= abs(self.stored.pop(chunk, 0))
+            if self.hashes != None and chunk in self.hashes:
+                self.released.append(self.hashes.pop(chunk))
+
+    def cached(self, chunk):
+        with self.lock:
+            return self.__has__(chunk)
+
+    def stored_length(self, chunk):
+        """(bytes, raw, digest) chunk is stored as, None if it isn't stored"""
+        with self.lock:
+            length = self.stored.get(chunk)
+            digest = self.hashes.get(chunk) if self.hashes != None else None
+        if length == None:
+            return None
+        return abs(length), length < 0, digest
+
+    def store(self, chunk, length, raw, digest = None):
+        """Records how chunk was just stored"""
+        with self.lock:
+            self.stored_bytes += length - abs(self.stored.get(chunk, 0))
+            self.stored[chunk] = -length if raw else length
+            if self.hashes != None:
+                if chunk in self.hashes:
+                    self.released.append(self.hashes.pop(chunk))
+                if digest != None:
+                    self.hashes[chunk] = digest
+            self.size = self.__size__()
+
+    def __drop_from__(self, chunk):
+        """Clears every chunk from chunk on"""
+        for c in range(chunk, len(self.bits) * 8):
+            self.__clear__(c)
+        del self.bits[(chunk + 7) >> 3:]
+
+    def __run__(self, chunk):
+        """(offset, end, last) of the run of cached chunks around chunk"""
+        first = chunk
+        while first > 0 and self.__has__(first - 1):
+            first -= 1
+        stop = chunk + 1
+        while self.__has__(stop):
+            stop += 1
+        end = stop << self.shift
+        if self.eof != None and end >= self.eof:
+            return first << self.shift, self.eof, True
+        return first << self.shift, end, False
+
+    def find(self, offset):
+        """Returns (offset, length, last) of the run of chunks holding offset"""
+        with self.lock:
+            if (self.eof != None and offset >= self.eof) or not self.__has__(offset >> self.shift):
+                return (None, None, False)
+            start, end, last = self.__run__(offset >> self.shift)
+            return (start, end - start, last)
+
+    def add(self, offset, end, last):
+        """
+        Marks the chunks [offset, end) covers whole, or up to the end of
+        the node when last.  Returns None if nothing changed.
+        """
+        mask = self.chunk_size - 1
+        with self.lock:
+            changed = False
+            if last:
+                if self.eof != end:
+                    self.eof = end
+                    changed = True
+                    self.__drop_from__((end + mask) >> self.shift)
+            elif self.eof != None and end > self.eof:
+                # The node goes on past end, by how much isn't known
+                self.eof = None
+                changed = True
+                if end & mask:
+                    self.__clear__(end >> self.shift)
+            stop = end >> self.shift
+            if last and end & mask:
+                stop += 1
+            for chunk in range((offset + mask) >> self.shift, stop):
+                changed = self.__set__(chunk) or changed
+            self.size = self.__size__()
+            return changed or None
+
+    def segments(self, offset, end):
+        """
+        Splits [offset, end) into (offset, length, cached) pieces.  Stops
+        early at the end of the node since nothing exists past it.
+        """
+        segs = []
+        with self.lock:
+            pos = offset
+            while pos < end:
+                chunk = pos >> self.shift
+                cached = self.__has__(chunk)
+                seg_end = min(end, (chunk + 1) << self.shift)
+                stop = cached and self.eof != None and seg_end >= self.eof
+                if stop:
+                    seg_end = self.eof
+                if segs and segs[-1][2] == cached:
+                    segs[-1] = (segs[-1][0], seg_end - segs[-1][0], cached)
+                else:
+                    segs.append((pos, seg_end - pos, cached))
+                if stop:
+                    break
+                pos = seg_end
+        return [(o, e, c) for o, e, c in segs if e > 0]
+
+    def truncate(self, l):
+        """Drops every chunk past l, which becomes the end of the node"""
+        with self.lock:
+            self.__drop_from__((l + self.chunk_size - 1) >> self.shift)
+            self.eof = l
+            self.size = self.__size__()
+
+    def known(self):
+        ret = {}
+        with self.lock:
+            chunk = 0
+            while chunk < len(self.bits) * 8:
+                if self.__has__(chunk):
+                    start, end, last = self.__run__(chunk)
+                    ret[start] = end - start
+                    chunk = (end >> self.shift) + 1
+                else:
+                    chunk += 1
+        return ret
+
+    def align(self, offset, end):
+        """The whole chunks covering [offset, end)"""
+        mask = self.chunk_size - 1
+        return offset & ~mask, (end + mask) & ~mask
+
+    def partial(self, offset, end):
+        """Uncached chunks a write of [offset, end) only covers part of"""
+        mask = self.chunk_size - 1
+        ret = []
+        with self.lock:
+            for edge in set([offset, end]):
+                if edge & mask and not self.__has__(edge >> self.shift):
+                    start = edge & ~mask
+                    if start < offset or start + self.chunk_size > end:
+                        ret.append((start, start + self.chunk_size))
+        return sorted(set(ret))
+
+    def replace(self, fresh):
+        """Takes on what fresh, a later load of the same node, holds"""
+        with self.lock:
+            self.bits, self.eof, self.count = fresh.bits, fresh.eof, fresh.count
+            self.stored, self.hashes = fresh.stored, fresh.hashes
+            if fresh.stored != None:
+                self.stored_bytes = fresh.stored_bytes
+            self.size = fresh.size
+
+    def save(self, db, node_id):
+        with self.lock:
+            bitmap, eof, lengths = buffer(str(self.bits)), self.eof, None
+            if self.stored != None:
+                stored = array.array('i', [0]) * (len(self.bits) * 8)
+                for chunk, length in self.stored.items():
+                    if chunk < len(stored):
+                        stored[chunk] = length
+                lengths = buffer(stored.tostring())
+            hashes = None
+            if self.hashes != None:
+                digests = bytearray(len(self.bits) * 8 * 20)
+                for chunk, digest in self.hashes.items():
+                    digests[chunk * 20:chunk * 20 + 20] = digest
+                hashes = buffer(str(digests))
+        db.execute('INSERT OR REPLACE INTO chunks (node_id, eof, bitmap, lengths, hashes) VALUES (?, ?, ?, ?, ?)',
+                   (node_id, eof, bitmap, lengths, hashes))
+        self.release(db)
+
+    def release(self, db):
+        """Gives back the references of the chunks the map dropped, in db's transaction"""
+        with self.lock:
+            released, self.released = self.released, []
+        db.executemany('UPDATE chunk_store SET refs = refs - 1 WHERE hash = ?',
+                       [(buffer(digest),) for digest in released])
+
+    def save_add(self, db, node_id, merged):
+        self.save(db, node_id)
+
+    def save_truncate(self, db, node_id, l):
+        self.save(db, node_id)
+
+
+def codec_of(db, cachebase):
+    """The name of the codec chunks of the cache in cachebase are compressed with, '' if they aren't"""
+    codec = FileDataCache.codecs.get(cachebase)
+    if codec == None:
+        row = db.execute("SELECT value FROM settings WHERE name = 'compression'").fetchone()
+        codec = FileDataCache.codecs[cachebase] = row[0] if row else ''
+    return codec
+
+
+def store_of(db, cachebase):
+    """The ChunkStore the chunks of the cache in cachebase are deduplicated in, None if they aren't"""
+    with FileDataCache.block_maps_lock:
+        if cachebase not in FileDataCache.stores:
+            row = db.execute("SELECT value FROM settings WHERE name = 'dedup'").fetchone()
+            FileDataCache.stores[cachebase] = ChunkStore(cachebase) if row and str(row[0]) == '1' else None
+        return FileDataCache.stores[cachebase]
+
+
+def shared_of(db, cachebase):
+    """The SharedCache of the cache in cachebase, None if it isn't shared between mounts"""
+    with FileDataCache.block_maps_lock:
+        if cachebase not in FileDataCache.shared:
+            row = db.execute("SELECT value FROM settings WHERE name = 'shared'").fetchone()
+            FileDataCache.shared[cachebase] = SharedCache(cachebase) if row and str(row[0]) == '1' else None
+        return FileDataCache.shared[cachebase]
+
+
+def whole_files_of(db, cachebase):
+    """
+    node_id -> (path, size, mtime, ctime) of the small files of the cache
+    in cachebase that are cached whole, read from the database only once.
+    Always empty if the cache is shared: another mount may have changed
+    the file since, which only the node's lock and generation tell.
+    Every write looks here, so once loaded this takes no lock.
+    """
+    whole = FileDataCache.whole_files.get(cachebase)
+    if whole != None:
+        return whole
+    shared = shared_of(db, cachebase)
+    with FileDataCache.whole_files_lock:
+        whole = FileDataCache.whole_files.get(cachebase)
+        if whole == None:
+            whole = {}
+            if shared == None:
+                whole.update((node_id, (path, size, mtime, ctime)) for node_id, path, size, mtime, ctime in
+                             db.execute('SELECT nodes.id, paths.path, size, mtime, ctime FROM nodes '
+                                        'JOIN paths ON paths.node_id = nodes.id WHERE whole = 1'))
+            # Published once filled in, readers don't wait for the lock
+            FileDataCache.whole_files[cachebase] = whole
+        return whole
+
+
+def chunk_size_of(db, cachebase):
+    """The chunk size of the cache in cachebase, 0 if it stores byte ranges"""
+    chunk_size = FileDataCache.chunk_sizes.get(cachebase)
+    if chunk_size == None:
+        row = db.execute("SELECT value FROM settings WHERE name = 'chunk_size'").fetchone()
+        chunk_size = FileDataCache.chunk_sizes[cachebase] = int(row[0]) if row else 0
+    return chunk_size
+
+
+def cached_sizes(db, cachebase):
+    """(node_id, bytes cached) of every node with something cached, least recently opened first"""
+    if not chunk_size_of(db, cachebase):
+        return db.execute('SELECT blocks.node_id, SUM(blocks.end - blocks.offset) FROM blocks '
+                          'LEFT JOIN nodes ON nodes.id = blocks.node_id '
+                          'GROUP BY blocks.node_id ORDER BY nodes.last_use').fetchall()
+    chunk_size = chunk_size_of(db, cachebase)
+    packed = bool(codec_of(db, cachebase)) or store_of(db, cachebase) != None
+    return [(node_id, ChunkMap(chunk_size, str(bitmap), eof, lengths, packed).size)
+            for node_id, bitmap, eof, lengths in db.execute('SELECT chunks.node_id, bitmap, eof, lengths FROM chunks '
+                                                            'LEFT JOIN nodes ON nodes.id = chunks.node_id '
+                                                            'ORDER BY nodes.last_use').fetchall()]
+
+
+class ChunkStore(object):
+    """
+    Content addressed store for the chunks of a deduplicating cache.
+    Each distinct chunk is kept once, in a file named after the SHA-1 of
+    its contents, with a row in the chunk_store table counting the chunk
+    maps referring to it (and its length, negated if it is stored as
+    is).  References are taken right away and given back when the map
+    that dropped them is saved, so a crash can at worst leave a chunk
+    nobody needs, never a map pointing at a chunk that is gone.  Chunks
+    nobody refers to any more are removed by sweep().
+    """
+    def __init__(self, cachebase):
+        self.cachebase = cachebase
+        self.root = os.path.join(cachebase, "chunk_store")
+        # Held from looking a chunk up to taking a reference to it, and
+        # by sweep(), so a chunk can't be swept away in between
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def __locked__(self, db):
+        """self.lock, and the store's lock against the other mounts if the cache is shared"""
+        shared = shared_of(db, self.cachebase)
+        with self.lock:
+            if shared == None:
+                yield
+            else:
+                with shared.locked(None, True):
+                    yield
+
+    def path(self, digest):
+        name = digest.encode('hex')
+        return os.path.join(self.root, name[:2], name)
+
+    def put(self, db, data, pack):
+        """
+        Takes a reference to the chunk holding data, storing pack(data) ->
+        (bytes, raw) first if it's new.  Returns (digest, length, raw).
+        """
+        digest = hashlib.sha1(data).digest()
+        with self.__locked__(db):
+            row = db.execute('SELECT length FROM chunk_store WHERE hash = ?', (buffer(digest),)).fetchone()
+            if row == None:
+                packed, raw = pack(data)
+                path = self.path(digest)
+                try:
+                    os.makedirs(os.path.dirname(path))
+                except OSError:
+                    pass
+                with span('cache.write'):
+                    with open(path + '.tmp', 'wb') as f:
+                        f.write(packed)
+                    os.rename(path + '.tmp', path)
+                length = -len(packed) if raw else len(packed)
+                with db:
+                    db.execute('INSERT INTO chunk_store VALUES (?, 1, ?)', (buffer(digest), length))
+            else:
+                length = row[0]
+                with db:
+                    db.execute('UPDATE chunk_store SET refs = refs + 1 WHERE hash = ?', (buffer(digest),))
+        return digest, abs(length), length < 0
+
+    def read(self, digest, length):
+        with open(self.path(digest), 'rb') as f:
+            return f.read(length)
+
+    def sweep(self, db):
+        """Removes the chunks nobody refers to any more"""
+        with self.__locked__(db):
+            with db:
+                garbage = db.execute('SELECT hash FROM chunk_store WHERE refs <= 0').fetchall()
+                db.execute('DELETE FROM chunk_store WHERE refs <= 0')
+            for digest, in garbage:
+                try:
+                    os.remove(self.path(str(digest)))
+                except OSError:
+                    pass
+
+    def usage(self, db):
+        """(bytes the chunk maps refer to, bytes actually stored)"""
+        referenced, stored = db.execute('SELECT SUM(refs * ABS(length)), SUM(ABS(length)) FROM chunk_store '
+                                        'WHERE refs > 0').fetchone()
+        return referenced or 0, stored or 0
+
+
+class SharedCache(object):
+    """
+    Lets several mounts, each its own process, use one cache directory
+    at once.  Everything they need to agree on lives in <cache>/shared:
+
+    A generation counter per node (hashed into slots, mapped into every
+    mount's memory) that is bumped once a change to the node's cached
+    data is committed, so a mount can tell its in-memory map is out of
+    date with a memory read and load it again, instead of rescanning.
+
+    Past the counters, a byte per node that is locked with fcntl() to
+    keep a mount from reading cached data while another one changes it:
+    shared by readers, exclusive by writers.  Threads of one process
+    all hold the same POSIX lock, so they are sorted out among
+    themselves here first, and only the first reader in and the last
+    one out touch the file lock.  The byte past every node's is the
+    lock of the ChunkStore.
+    """
+    slots = 65536
+
+    def __init__(self, cachebase):
+        self.fd = os.open(os.path.join(cachebase, "shared"), os.O_RDWR | os.O_CREAT, 0644)
+        if os.fstat(self.fd).st_size < self.slots * 8:
+            os.ftruncate(self.fd, self.slots * 8)
+        self.counters = mmap.mmap(self.fd, self.slots * 8)
+        self.lock = threading.Lock()
+        self.cond = threading.Condition()
+        # lock byte -> readers holding it, -1 for a writer, None while taking or giving up the file lock
+        self.holders = {}
+        self.reloads = 0
+
+    def generation(self, node_id):
+        return struct.unpack_from('<Q', self.counters, node_id % self.slots * 8)[0]
+
+    def bump(self, node_id):
+        """Tells the other mounts node_id changed, once the change is committed.  Returns its new generation."""
+        offset = node_id % self.slots * 8
+        with self.lock:
+            # Nodes sharing a slot may be bumped by two mounts at once
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, 8, offset)
+            try:
+                generation = struct.unpack_from('<Q', self.counters, offset)[0] + 1
+                struct.pack_into('<Q', self.counters, offset, generation)
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, 8, offset)
+        return generation
+
+    def __byte__(self, node_id):
+        if node_id == None:
+            return self.slots * 8 + (1 << 62)
+        return self.slots * 8 + node_id % (1 << 62)
+
+    def acquire(self, node_id, exclusive = False):
+        """Locks node_id (the ChunkStore for None) against every other mount, and against this one's other threads"""
+        byte = self.__byte__(node_id)
+        with self.cond:
+            while True:
+                held = self.holders.get(byte, 0)
+                if held == 0:
+                    break
+                if held > 0 and not exclusive:
+                    self.holders[byte] = held + 1
+                    return
+                self.cond.wait()
+            self.holders[byte] = None
+        try:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH, 1, byte)
+        except:
+            with self.cond:
+                del self.holders[byte]
+                self.cond.notify_all()
+            raise
+        with self.cond:
+            self.holders[byte] = -1 if exclusive else 1
+            self.cond.notify_all()
+
+    def release(self, node_id):
+        byte = self.__byte__(node_id)
+        with self.cond:
+            held = self.holders[byte]
+            if held > 1:
+                self.holders[byte] = held - 1
+                return
+            self.holders[byte] = None
+        try:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, byte)
+        finally:
+            with self.cond:
+                del self.holders[byte]
+                self.cond.notify_all()
+
+    @contextmanager
+    def locked(self, node_id, exclusive = False):
+        self.acquire(node_id, exclusive)
+        try:
+            yield
+        finally:
+            self.release(node_id)
+
+
+class AccessPattern(object):
+    """
+    Per-handle sequential stream detector.  Once two reads in a row are
+    contiguous it asks for readahead, doubling the window from
+    min_window up to max_window each time the reader catches up to half
+    a window of what was already requested.
+    """
+    def __init__(self, min_window, max_window):
+        self.min_window = min_window
+        self.max_window = max_window
+        self.next_offset = None
+        self.window = 0
+        self.ahead = 0
+
+    def access(self, offset, size):
+        """Records a read, returns the (offset, size) to prefetch or None"""
+        end = offset + size
+        sequential = offset == self.next_offset
+        self.next_offset = end
+        if not sequential:
+            self.window = 0
+            self.ahead = end
+            return None
+
+        if self.window and self.ahead - end >= self.window / 2:
+            return None
+
+        self.window = min(max(self.window * 2, self.min_window), self.max_window)
+        start = max(self.ahead, end)
+        self.ahead = end + self.window
+        if start >= self.ahead:
+            return None
+        return (start, self.ahead - start)
+
+
+class Readahead(object):
+    """
+    Background threads pulling upcoming ranges of sequentially read files
+    from the target into the cache.  At most max_pending bytes may be
+    queued at once, further requests are dropped until the queue drains.
+    """
+    chunk_size = 1024 * 1024
+
+    def __init__(self, cachebase, min_window, max_window, max_pending, threads = 2):
+        self.cachebase = cachebase
+        self.min_window = min_window
+        self.max_window = max_window
+        self.max_pending = max_pending
+        self.pending = 0
+        self.fetched = 0
+        self.lock = threading.Lock()
+        self.queue = Queue.Queue()
+        self.threads = []
+        for i in range(threads):
+            t = threading.Thread(target=self.__worker__, name="readahead-%d" % i)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def pattern(self):
+        return AccessPattern(self.min_window, self.max_window)
+
+    def submit(self, target_path, path, node_id, offset, size):
+        with self.lock:
+            if self.pending + size > self.max_pending:
+                return False
+            self.pending += size
+        self.queue.put((target_path, path, node_id, offset, size))
+        return True
+
+    def wait(self):
+        self.queue.join()
+
+    def stop(self):
+        for t in self.threads:
+            self.queue.put(None)
+        for t in self.threads:
+            t.join()
+
+    def __worker__(self):
+        db = open_db(self.cachebase)
+        while True:
+            job = self.queue.get()
+            try:
+                if job == None:
+                    break
+                self.__prefetch__(db, *job)
+            except Exception, e:
+                debug("readahead error: %s" % e)
+            finally:
+                if job != None:
+                    with self.lock:
+                        self.pending -= job[-1]
+                self.queue.task_done()
+        db.close()
+
+    def __prefetch__(self, db, target_path, path, node_id, offset, size):
+        cache = FileDataCache(db, self.cachebase, path, os.O_RDWR, node_id)
+        f = os.open(target_path, os.O_RDONLY)
+        try:
+            fetched = fetch_range(cache, f, offset, offset + size, self.chunk_size)
+            with self.lock:
+                self.fetched += fetched
+        finally:
+            os.close(f)
+            cache.close()
+
+
+class AccessLog(object):
+    """
+    Append-only record of what was read through the mount, kept in
+    access.log in the cache dir as fixed size (time, node_id, offset,
+    size) records.  A node read sequentially extends its last record
+    rather than adding new ones, so a streamed file costs one record.
+    Once the log outgrows max_bytes its older half is dropped.
+    """
+    record = struct.Struct('<dqqq')
+    # Reads this many seconds old count half as much towards the hot set
+    half_life = 24 * 3600
+
+    def __init__(self, cachebase, max_bytes = 16 * 1024 * 1024):
+        self.path = os.path.join(cachebase, "access.log")
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # node_id -> [time, offset, end] of the run each node is being read in
+        self.runs = OrderedDict()
+        self.f = open(self.path, 'ab')
+        self.size = self.f.tell()
+
+    def add(self, node_id, offset, size):
+        with self.lock:
+            run = self.runs.pop(node_id, None)
+            if run != None and run[2] == offset:
+                run[2] += size
+            else:
+                if run != None:
+                    self.__write__(node_id, run)
+                run = [time.time(), offset, offset + size]
+            self.runs[node_id] = run
+            if len(self.runs) > 256:
+                self.__write__(*self.runs.popitem(False))
+
+    def flush(self):
+        with self.lock:
+            while self.runs:
+                self.__write__(*self.runs.popitem(False))
+            self.f.flush()
+
+    def close(self):
+        self.flush()
+        self.f.close()
+
+    def __write__(self, node_id, run):
+        self.f.write(self.record.pack(run[0], node_id, run[1], run[2] - run[1]))
+        self.size += self.record.size
+        if self.size > self.max_bytes:
+            self.f.close()
+            with open(self.path, 'rb') as f:
+                f.seek(-(self.max_bytes / 2 / self.record.size * self.record.size), os.SEEK_END)
+                keep = f.read()
+            with open(self.path + '.tmp', 'wb') as f:
+                f.write(keep)
+            os.rename(self.path + '.tmp', self.path)
+            self.f = open(self.path, 'ab')
+            self.size = len(keep)
+
+    def records(self):
+        """Every (time, node_id, offset, size) in the log, oldest first"""
+        self.flush()
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        size = self.record.size
+        return [self.record.unpack_from(data, at) for at in range(0, len(data) - size + 1, size)]
+
+    def hot_set(self, budget, now = None):
+        """
+        The ranges most worth having cached, at most budget bytes of them,
+        as (node_id, offset, end) in the order they were first read.  Reads
+        of a node are merged into extents, each scored by how often and how
+        lately it was read.
+        """
+        if now == None:
+            now = time.time()
+        by_node = {}
+        for t, node_id, offset, size in self.records():
+            by_node.setdefault(node_id, []).append((offset, offset + size, t))
+
+        extents = []
+        for node_id, reads in by_node.items():
+            reads.sort()
+            current = None
+            for offset, end, t in reads:
+                weight = 0.5 ** (max(0, now - t) / self.half_life)
+                if current != None and offset <= current[2]:
+                    current[2] = max(current[2], end)
+                    current[3] += weight
+                    current[4] = min(current[4], t)
+                else:
+                    current = [node_id, offset, end, weight, t]
+                    extents.append(current)
+
+        chosen = []
+        for node_id, offset, end, score, first in sorted(extents, key=lambda e: -e[3]):
+            if budget <= 0:
+                break
+            end = min(end, offset + budget)
+            budget -= end - offset
+            chosen.append((first, node_id, offset, end))
+        return [(node_id, offset, end) for first, node_id, offset, end in sorted(chosen)]
+
+
+class Prewarm(object):
+    """
+    Fetches the hot set of the access log back into the cache after a
+    mount, from a single background thread at lowered priority, in the
+    order it was first read.  Files that changed on the target since are
+    dropped by validating them first, and not fetched.  It gives up for good the moment
+    anything is opened through the mount, which needs the target more.
+    """
+    chunk_size = 1024 * 1024
+
+    def __init__(self, cachebase, target, ranges):
+        self.cachebase = cachebase
+        self.target = target
+        self.ranges = ranges
+        self.fetched = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.__worker__, name="prewarm")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def join(self):
+        self.thread.join()
+
+    def __worker__(self):
+        if sys.platform.startswith('linux'):
+            # Only lowers this thread's priority on Linux
+            try:
+                os.nice(10)
+            except OSError:
+                pass
+        db = open_db(self.cachebase)
+        try:
+            opened = {}
+            for node_id, offset, end in self.ranges:
+                if self.stopped.is_set():
+                    break
+                try:
+                    if node_id not in opened:
+                        opened[node_id] = self.__open__(db, node_id)
+                    if opened[node_id] == None:
+                        continue
+                    cache, f, size = opened[node_id]
+                    while offset < min(end, size) and not self.stopped.is_set():
+                        piece = min(end, offset + self.chunk_size)
+                        self.fetched += fetch_range(cache, f, offset, piece, self.chunk_size, size)
+                        offset = piece
+                except Exception, e:
+                    debug("prewarm error: %s" % e)
+                    opened[node_id] = None
+            for entry in opened.values():
+                if entry != None:
+                    os.close(entry[1])
+                    entry[0].close()
+        finally:
+            db.close()
+
+    def __open__(self, db, node_id):
+        """(cache, target file, size) of node_id, or None if it's gone or changed on the target"""
+        row = db.execute('SELECT path FROM paths WHERE node_id = ?', (node_id,)).fetchone()
+        if row == None:
+            return None
+        path = row[0]
+        f = os.open(os.path.join(self.target, path.lstrip('/')), os.O_RDONLY)
+        st = os.fstat(f)
+        if st.st_ino != node_id:
+            os.close(f)
+            return None
+        cache = FileDataCache(db, self.cachebase, path, os.O_RDWR, node_id)
+        if not cache.validate(st):
+            # Whoever reads it now may well want something else of it
+            os.close(f)
+            cache.close()
+            return None
+        return cache, f, st.st_size
+
+
+def fetch_range(cache, f, offset, end, chunk_size, size = None):
+    """
+    Copies whatever of [offset, end) isn't cached yet from the open target
+    file f into cache, chunk_size bytes at a time, stopping at the end of
+    the file (size, when known).  Returns the number of bytes fetched.
+    """
+    fetched = 0
+    key = (cache.cachebase, cache.node_id)
+    for seg_offset, seg_size, cached in cache.blocks.segments(offset, end):
+        if cached:
+            continue
+        seg_offset, seg_end = cache.blocks.align(seg_offset, seg_offset + seg_size)
+        while seg_offset < seg_end:
+            want = cache.blocks.align(seg_offset, min(seg_end, seg_offset + chunk_size))[1] - seg_offset
+            mine, done = FileDataCache.in_flight.claim(key, seg_offset, seg_offset + want)
+            if not mine:
+                # Someone else is already on it
+                seg_offset += want
+                continue
+            try:
+                buf = pread(f, want, seg_offset)
+                last = len(buf) < want or (size != None and seg_offset + len(buf) >= size)
+                cache.update(buf, seg_offset, last)
+            finally:
+                FileDataCache.in_flight.release(key, seg_offset, seg_offset + want, done)
+            fetched += len(buf)
+            if last:
+                return fetched
+            seg_offset += want
+    return fetched
+
+
+class LRUPolicy(object):
+    """Evicts the node that was used least recently"""
+    def __init__(self, evictor):
+        self.order = OrderedDict()
+
+    def insert(self, node_id):
+        self.order[node_id] = True
+
+    def access(self, node_id):
+        if node_id in self.order:
+            del self.order[node_id]
+            self.order[node_id] = True
+
+    def remove(self, node_id):
+        self.order.pop(node_id, None)
+
+    def victim(self, skip):
+        for node_id in self.order:
+            if not skip(node_id):
+                del self.order[node_id]
+                return node_id
+        return None
+
+
+class LFUPolicy(object):
+    """Evicts the node used least often, the least recent of those on ties"""
+    def __init__(self, evictor):
+        self.counts = OrderedDict()
+
+    def insert(self, node_id):
+        self.counts[node_id] = 1
+
+    def access(self, node_id):
+        if node_id in self.counts:
+            self.counts[node_id] = self.counts.pop(node_id) + 1
+
+    def remove(self, node_id):
+        self.counts.pop(node_id, None)
+
+    def victim(self, skip):
+        best = None
+        for node_id, count in self.counts.iteritems():
+            if not skip(node_id) and (best == None or count < self.counts[best]):
+                best = node_id
+        if best != None:
+            del self.counts[best]
+        return best
+
+
+class ARCPolicy(object):
+    """
+    Adaptive Replacement Cache, sized in bytes.  t1 holds nodes used once
+    recently, t2 nodes used more than once; b1 and b2 remember what was
+    recently evicted from each so a re-miss can shift the target size p
+    of t1 towards whichever list would have kept it.
+    """
+    def __init__(self, evictor):
+        self.evictor = evictor
+        self.p = 0
+        self.t1, self.t2 = OrderedDict(), OrderedDict()
+        self.b1, self.b2 = OrderedDict(), OrderedDict()
+
+    def __total__(self, l):
+        sizes = self.evictor.sizes
+        return sum(sizes.get(node_id, 0) for node_id in l)
+
+    def insert(self, node_id):
+        c = self.evictor.capacity
+        size = max(self.evictor.sizes.get(node_id, 0), 1)
+        if node_id in self.b1:
+            ratio = max(float(len(self.b2)) / len(self.b1), 1)
+            self.p = min(c, self.p + ratio * size)
+            del self.b1[node_id]
+            self.t2[node_id] = True
+        elif node_id in self.b2:
+            ratio = max(float(len(self.b1)) / len(self.b2), 1)
+            self.p = max(0, self.p - ratio * size)
+            del self.b2[node_id]
+            self.t2[node_id] = True
+        else:
+            self.t1[node_id] = True
+
+    def access(self, node_id):
+        if node_id in self.t1:
+            del self.t1[node_id]
+            self.t2[node_id] = True
+        elif node_id in self.t2:
+            del self.t2[node_id]
+            self.t2[node_id] = True
+
+    def remove(self, node_id):
+        for l in (self.t1, self.t2, self.b1, self.b2):
+            l.pop(node_id, None)
+
+    def __pop__(self, l, skip):
+        for node_id in l:
+            if not skip(node_id):
+                del l[node_id]
+                return node_id
+        return None
+
+    def victim(self, skip):
+        node_id = None
+        if self.t1 and (self.__total__(self.t1) > self.p or not self.t2):
+            node_id = self.__pop__(self.t1, skip)
+            ghosts = self.b1
+        if node_id == None:
+            node_id = self.__pop__(self.t2, skip)
+            ghosts = self.b2
+        if node_id == None:
+            node_id = self.__pop__(self.t1, skip)
+            ghosts = self.b1
+        if node_id != None:
+            ghosts[node_id] = True
+            # Ghost lists only need to remember about a cache's worth of nodes
+            while len(self.b1) + len(self.b2) > max(len(self.t1) + len(self.t2), 1):
+                (self.b1 if len(self.b1) > len(self.b2) else self.b2).popitem(last=False)
+        return node_id
+
+
+class Evictor(object):
+    """
+    Keeps the bytes cached under a cachebase within capacity by dropping
+    the cached data of whole nodes, picked by a pluggable policy.
+    """
+    policies = {'lru': LRUPolicy,
+                'lfu': LFUPolicy,
+                'arc': ARCPolicy}
+
+    def __init__(self, cachebase, capacity, policy = 'lru'):
+        self.cachebase = cachebase
+        self.capacity = capacity
+        self.lock = threading.RLock()
+        self.sizes = {}
+        self.used = 0
+        self.evictions = 0
+        self.evicted_bytes = 0
+        self.policy = self.policies[policy](self)
+        # Nodes that must stay cached, e.g. ones with unflushed writes
+        self.pinned = lambda node_id: False
+
+    def load(self, db):
+        """Picks up what is already cached, least recently opened first"""
+        for node_id, size in cached_sizes(db, self.cachebase):
+            self.resize(db, node_id, size)
+
+    def access(self, node_id):
+        with self.lock:
+            if node_id in self.sizes:
+                self.policy.access(node_id)
+
+    def resize(self, db, node_id, size):
+        with self.lock:
+            if node_id not in self.sizes:
+                if not size:
+                    return
+                self.sizes[node_id] = 0
+                self.policy.insert(node_id)
+            self.used += size - self.sizes[node_id]
+            self.sizes[node_id] = size
+
+            skip = lambda victim: victim == node_id or self.pinned(victim)
+            while self.used > self.capacity:
+                victim = self.policy.victim(skip)
+                if victim == None:
+                    if self.pinned(node_id):
+                        break
+                    victim = node_id
+                self.drop(db, victim)
+                if victim == node_id:
+                    break
+
+    def forget(self, node_id):
+        with self.lock:
+            self.used -= self.sizes.pop(node_id, 0)
+            self.policy.remove(node_id)
+
+    def drop(self, db, node_id):
+        """Throws away everything cached for node_id"""
+        shared = FileDataCache.shared.get(self.cachebase)
+        with self.lock:
+            if shared == None:
+                self.__drop__(db, node_id)
+                return
+            with shared.locked(node_id, True):
+                try:
+                    self.__drop__(db, node_id, shared)
+                finally:
+                    generation = shared.bump(node_id)
+                    blocks = FileDataCache.block_maps.get((self.cachebase, node_id))
+                    if blocks != None:
+                        blocks.generation = generation
+
+    def __drop__(self, db, node_id, shared = None):
+        ram = FileDataCache.ram_caches.get(self.cachebase)
+        if ram:
+            ram.forget(node_id)
+        whole_files_of(db, self.cachebase).pop(node_id, None)
+        store = FileDataCache.stores.get(self.cachebase)
+        registered = blocks = FileDataCache.block_maps.get((self.cachebase, node_id))
+        if blocks == None or store and shared:
+            if store:
+                # Its chunks are only known from its row, which another
+                # mount sharing the cache may have changed since
+                blocks = ChunkMap.load(db, node_id, chunk_size_of(db, self.cachebase), True, True)
+            else:
+                blocks = BlockMap()
+        with blocks.write_lock:
+            mappings = FileDataCache.mappings.get(self.cachebase)
+            if mappings and registered != None:
+                mappings.retire(registered)
+            for path, in db.execute('SELECT path FROM paths WHERE node_id = ?', (node_id,)).fetchall():
+                full_path = os.path.join(self.cachebase, "file_data") + path
+                try:
+                    f = os.open(full_path, os.O_WRONLY)
+                    try:
+                        os.ftruncate(f, 0)
+                    finally:
+                        os.close(f)
+                except OSError:
+                    pass
+
+            blocks.truncate(0)
+            if registered != None and registered is not blocks:
+                registered.truncate(0)
+            with db:
+                if store:
+                    blocks.release(db)
+                db.execute("DELETE FROM blocks WHERE node_id = ?", (node_id,))
+                db.execute("DELETE FROM chunks WHERE node_id = ?", (node_id,))
+                db.execute("UPDATE nodes SET whole = 0 WHERE id = ?", (node_id,))
+        if store:
+            store.sweep(db)
+
+        size = self.sizes.pop(node_id, 0)
+        self.used -= size
+        self.policy.remove(node_id)
+        self.evictions += 1
+        self.evicted_bytes += size
+
+
+class WriteBack(object):
+    """
+    Write-back journal.  Writes land in the cache and their ranges are
+    recorded in the dirty table; flusher threads coalesce them per node
+    and push them to the target once they have sat for delay seconds.
+    Journal rows are only removed after a range reached the target, so
+    anything left over after a crash is pushed again at the next mount.
+    A failing push is retried with the delay doubled each time, up to
+    max_delay; one whose data is gone from the cache is given up on, and
+    its size added to lost.
+    """
+    chunk_size = 1024 * 1024
+    max_delay = 300
+
+    def __init__(self, cachebase, target, delay = 1.0, threads = 2):
+        self.cachebase = cachebase
+        self.target = target
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.dirty = {}
+        self.paths = {}
+        self.queued = set()
+        self.node_locks = {}
+        self.pushed = 0
+        self.lost = 0
+        self.failures = {}
+        # (due, node_id) of the scheduled nodes, a heap so a node backed off
+        # after failing doesn't hold up the ones due before it
+        self.due = []
+        self.cond = threading.Condition(self.lock)
+        self.stopping = False
+        self.threads = []
+        for i in range(threads):
+            t = threading.Thread(target=self.__worker__, name="writeback-%d" % i)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def load(self, db):
+        """Queues whatever an earlier mount left unflushed"""
+        rows = {}
+        for node_id, offset, end in db.execute('SELECT node_id, offset, end FROM dirty').fetchall():
+            rows.setdefault(node_id, []).append((offset, end, False))
+        for node_id, node_rows in rows.items():
+            for path, in db.execute('SELECT path FROM paths WHERE node_id = ? LIMIT 1', (node_id,)):
+                with self.lock:
+                    self.dirty[node_id] = BlockMap(node_rows)
+                    self.paths[node_id] = path
+                self.__schedule__(node_id)
+
+    def is_dirty(self, node_id):
+        with self.lock:
+            return node_id in self.dirty
+
+    def dirty_bytes(self):
+        with self.lock:
+            return sum(dirty.size for dirty in self.dirty.values())
+
+    def extent(self, node_id):
+        """End of the furthest unflushed write to node_id, 0 if there is none"""
+        with self.lock:
+            dirty = self.dirty.get(node_id)
+            if dirty and len(dirty):
+                return dirty.ends[-1]
+            return 0
+
+    def record(self, db, node_id, path, offset, length, blocks = None):
+        """
+        Journals a write that so far only landed in the cache.  blocks is
+        the node's map if a BlockWriter defers its growth: the map is then
+        saved in the journal row's transaction, as a row left over after a
+        crash has to point at data the blocks table knows is cached.
+        """
+        with self.lock:
+            dirty = self.dirty.setdefault(node_id, BlockMap())
+            dirty.add(offset, offset + length, False)
+            self.paths[node_id] = path
+        if blocks == None:
+            with db:
+                db.execute('INSERT INTO dirty VALUES (?, ?, ?)', (node_id, offset, offset + length))
+        else:
+            with blocks.write_lock, span('db.commit'), db:
+                blocks.save(db, node_id)
+                db.execute('INSERT INTO dirty VALUES (?, ?, ?)', (node_id, offset, offset + length))
+        self.__schedule__(node_id)
+
+    def truncate(self, db, node_id, l):
+        """Forgets unflushed writes past l, waiting out any flush in progress"""
+        with self.__node_lock__(node_id):
+            with self.lock:
+                dirty = self.dirty.get(node_id)
+                if dirty == None:
+                    return
+                dirty.truncate(l)
+                if not len(dirty):
+                    del self.dirty[node_id]
+            self.__persist__(db, node_id)
+
+    def flush(self, db, node_id):
+        """Pushes every unflushed write of node_id to the target before returning"""
+        with self.__node_lock__(node_id):
+            with self.lock:
+                dirty = self.dirty.pop(node_id, None)
+                path = self.paths.get(node_id)
+            if dirty == None:
+                return
+            try:
+                st = self.__push__(db, node_id, path, dirty)
+            except:
+                with self.lock:
+                    for offset, end in zip(dirty.starts, dirty.ends):
+                        self.dirty.setdefault(node_id, BlockMap()).add(offset, end, False)
+                raise
+            self.__persist__(db, node_id)
+            with db:
+                db.execute('UPDATE nodes SET size = ?, mtime = ?, ctime = ?, sample = NULL WHERE id = ?',
+                           (st.st_size, st.st_mtime, st.st_ctime, node_id))
+
+    def stop(self, db):
+        """Stops the flushers and makes a last attempt at every node, the journal keeps what fails"""
+        with self.cond:
+            self.stopping = True
+            self.cond.notify_all()
+        for t in self.threads:
+            t.join()
+        with self.lock:
+            node_ids = self.dirty.keys()
+        for node_id in node_ids:
+            try:
+                self.flush(db, node_id)
+            except Exception, e:
+                print "writeback of node %s failed, left for the next mount: %s" % (node_id, e)
+
+    def __node_lock__(self, node_id):
+        with self.lock:
+            return self.node_locks.setdefault(node_id, threading.Lock())
+
+    def __schedule__(self, node_id, delay = None):
+        with self.cond:
+            if node_id in self.queued:
+                return
+            self.queued.add(node_id)
+            heapq.heappush(self.due, (time.time() + (self.delay if delay == None else delay), node_id))
+            self.cond.notify()
+
+    def __forget__(self, db, node_id):
+        """Drops the unflushed writes of node_id without pushing them"""
+        with self.__node_lock__(node_id):
+            with self.lock:
+                dirty = self.dirty.pop(node_id, None)
+                self.failures.pop(node_id, None)
+                if dirty != None:
+                    self.lost += dirty.size
+            self.__persist__(db, node_id)
+
+    def __persist__(self, db, node_id):
+        """Rewrites the journal rows of node_id from what is still dirty in memory"""
+        with self.lock:
+            dirty = self.dirty.get(node_id)
+            rows = []
+            if dirty != None:
+                rows = [(node_id, offset, end) for offset, end in zip(dirty.starts, dirty.ends)]
+        with db:
+            db.execute('DELETE FROM dirty WHERE node_id = ?', (node_id,))
+            db.executemany('INSERT INTO dirty VALUES (?, ?, ?)', rows)
+
+    def __push__(self, db, node_id, path, dirty):
+        cache = FileDataCache(db, self.cachebase, path, os.O_RDWR, node_id)
+        try:
+            target = os.open(os.path.join(self.target, path.lstrip('/')), os.O_WRONLY)
+            try:
+                for offset, end in zip(dirty.starts, dirty.ends):
+                    while offset < end:
+                        buf = cache.read(min(self.chunk_size, end - offset), offset)
+                        if not buf:
+                            break
+                        pwrite(target, buf, offset)
+                        offset += len(buf)
+                        with self.lock:
+                            self.pushed += len(buf)
+                return os.fstat(target)
+            finally:
+                os.close(target)
+        finally:
+            cache.close()
+
+    def __worker__(self):
+        db = open_db(self.cachebase)
+        while True:
+            with self.cond:
+                while not self.stopping and not (self.due and self.due[0][0] <= time.time()):
+                    self.cond.wait(self.due[0][0] - time.time() if self.due else None)
+                if self.stopping:
+                    break
+                due, node_id = heapq.heappop(self.due)
+                self.queued.discard(node_id)
+            try:
+                self.flush(db, node_id)
+            except CacheMiss:
+                # Retrying can't bring back what the cache no longer has
+                print "writeback of node %s abandoned, its data is no longer cached" % node_id
+                self.__forget__(db, node_id)
+                continue
+            except Exception, e:
+                with self.lock:
+                    failures = self.failures[node_id] = self.failures.get(node_id, 0) + 1
+                delay = min(self.delay * 2 ** failures, self.max_delay)
+                print "writeback of node %s failed %d time(s), retrying in %ds: %s" % (
+                    node_id, failures, delay, e)
+                self.__schedule__(node_id, delay)
+                continue
+            with self.lock:
+                self.failures.pop(node_id, None)
+        db.close()
+
+
+class TargetMonitor(object):
+    """
+    Keeps track of whether the target can be reached.  It is probed every
+    interval seconds, and right away whenever an operation on it fails
+    the way an unreachable target does.  A probe runs in a thread of its
+    own and is given timeout seconds, so a hung network file system is
+    noticed rather than waited on; while one hangs no other is started.
+    """
+    # What a target that has gone away fails with, as opposed to errors about the request
+    unreachable = set([errno.EIO, errno.ENOTCONN, errno.ETIMEDOUT, errno.ESTALE,
+                       errno.EHOSTDOWN, errno.EHOSTUNREACH, errno.ENETDOWN,
+                       errno.ENETUNREACH, errno.ECONNABORTED, errno.ECONNRESET])
+
+    def __init__(self, target, interval = 5.0, timeout = 2.0):
+        self.target = target
+        self.interval = interval
+        self.timeout = timeout
+        self.online = True
+        self.transitions = 0
+        self.cond = threading.Condition()
+        self.prober = None
+        self.stopping = False
+        self.thread = threading.Thread(target=self.__worker__, name="target-monitor")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def check(self):
+        """Goes to the target, raising if it doesn't answer"""
+        os.stat(self.target)
+        os.statvfs(self.target)
+
+    def probe(self):
+        """Checks the target now, waiting at most timeout seconds.  Returns whether it is online"""
+        with self.cond:
+            prober = self.prober
+            if prober == None or not prober.is_alive():
+                prober = self.prober = threading.Thread(target=self.__check__, name="target-probe")
+                prober.daemon = True
+                prober.ok = False
+                prober.start()
+        prober.join(self.timeout)
+        self.__set__(not prober.is_alive() and prober.ok)
+        return self.online
+
+    def failed(self, e):
+        """
+        Tells the monitor an operation on the target raised e.  Returns
+        True (and goes offline) if e means the target is unreachable.
+        """
+        if getattr(e, 'errno', None) not in self.unreachable:
+            return False
+        self.__set__(False)
+        with self.cond:
+            self.cond.notify()
+        return True
+
+    def stop(self):
+        with self.cond:
+            self.stopping = True
+            self.cond.notify()
+        self.thread.join()
+
+    def __set__(self, online):
+        with self.cond:
+            if online != self.online:
+                print ">> target %s is %s" % (self.target, online and 'back online' or 'unreachable, going offline')
+                self.online = online
+                self.transitions += 1
+
+    def __check__(self):
+        try:
+            self.check()
+            threading.current_thread().ok = True
+        except (OSError, IOError):
+            pass
+
+    def __worker__(self):
+        while True:
+            with self.cond:
+                if not self.stopping:
+                    self.cond.wait(self.interval)
+                if self.stopping:
+                    break
+            self.probe()
+
+
+class Stats(object):
+    """
+    Cumulative counters since mount, named "group.counter".  They are
+    served, together with the state of the other components, as JSON
+    from the read-only STATS_PATH under the mount point.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.started = time.time()
+
+    def add(self, name, n = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def snapshot(self):
+        """The counters nested by group"""
+        ret = {}
+        with self.lock:
+            for name, value in self.counters.items():
+                group, counter = name.split('.', 1)
+                ret.setdefault(group, {})[counter] = value
+        return ret
+
+
+class MetadataCache(object):
+    """
+    Stat results ('attr'), directory listings ('dir') and symlink targets
+    ('link') from the target, kept in memory and persisted in the
+    metadata table so a remount starts warm.  A missing path is cached as
+    an attr of None for negative_ttl seconds, everything else for ttl.
+    Every row in the table is also in memory, so invalidating something
+    that isn't cached never touches the database.  Expired entries are
+    kept, as the last known state of the target, to answer from while it
+    can't be reached.
+    """
+    def __init__(self, ttl, negative_ttl):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def encode(kind, value):
+        if kind == 'attr' and value != None:
+            value = [value.st_mode, value.st_ino, value.st_dev, value.st_nlink,
+                     value.st_uid, value.st_gid, value.st_size,
+                     value.st_atime, value.st_mtime, value.st_ctime]
+        # Names are bytes, latin-1 gets any of them through JSON unchanged
+        return json.dumps(value, encoding='latin-1')
+
+    @staticmethod
+    def decode(kind, text):
+        value = json.loads(text)
+        if kind == 'attr' and value != None:
+            value = os.stat_result(value)
+        elif kind == 'dir':
+            value = [name.encode('latin-1') for name in value]
+        elif kind == 'link':
+            value = value.encode('latin-1')
+        return value
+
+    def load(self, db):
+        now = time.time()
+        with db:
+            db.execute("DELETE FROM metadata WHERE expires <= ? AND value = 'null'", (now,))
+        with self.lock:
+            for kind, path, value, expires in db.execute('SELECT kind, path, value, expires FROM metadata'):
+                self.entries[(kind, path)] = (self.decode(kind, value), expires)
+
+    def get(self, kind, path, stale = False):
+        """
+        Returns (True, value) while an unexpired entry exists, or any
+        entry at all when stale, else (False, None)
+        """
+        with self.lock:
+            entry = self.entries.get((kind, path))
+            if entry != None and (stale or entry[1] > time.time()):
+                self.hits += 1
+                return True, entry[0]
+            self.misses += 1
+            return False, None
+
+    def put(self, db, kind, path, value):
+        expires = time.time() + (self.ttl if value != None else self.negative_ttl)
+        with self.lock:
+            self.entries[(kind, path)] = (value, expires)
+        with db:
+            db.execute('INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?)',
+                       (kind, path, self.encode(kind, value), expires))
+
+    def invalidate(self, db, path, tree = False):
+        """
+        Forgets path and its parent's listing, and with tree everything
+        below path as well.
+        """
+        parent = os.path.dirname(path)
+        prefix = path.rstrip('/') + '/'
+        with self.lock:
+            keys = [(kind, path) for kind in ('attr', 'dir', 'link')] + [('dir', parent)]
+            if tree:
+                keys += [key for key in self.entries if key[1].startswith(prefix)]
+            keys = [key for key in keys if self.entries.pop(key, None) != None]
+        if keys:
+            with db:
+                db.executemany('DELETE FROM metadata WHERE kind = ? AND path = ?', keys)
+
+
+class BlockWriter(object):
+    """
+    Persists block map growth in the background.  Nodes whose map grew
+    are remembered and their rows rewritten from the in-memory map, all
+    in one transaction, every interval seconds or as soon as max_pending
+    changes have piled up.  Only growth is deferred; anything shrinking a
+    map is written straight away under the map's write_lock, so after a
+    crash the blocks table can only be missing ranges (which are simply
+    fetched again), never claim ones that aren't in the cache file.
+    A chunk of a compressed cache rewritten in place into a different
+    length or form is written straight away too, see __write_chunk__().
+    Writes not yet on the target can't be fetched again, which is why
+    WriteBack.record() saves the map along with their journal rows.
+    """
+    def __init__(self, cachebase, interval = 1.0, max_pending = 1000):
+        self.cachebase = cachebase
+        self.interval = interval
+        self.max_pending = max_pending
+        self.cond = threading.Condition()
+        self.dirty = {}
+        self.pending = 0
+        self.stopping = False
+        self.commits = 0
+        self.thread = threading.Thread(target=self.__worker__, name="block-writer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def mark(self, node_id, blocks):
+        with self.cond:
+            self.dirty[node_id] = blocks
+            self.pending += 1
+            if self.pending >= self.max_pending:
+                self.cond.notify()
+
+    def discard(self, node_id):
+        with self.cond:
+            self.dirty.pop(node_id, None)
+
+    def flush(self, db, node_ids = None):
+        """Writes out the given nodes (or every pending one) before returning"""
+        with self.cond:
+            if node_ids == None:
+                batch, self.dirty, self.pending = self.dirty, {}, 0
+            else:
+                batch = dict((node_id, self.dirty.pop(node_id)) for node_id in node_ids
+                             if node_id in self.dirty)
+        self.__write__(db, batch)
+
+    def stop(self, db):
+        with self.cond:
+            self.stopping = True
+            self.cond.notify()
+        self.thread.join()
+        self.flush(db)
+
+    def __write__(self, db, batch):
+        if not batch:
+            return
+        # Everyone else takes a map's write_lock before touching the
+        # database, so take them all (in a fixed order) before starting
+        # the transaction.  A shrink can't then land between snapshotting
+        # a map and writing it out.
+        nodes = sorted(batch.items())
+        for node_id, blocks in nodes:
+            blocks.write_lock.acquire()
+        try:
+            with span('db.commit'), db:
+                for node_id, blocks in nodes:
+                    blocks.save(db, node_id)
+        finally:
+            for node_id, blocks in nodes:
+                blocks.write_lock.release()
+        self.commits += 1
+        store = FileDataCache.stores.get(self.cachebase)
+        if store:
+            store.sweep(db)
+
+    def __worker__(self):
+        db = open_db(self.cachebase)
+        while True:
+            with self.cond:
+                if not self.stopping and self.pending < self.max_pending:
+                    self.cond.wait(self.interval)
+                if self.stopping:
+                    break
+            try:
+                self.flush(db)
+            except Exception, e:
+                print "Error persisting blocks: %s" % e
+        db.close()
+
+
+class RamCache(object):
+    """
+    Bounded copy in memory of cache file data, in aligned blocks of
+    block_size keyed by (node_id, block index), so hot data is served
+    without a trip to the cache device.  Blocks not used lately are
+    dropped first (CLOCK, which keeps a hit down to a dict lookup).  A
+    block is only held whole (or up to the end of its node).  Writes patch the blocks
+    they touch; every change to a node bumps its generation, and a block
+    read from the cache device before the change is not put back.
+    """
+    block_size = 64 * 1024
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.blocks = {}
+        self.referenced = set()
+        self.clock = deque()
+        self.nodes = {}
+        self.generations = {}
+        self.used = 0
+        self.hits = 0
+
+    def get(self, node_id, index):
+        key = (node_id, index)
+        with self.lock:
+            block = self.blocks.get(key)
+            if block != None:
+                self.referenced.add(key)
+                self.hits += len(block)
+            return block
+
+    def generation(self, node_id):
+        with self.lock:
+            return self.generations.get(node_id, 0)
+
+    def put(self, node_id, index, block, generation):
+        """Holds block unless node_id changed since generation was read"""
+        with self.lock:
+            if self.generations.get(node_id, 0) == generation:
+                self.__store__(node_id, index, block)
+
+    def write(self, node_id, offset, data):
+        """Applies a write of data at offset to the blocks it touches"""
+        end = offset + len(data)
+        with self.lock:
+            self.generations[node_id] = self.generations.get(node_id, 0) + 1
+            for index in range(offset / self.block_size, (end - 1) / self.block_size + 1):
+                start = index * self.block_size
+                piece = data[max(offset, start) - offset:min(end, start + self.block_size) - offset]
+                at = max(offset, start) - start
+                block = self.blocks.get((node_id, index))
+                if block != None and at <= len(block):
+                    self.__store__(node_id, index, block[:at] + piece + block[at + len(piece):])
+                elif block != None:
+                    # Leaves a hole, just forget it
+                    self.__discard__(node_id, index)
+                elif len(piece) == self.block_size:
+                    self.__store__(node_id, index, piece)
+
+    def truncate(self, node_id, l):
+        with self.lock:
+            self.generations[node_id] = self.generations.get(node_id, 0) + 1
+            for index in list(self.nodes.get(node_id, ())):
+                start = index * self.block_size
+                if start >= l:
+                    self.__discard__(node_id, index)
+                elif start + len(self.blocks[(node_id, index)]) > l:
+                    self.__store__(node_id, index, self.blocks[(node_id, index)][:l - start])
+
+    def forget(self, node_id):
+        self.truncate(node_id, 0)
+
+    def __store__(self, node_id, index, block):
+        key = (node_id, index)
+        if len(block) > self.capacity:
+            self.__discard__(node_id, index)
+            return
+        old = self.blocks.get(key)
+        if old != None:
+            self.used -= len(old)
+        else:
+            self.clock.append(key)
+            self.nodes.setdefault(node_id, set()).add(index)
+        self.blocks[key] = block
+        self.used += len(block)
+        if len(self.clock) > 2 * len(self.blocks) + 64:
+            # Drop what was discarded behind the hand's back
+            seen = set()
+            self.clock = deque(k for k in self.clock
+                               if k in self.blocks and not (k in seen or seen.add(k)))
+        while self.used > self.capacity:
+            key = self.clock.popleft()
+            if key not in self.blocks:
+                continue
+            if key in self.referenced:
+                # Used since the hand last passed, give it another round
+                self.referenced.discard(key)
+                self.clock.append(key)
+                continue
+            self.__discard__(*key)
+
+    def __discard__(self, node_id, index):
+        old = self.blocks.pop((node_id, index), None)
+        if old != None:
+            self.used -= len(old)
+            self.referenced.discard((node_id, index))
+            self.__unindex__(node_id, index)
+
+    def __unindex__(self, node_id, index):
+        indexes = self.nodes[node_id]
+        indexes.discard(index)
+        if not indexes:
+            del self.nodes[node_id]
+
+
+class Mappings(object):
+    """
+    Read-only memory mappings of cache files at least min_size long, so
+    their cache hits are sliced out of memory instead of read with a
+    system call.  A node's mapping hangs off its map, as mapped, and
+    covers its cache file as far as it reached when mapped; a hit past
+    that maps it again.  A slice reaching past the end of the file
+    would be a SIGBUS rather than a short read, so anything cutting a
+    cache file short retires its mapping first, holding the map's
+    write_lock (which mapping takes too), and slices are taken under
+    the map's lock.  Each mapping holds a file descriptor, so only the
+    capacity most recently mapped nodes keep theirs.
+    """
+    def __init__(self, min_size, capacity = 256):
+        self.min_size = min_size
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.maps = OrderedDict()
+        self.mapped = 0
+
+    def read(self, blocks, fd, size, offset):
+        """[offset, offset+size) of fd, the cache file of blocks' node, None if it can't be mapped that far"""
+        end = offset + size
+        for attempt in (0, 1):
+            with blocks.lock:
+                if blocks.mapped != None and end <= len(blocks.mapped):
+                    return blocks.mapped[offset:end]
+            if attempt or not self.__map__(blocks, fd, end):
+                return None
+
+    def __map__(self, blocks, fd, end):
+        with blocks.write_lock:
+            size = os.fstat(fd).st_size
+            if size < max(end, self.min_size, 1):
+                return False
+            mapped = mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+            with blocks.lock:
+                blocks.mapped = mapped
+        retired = []
+        with self.lock:
+            self.mapped += 1
+            self.maps.pop(blocks, None)
+            self.maps[blocks] = True
+            while len(self.maps) > self.capacity:
+                retired.append(self.maps.popitem(False)[0])
+        for old in retired:
+            with old.lock:
+                old.mapped = None
+        return True
+
+    def retire(self, blocks):
+        """Drops the mapping of blocks' node, its cache file is about to be cut short"""
+        with self.lock:
+            self.maps.pop(blocks, None)
+        with blocks.lock:
+            # Unmapped once the last slice taken from it is done
+            blocks.mapped = None
+
+    def count(self):
+        with self.lock:
+            return len(self.maps)
+
+
+class InFlight(object):
+    """
+    Registry of the ranges being fetched from the target, per node, so a
+    range is fetched once however many readers miss on it at the same
+    time.  Whoever claims a range fetches it; anyone after an
+    overlapping one gets the event that is set when that fetch is over,
+    whether it succeeded or not.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.fetches = {}
+
+    def claim(self, key, offset, end):
+        """Returns (True, event) if [offset, end) is now ours to fetch, else (False, event) to wait on"""
+        with self.lock:
+            for o, e, event in self.fetches.get(key, ()):
+                if o < end and offset < e:
+                    return False, event
+            event = threading.Event()
+            self.fetches.setdefault(key, []).append((offset, end, event))
+            return True, event
+
+    def release(self, key, offset, end, event):
+        with self.lock:
+            fetches = self.fetches[key]
+            fetches.remove((offset, end, event))
+            if not fetches:
+                del self.fetches[key]
+        event.set()
+
+
+class HandlePool(object):
+    """
+    FileDataCaches shared by every open of a node through the same path,
+    keyed by (cachebase, path, node_id) and counted, so opening a file
+    again (or once more while it is open) reuses its cache file
+    descriptor and state instead of setting them up from scratch.  Once
+    nobody has a handle open it stays around, ready for the next open,
+    until more than capacity idle ones pile up; the least recently
+    released are closed first.
+    """
+    def __init__(self, capacity = 256):
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        # key -> [cache, opens]
+        self.handles = {}
+        self.idle = OrderedDict()
+        self.reused = 0
+
+    def acquire(self, cachebase, path, node_id, flags = os.O_RDWR):
+        key = (cachebase, path, node_id)
+        with self.lock:
+            entry = self.handles.get(key)
+            if entry != None:
+                entry[1] += 1
+                self.idle.pop(key, None)
+                self.reused += 1
+        if entry == None:
+            cache = FileDataCache(None, cachebase, path, flags & ~os.O_TRUNC, node_id)
+            with self.lock:
+                entry = self.handles.get(key)
+                if entry == None:
+                    entry = self.handles[key] = [cache, 0]
+                else:
+                    # Lost a race to set it up
+                    self.idle.pop(key, None)
+                entry[1] += 1
+            if entry[0] is not cache:
+                cache.close()
+        if flags & os.O_TRUNC:
+            entry[0].truncate(0)
+        return entry[0]
+
+    def release(self, cache):
+        closing = []
+        key = (cache.cachebase, cache.path, cache.node_id)
+        with self.lock:
+            entry = self.handles.get(key)
+            if entry == None or entry[0] is not cache:
+                # Never pooled, or forgotten since
+                closing.append(cache)
+            else:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    self.idle[key] = True
+                    while len(self.idle) > self.capacity:
+                        closing.append(self.handles.pop(self.idle.popitem(False)[0])[0])
+        for cache in closing:
+            cache.close()
+
+    def forget(self, cachebase, path, tree = False):
+        """
+        Stops handing out handles of path (and everything under it with
+        tree), e.g. once it is unlinked or renamed.  Idle ones are closed
+        now, ones still open once they are released.
+        """
+        closing = []
+        with self.lock:
+            for key in self.handles.keys():
+                if key[0] == cachebase and (key[1] == path or tree and key[1].startswith(path.rstrip('/') + '/')):
+                    cache, opens = self.handles.pop(key)
+                    if self.idle.pop(key, None):
+                        closing.append(cache)
+        for cache in closing:
+            cache.close()
+
+    def clear(self):
+        """Closes every idle handle"""
+        with self.lock:
+            closing = [self.handles.pop(key)[0] for key in self.idle]
+            self.idle.clear()
+        for cache in closing:
+            cache.close()
+
+    def counts(self):
+        """(handles open, idle handles)"""
+        with self.lock:
+            return len(self.handles) - len(self.idle), len(self.idle)
+
+
+class FileDataCache(object):
+    # Block maps are shared by every open of a node, keyed by (cachebase, node_id),
+    # and loaded again from the database once the last of them is closed
+    block_maps = {}
+    block_maps_lock = threading.Lock()
+    # Capacity limits, keyed by cachebase
+    evictors = {}
+    # Background persistence of block maps, keyed by cachebase
+    block_writers = {}
+    # Chunk size of caches using ChunkMaps (0 for BlockMaps), keyed by cachebase
+    chunk_sizes = {}
+    # Codec names of caches storing chunks compressed ('' if not), keyed by cachebase
+    codecs = {}
+    # ChunkStores of deduplicating caches (None if not), keyed by cachebase
+    stores = {}
+    # Memory tiers in front of the cache files, keyed by cachebase
+    ram_caches = {}
+    # Small files cached whole, see whole_files_of(), keyed by cachebase
+    whole_files = {}
+    whole_files_lock = threading.Lock()
+    # SharedCaches of caches used by several mounts at once (None if not), keyed by cachebase
+    shared = {}
+    # Memory mappings serving cache hits, keyed by cachebase
+    mappings = {}
+    # Fetches from targets under way, keyed by (cachebase, node_id)
+    in_flight = InFlight()
+    # Handles shared by the opens of a file through the mount
+    handles = HandlePool()
+
     def cache_file(self, path):
         return os.path.join(self.cachebase, "file_data") + path
 
@@ -36,13 +2287,9 @@ class FileDataCache:
         self.cachebase = cachebase
         self.full_path = self.cache_file(path)
 
-        try:
-            os.makedirs(os.path.dirname(self.full_path))
-        except OSError:
-            pass
-
         self.path = path
-        self.db = db
+        # Without an explicit connection each thread uses its own
+        self.own_db = db
 
         self.cache = None
 
@@ -50,15 +2297,24 @@ class FileDataCache:
                                    os.O_CREAT &
                                    os.O_EXCL )
         self.node_id = node_id
+        self.codec = None
+        self.store = None
+        if chunk_size_of(self.db, self.cachebase):
+            if codec_of(self.db, self.cachebase):
+                self.codec = CODECS[codec_of(self.db, self.cachebase)]
+            self.store = store_of(self.db, self.cachebase)
+        # Chunks are kept whole, each on its own, rather than in place
+        self.packed = self.codec != None or self.store != None
+        self.shared = shared_of(self.db, self.cachebase)
+        # Generation of the node the cache file was last checked at, see __sync__()
+        self.synced = None
 
         self.open()
 
-        if flags & os.O_TRUNC:
-            self.truncate(0)
-
-        with self.db:
+        with span('db.lookup'), self.db:
             if self.node_id != None:
-                self.db.execute('INSERT OR REPLACE INTO nodes (id, last_use) values (?,?)', (self.node_id,time.time()))
+                self.db.execute('INSERT OR IGNORE INTO nodes (id) values (?)', (self.node_id,))
+                self.db.execute('UPDATE nodes SET last_use = ? WHERE id = ?', (time.time(), self.node_id))
                 self.db.execute('INSERT OR REPLACE INTO paths (node_id,path) values (?,?)', (self.node_id,self.path))
             else:
                 for nid, in self.db.execute('SELECT node_id FROM paths WHERE path = ?', (self.path,)):
@@ -68,32 +2324,249 @@ class FileDataCache:
                     print "Unable to find path in db and no node_id given, unable to open cache"
                     raise CacheMiss
 
-            for other_path, in self.db.execute('SELECT path FROM paths WHERE node_id = ? AND path != ?', (self.node_id, self.path)):
-                try:
-                    if not os.path.exists(self.full_path) and os.path.exists(self.cache_file(other_path)):
-                        os.link(self.cache_file(other_path), self.full_path)
-                except Exception, e:
-                    print "link error: %s" % e
-                    raise e
+            # Only a cache file that was just created could be missing data another path has
+            if self.created:
+                for other_path, in self.db.execute('SELECT path FROM paths WHERE node_id = ? AND path != ?', (self.node_id, self.path)):
+                    try:
+                        if not os.path.exists(self.full_path) and os.path.exists(self.cache_file(other_path)):
+                            os.link(self.cache_file(other_path), self.full_path)
+                    except Exception, e:
+                        print "link error: %s" % e
+                        raise e
+
+        self.blocks = self.__block_map__()
+        self.evictor = FileDataCache.evictors.get(self.cachebase)
+        self.ram = FileDataCache.ram_caches.get(self.cachebase)
+        # Packed chunks have to be decompressed anyway
+        self.mappings = None if self.packed else FileDataCache.mappings.get(self.cachebase)
 
         self.misses = 0
         self.hits = 0
+        # Gaps another fetch was already filling
+        self.waits = 0
+
+        if flags & os.O_TRUNC:
+            self.truncate(0)
+
+    @property
+    def db(self):
+        if self.own_db != None:
+            return self.own_db
+        return thread_db(self.cachebase)
+
+    def __block_map__(self):
+        key = (self.cachebase, self.node_id)
+        with FileDataCache.block_maps_lock:
+            blocks = FileDataCache.block_maps.get(key)
+            if blocks == None:
+                # Read first, a change committed while loading then shows up as a newer one
+                generation = self.shared.generation(self.node_id) if self.shared else None
+                blocks = self.__load_map__()
+                blocks.generation = generation
+                FileDataCache.block_maps[key] = blocks
+            blocks.users += 1
+        return blocks
+
+    def __release_map__(self):
+        """
+        Lets go of the node's map, dropping it once no open of the node
+        holds it any more.  Growth the BlockWriter hasn't saved yet is
+        saved first, as the map is loaded from the database next time.
+        """
+        key = (self.cachebase, self.node_id)
+        blocks, self.blocks = self.blocks, None
+        with FileDataCache.block_maps_lock:
+            last = blocks.users == 1
+        if last:
+            writer = FileDataCache.block_writers.get(self.cachebase)
+            if writer:
+                writer.flush(self.db, [self.node_id])
+        with FileDataCache.block_maps_lock:
+            blocks.users -= 1
+            # Someone may have picked it up again while it was being saved
+            if blocks.users or FileDataCache.block_maps.get(key) is not blocks:
+                return
+            del FileDataCache.block_maps[key]
+        if self.mappings:
+            self.mappings.retire(blocks)
+
+    def __load_map__(self):
+        chunk_size = chunk_size_of(self.db, self.cachebase)
+        if chunk_size:
+            return ChunkMap.load(self.db, self.node_id, chunk_size, self.packed, self.store != None)
+        return BlockMap.load(self.db, self.node_id)
+
+    def __sync__(self):
+        """
+        Brings the map up to date with what other mounts sharing the
+        cache did to the node since it was loaded, if they did anything.
+        Reads of the cache file do this holding the node's lock, so what
+        the map says is there stays there until they're done.  Returns
+        True if the map changed.
+
+        The map is shared by every handle of the node, the cache file
+        descriptor isn't, so each handle notes the generation it last
+        looked at its own in synced.  The generations are only recorded
+        once everything is in place, as other threads go ahead on them
+        without taking any lock.
+        """
+        generation = self.shared.generation(self.node_id)
+        if generation == self.synced:
+            return False
+        with self.blocks.write_lock:
+            if generation == self.synced:
+                return False
+            changed = generation != self.blocks.generation
+            if changed:
+                with span('db.lookup'):
+                    fresh = self.__load_map__()
+                self.blocks.replace(fresh)
+                self.shared.reloads += 1
+                if self.mappings:
+                    # The cache file may be shorter now
+                    self.mappings.retire(self.blocks)
+                if self.ram:
+                    self.ram.forget(self.node_id)
+            if os.fstat(self.cache).st_nlink == 0:
+                # Unlinked by another mount, start a new cache file.  It
+                # takes over the descriptor, so a read going on meanwhile
+                # gets one file or the other, never a closed descriptor.
+                fd = os.open(self.full_path, self.flags | os.O_CREAT)
+                try:
+                    os.dup2(fd, self.cache)
+                finally:
+                    os.close(fd)
+            self.synced = generation
+            if changed:
+                self.blocks.generation = generation
+        return changed
+
+    @contextmanager
+    def __changing__(self):
+        """
+        Held across changing the node's cached data and persisting it:
+        the map's write_lock and, if the cache is shared, the node's lock
+        against the other mounts, with the map brought up to date first
+        and the change announced to them once it is committed.
+        """
+        if self.shared == None:
+            with self.blocks.write_lock:
+                yield
+            return
+        with self.shared.locked(self.node_id, True), self.blocks.write_lock:
+            self.__sync__()
+            try:
+                yield
+            finally:
+                self.blocks.generation = self.synced = self.shared.bump(self.node_id)
 
     def known_offsets(self):
-        ret = {}
-        c = self.db.cursor()
-        c.execute('select offset, end from blocks where node_id = ?', (self.node_id,))
-        for offset, end in c:
-            ret[offset] = end - offset
+        return self.blocks.known()
 
-        return ret
+    def validate(self, st, sample = None):
+        """
+        Checks what the target looks like now (st, and optionally a
+        content sample) against the fingerprint taken when the cached
+        data was last known good.  If it changed behind our back
+        everything cached for the node is dropped at once.  Returns True
+        when the cached data can be trusted as is.
+        """
+        with span('db.lookup'):
+            row = self.db.execute('SELECT size, mtime, ctime, sample FROM nodes WHERE id = ?',
+                                  (self.node_id,)).fetchone()
+        if row != None and row[0] != None:
+            size, mtime, ctime, known_sample = row
+            if ((size, mtime, ctime) == (st.st_size, st.st_mtime, st.st_ctime) and
+                (known_sample == None or sample == None or known_sample == sample)):
+                if known_sample == None and sample != None:
+                    self.remember(st, sample)
+                return True
+
+        if len(self.blocks):
+            debug(">> %s changed on the target, dropping its cached data" % self.path)
+            self.truncate(0)
+        self.remember(st, sample)
+        return False
+
+    def complete(self):
+        """
+        Returns the size of the node if all of its data is cached, going by
+        its fingerprint, else None
+        """
+        row = self.db.execute('SELECT size FROM nodes WHERE id = ?', (self.node_id,)).fetchone()
+        if row == None or row[0] == None:
+            return None
+        size = row[0]
+        addr, length, last = self.blocks.find(0)
+        if size and (addr != 0 or length < size):
+            return None
+        return size
+
+    def remember(self, st, sample = None):
+        """Records st (and a content sample) as the fingerprint of the node's cached data"""
+        with self.db:
+            self.db.execute('UPDATE nodes SET size = ?, mtime = ?, ctime = ?, sample = ? WHERE id = ?',
+                            (st.st_size, st.st_mtime, st.st_ctime, sample, self.node_id))
+
+    @staticmethod
+    def sample(f, size, length = 4096):
+        """Hashes a few small pieces of the open file f, size bytes long"""
+        digest = hashlib.md5()
+        for offset in sorted(set([0, max(0, size / 2 - length / 2), max(0, size - length)])):
+            digest.update(pread(f, length, offset))
+        return digest.hexdigest()
 
     def open(self):
+        self.created = False
         if self.cache == None:
             try:
                 self.cache = os.open(self.full_path, self.flags)
             except Exception, e:
+                try:
+                    os.makedirs(os.path.dirname(self.full_path))
+                except OSError:
+                    pass
                 self.cache = os.open(self.full_path, self.flags | os.O_CREAT )
+                self.created = True
+
+    @staticmethod
+    def read_whole(cachebase, path, st):
+        """
+        The contents of the small file at path, if it is cached whole and
+        st says it hasn't changed since, else None.  Once the cache has
+        been looked at this takes no database queries.
+        """
+        whole = whole_files_of(thread_db(cachebase), cachebase)
+        if whole.get(st.st_ino) != (path, st.st_size, st.st_mtime, st.st_ctime):
+            return None
+        try:
+            f = os.open(os.path.join(cachebase, "file_data") + path, os.O_RDONLY)
+        except OSError:
+            return None
+        try:
+            with span('cache.read'):
+                data = pread(f, st.st_size + 1, 0)
+        finally:
+            os.close(f)
+        if len(data) != st.st_size:
+            return None
+        return data
+
+    def mark_whole(self, st):
+        """Records that all of the node, as described by st, is in the cache file"""
+        if self.packed or self.shared != None:
+            # The cache file doesn't hold the data as is, or see whole_files_of()
+            return
+        whole = whole_files_of(self.db, self.cachebase)
+        with self.db:
+            self.db.execute('UPDATE nodes SET whole = 1 WHERE id = ?', (self.node_id,))
+        whole[self.node_id] = (self.path, st.st_size, st.st_mtime, st.st_ctime)
+
+    def __forget_whole__(self):
+        """Drops the whole flag of the node, its cached data is about to change"""
+        if whole_files_of(self.db, self.cachebase).pop(self.node_id, None) != None:
+            with self.db:
+                self.db.execute('UPDATE nodes SET whole = 0 WHERE id = ?', (self.node_id,))
 
 
     def report(self):
@@ -106,50 +2579,37 @@ class FileDataCache:
             self.path, self.hits, self.misses, rate)
 
     def __del__(self):
-        self.close()
+        # Only the file, taking locks here could deadlock whichever thread collects it
+        if self.cache:
+            os.close(self.cache)
+            self.cache = None
 
     def close(self):
         if self.cache:
             os.close(self.cache)
             self.cache = None
+        if self.blocks != None:
+            self.__release_map__()
 
 
-    def __conditions__(self, offset, length = None):
-        if length != None:
-            return ["node_id = ? AND (offset = ? OR "
-                    "(offset > ? AND offset <= ?) OR (offset < ? AND end >= ?))",
-                    (self.node_id,
-                     offset,
-                     offset, offset + length,
-                     offset, offset)]
-        else:
-            return ["node_id = ? AND offset <= ? AND end > ?",
-                    (self.node_id,            offset,     offset)]
-
     def __overlapping_block__(self, offset):
-        conditions = self.__conditions__(offset)
-                      
-        query = "select offset, end, last_block from blocks where %s" % conditions[0]
-        result = self.db.execute(query, conditions[1])
-        for db_offset, db_end, last_block in result:
-            return (db_offset, db_end - db_offset, last_block)
-        return (None, None, False)
-
-    def __add_block___(self, offset, length, last_bytes):
-        end = offset + length
-
-        conditions = self.__conditions__(offset, length)
-        query = "select min(offset), max(end) from blocks where %s" % conditions[0]
-        with self.db:
-            for db_offset, db_end in self.db.execute(query, conditions[1]):
-                if db_offset == None or db_end == None:
-                    continue
-                offset = min(offset, db_offset)
-                end = max(end, db_end)
+        return self.blocks.find(offset)
 
-            self.db.execute("delete from blocks where %s" % conditions[0], conditions[1])
-            self.db.execute('insert into blocks values (?, ?, ?, ?)', (self.node_id, offset, end, last_bytes))
-        return
+    def __add_block___(self, offset, length, last_bytes, now = False):
+        """Records [offset, offset+length) as cached, in the database right away if now"""
+        writer = FileDataCache.block_writers.get(self.cachebase)
+        # Keeps the rows in step with the map, lookups only need blocks.lock
+        with span('block.merge'), self.blocks.write_lock:
+            merged = self.blocks.add(offset, offset + length, last_bytes)
+            if merged == None and not self.packed:
+                return
+
+            if writer and not now:
+                writer.mark(self.node_id, self.blocks)
+            else:
+                db = self.db
+                with span('db.commit'), db:
+                    self.blocks.save_add(db, self.node_id, merged)
 
     def read(self, size, offset):
         #print ">>> READ (size: %s, offset: %s" % (size, offset)
@@ -159,43 +2619,352 @@ class FileDataCache:
             raise CacheMiss
     
 #        self.open()
-        os.lseek(self.cache, offset, os.SEEK_SET)
-        buf = os.read(self.cache, size)
+        buf = self.__read_data__(size, offset)
         self.hits += len(buf)
 #        self.close()
 
         return buf
 
+    def read_through(self, size, offset, fetch):
+        """
+        Reads what is cached of [offset, offset+size) and calls
+        fetch(size, offset) -> (buf, last) for each gap in between,
+        recording the fetched ranges.  Returns the stitched buffer.
+        """
+        if self.evictor:
+            self.evictor.access(self.node_id)
+        if self.shared:
+            # Another mount may have cached some of it meanwhile
+            self.__sync__()
+        seen = self.blocks.generation
+
+        bufs = []
+        for seg_offset, seg_size, cached in self.blocks.segments(offset, offset + size):
+            if cached:
+                buf = self.__read_cached__(seg_size, seg_offset, seen)
+                if buf == None:
+                    # Changed by another mount since, look again
+                    bufs.append(self.read_through(offset + size - seg_offset, seg_offset, fetch))
+                    break
+                self.hits += len(buf)
+                if len(buf) < seg_size:
+                    # Dropped (evicted, say) since it was looked up.  Once
+                    # that is done the map tells what is left, and if it
+                    # still claims the rest it is wrong: that is a miss.
+                    pos = seg_offset + len(buf)
+                    with self.blocks.write_lock:
+                        still = self.blocks.find(pos)[0] != None
+                    bufs.append(buf)
+                    if still:
+                        bufs.append(self.__fetch_once__(offset + size - pos, pos, fetch))
+                    else:
+                        bufs.append(self.read_through(offset + size - pos, pos, fetch))
+                    break
+            else:
+                buf = self.__fetch_once__(seg_size, seg_offset, fetch)
+            bufs.append(buf)
+            if len(buf) < seg_size:
+                break
+        return ''.join(bufs)
+
+    def __read_cached__(self, size, offset, seen):
+        """
+        Reads [offset, offset+size), which is cached.  None if the node
+        changed in a cache shared with other mounts since that was looked
+        up, in the map at generation seen.
+        """
+        if self.shared == None:
+            return self.__read_ram__(size, offset)
+        with self.shared.locked(self.node_id):
+            self.__sync__()
+            if self.blocks.generation != seen:
+                return None
+            return self.__read_ram__(size, offset)
+
+    def __read_ram__(self, size, offset):
+        """Reads [offset, offset+size), which is cached, through the RAM tier if there is one"""
+        if self.ram == None:
+            return self.__read_data__(size, offset)
+
+        block_size = self.ram.block_size
+        bufs = []
+        pos, end = offset, offset + size
+        while pos < end:
+            index = pos / block_size
+            start = index * block_size
+            want = min(end, start + block_size) - pos
+            block = self.ram.get(self.node_id, index)
+            if block == None:
+                generation = self.ram.generation(self.node_id)
+                segs = self.blocks.segments(start, start + block_size)
+                if len(segs) == 1 and segs[0][2]:
+                    # The cache file has the whole block, keep it around
+                    block = self.__read_data__(segs[0][1], start)
+                    if len(block) == segs[0][1]:
+                        self.ram.put(self.node_id, index, block, generation)
+                else:
+                    buf = self.__read_data__(want, pos)
+                    bufs.append(buf)
+                    pos += want
+                    if len(buf) < want:
+                        break
+                    continue
+            buf = block[pos - start:pos - start + want]
+            bufs.append(buf)
+            pos += want
+            if len(buf) < want:
+                break
+        return ''.join(bufs)
+
+    def __read_data__(self, size, offset):
+        """Reads cached data from the cache file"""
+        if not self.packed:
+            if self.mappings != None:
+                buf = self.mappings.read(self.blocks, self.cache, size, offset)
+                if buf != None:
+                    return buf
+            with span('cache.read'):
+                return pread(self.cache, size, offset)
+
+        shift = self.blocks.shift
+        bufs = []
+        pos, end = offset, offset + size
+        while pos < end:
+            start = pos >> shift << shift
+            want = min(end, start + self.blocks.chunk_size) - pos
+            chunk = self.__read_chunk__(pos >> shift)
+            if chunk == None:
+                break
+            buf = chunk[pos - start:pos - start + want]
+            bufs.append(buf)
+            pos += want
+            if len(buf) < want:
+                break
+        return ''.join(bufs)
+
+    def __read_chunk__(self, chunk):
+        """The contents of chunk, None if it isn't stored"""
+        # Writers hold write_lock from storing a chunk until the map says
+        # how it is stored, and until a chunk it dropped is given back, so
+        # under it the bytes read are the ones the map describes
+        with self.blocks.write_lock:
+            stored = self.blocks.stored_length(chunk)
+            if stored == None:
+                return None
+            length, raw, digest = stored
+            with span('cache.read'):
+                if self.store != None:
+                    data = self.store.read(digest, length)
+                else:
+                    data = pread(self.cache, length, chunk << self.blocks.shift)
+        if raw:
+            return data
+        try:
+            with span('cache.decompress'):
+                return self.codec[1](data)
+        except self.codec[2], e:
+            raise IOError(errno.EIO, "chunk %d of node %s doesn't decompress: %s" % (chunk, self.node_id, e))
+
+    def __pack__(self, data):
+        """data compressed, or as is if that doesn't save an eighth: (bytes, raw)"""
+        if self.codec == None:
+            return data, True
+        with span('cache.compress'):
+            packed = self.codec[0](data)
+        if len(packed) > len(data) - len(data) / 8:
+            return data, True
+        return packed, False
+
+    def __write_chunk__(self, chunk, data):
+        """
+        Stores chunk, compressed if that's worth it.  True if it was
+        rewritten in place and now takes a different length or form, which
+        the database has to learn right away: its row would otherwise have
+        the new bytes read as what was there before.
+        """
+        if self.store != None:
+            digest, length, raw = self.store.put(self.db, data, self.__pack__)
+            self.blocks.store(chunk, length, raw, digest)
+            return False
+        packed, raw = self.__pack__(data)
+        offset = chunk << self.blocks.shift
+        old = self.blocks.stored_length(chunk)
+        with span('cache.write'):
+            pwrite(self.cache, packed, offset)
+        if old != None and old[0] > len(packed):
+            punch_hole(self.cache, offset + len(packed), old[0] - len(packed))
+        self.blocks.store(chunk, len(packed), raw)
+        return old != None and old[:2] != (len(packed), raw)
+
+    def __update_chunks__(self, buff, offset, last_bytes):
+        """
+        Writes buff into the chunks it touches: cached ones are patched,
+        others only stored if buff covers them whole (or up to the end of
+        the node) since that is all the map can record.  True if one of
+        them was rewritten the way __write_chunk__() reports.
+        """
+        chunk_size = self.blocks.chunk_size
+        end = offset + len(buff)
+        # Writing past the end leaves a hole the old last chunk reads as zeros
+        rewritten = self.__extend_last__(offset)
+        for chunk in range(offset >> self.blocks.shift, ((end - 1) >> self.blocks.shift) + 1):
+            start = chunk << self.blocks.shift
+            at = max(offset, start) - start
+            piece = buff[start + at - offset:min(end, start + chunk_size) - offset]
+            if self.blocks.cached(chunk):
+                old = self.__read_chunk__(chunk) or ''
+                data = old[:at] + '\0' * (at - len(old)) + piece + old[at + len(piece):]
+            elif at == 0 and (len(piece) == chunk_size or (last_bytes and start + len(piece) == end)):
+                data = piece
+            else:
+                continue
+            rewritten = self.__write_chunk__(chunk, data) or rewritten
+        return rewritten
+
+    def __fetch_once__(self, size, offset, fetch):
+        """
+        Fetches the gap [offset, offset+size), unless a fetch overlapping
+        it is already under way (another reader's, or readahead's), in
+        which case that is waited for and the gap read again.
+        """
+        # Fetch all of what the map can record, e.g. whole chunks
+        fetch_offset, fetch_end = self.blocks.align(offset, offset + size)
+        key = (self.cachebase, self.node_id)
+        mine, done = FileDataCache.in_flight.claim(key, fetch_offset, fetch_end)
+        if not mine:
+            self.waits += 1
+            done.wait()
+            return self.read_through(size, offset, fetch)
+        try:
+            fetched, last = fetch(fetch_end - fetch_offset, fetch_offset)
+            self.misses += size
+            self.update(fetched, fetch_offset, last)
+        finally:
+            FileDataCache.in_flight.release(key, fetch_offset, fetch_end, done)
+        return fetched[offset - fetch_offset:offset - fetch_offset + size]
+
+    def fill(self, offset, end, size, fetch):
+        """
+        Caches the parts of [offset, end) the map can't record a write to
+        on their own (the rest of partly written chunks) from fetch,
+        as far as size, where the node currently ends.
+        """
+        for start, stop in self.blocks.partial(offset, end):
+            if start < size:
+                self.read_through(min(stop, size) - start, start, fetch)
+
     def update(self, buff, offset, last_bytes=False):
 #        print ">>> UPDATE (len: %s, offset, %s)" % (len(buff), offset)
 #        self.open()
-        os.lseek(self.cache, offset, os.SEEK_SET)
-        os.write(self.cache, buff)
+        if self.shared != None or self.packed and buff:
+            # Shared: the data and the map change together for the other
+            # mounts.  Packed: a chunk's data and its stored length do.
+            with self.__changing__():
+                self.__update__(buff, offset, last_bytes)
+        else:
+            self.__update__(buff, offset, last_bytes)
 
-        self.__add_block___(offset, len(buff), last_bytes)
+        if self.evictor:
+            self.evictor.resize(self.db, self.node_id, self.blocks.size)
 #        self.close()
 
+    def __update__(self, buff, offset, last_bytes):
+        self.__forget_whole__()
+        rewritten = False
+        if not self.packed:
+            with span('cache.write'):
+                pwrite(self.cache, buff, offset)
+        elif buff:
+            rewritten = self.__update_chunks__(buff, offset, last_bytes)
+        if self.ram and buff:
+            self.ram.write(self.node_id, offset, buff)
+
+        self.__add_block___(offset, len(buff), last_bytes, rewritten)
+
     def truncate(self, l):
 #        print ">>> TRUNCATE (cache: %s, len: %s)" % (self.cache, l)
         try:
-            os.ftruncate(self.cache, l)
+            with self.__changing__():
+                self.__forget_whole__()
+                if self.mappings:
+                    self.mappings.retire(self.blocks)
+                if not self.packed:
+                    os.ftruncate(self.cache, l)
+                if self.ram:
+                    self.ram.truncate(self.node_id, l)
+                if self.packed:
+                    self.__truncate_chunks__(l)
+                self.blocks.truncate(l)
 
-            with self.db:
-                self.db.execute("DELETE FROM blocks WHERE node_id = ? AND offset >= ?", (self.node_id, l))
-                self.db.execute("UPDATE blocks SET end = ? WHERE node_id = ? AND end > ?", (l, self.node_id, l))
+                with self.db:
+                    self.blocks.save_truncate(self.db, self.node_id, l)
+            if self.store:
+                self.store.sweep(self.db)
+
+            if self.evictor:
+                self.evictor.resize(self.db, self.node_id, self.blocks.size)
         except Exception, e:
             print "Error truncating: %s" % e
         
         return
 
-    def unlink(self):
-        shutil.rmtree(self.full_path)
-        with self.db:
-            self.db.execute("DELETE FROM paths WHERE path = ?", self.path)
-            count = self.db.execute("SELECT COUNT(*) FROM paths WHERE paths.path = ? ", self.path).fetchone()[0]
-            if count == 0:
-                self.db.execute("DELETE FROM nodes WHERE node_id = ? ", self.node_id)
+    def __extend_last__(self, l):
+        """
+        Gives the cached last chunk, if it ends short of a whole one, the
+        zeros the node growing to l adds to it.  See __write_chunk__() for
+        what is returned.
+        """
+        shift = self.blocks.shift
+        eof = self.blocks.eof
+        if eof != None and eof < l and eof >> shift << shift != eof and self.blocks.cached(eof >> shift):
+            start = eof >> shift << shift
+            data = self.__read_chunk__(eof >> shift)
+            return self.__write_chunk__(eof >> shift, data.ljust(min(l - start, self.blocks.chunk_size), '\0'))
+        return False
+
+    def __truncate_chunks__(self, l):
+        """Cuts the cache file after the chunk holding l, which is rewritten to end at l"""
+        shift = self.blocks.shift
+        self.__extend_last__(l)
 
+        chunk = l >> shift
+        start = chunk << shift
+        data = None
+        if l > start and self.blocks.cached(chunk):
+            data = self.__read_chunk__(chunk)
+        if self.store == None:
+            os.ftruncate(self.cache, start)
+        if data != None:
+            self.blocks.store(chunk, 0, False)
+            self.__write_chunk__(chunk, data[:l - start].ljust(l - start, '\0'))
+
+    def unlink(self):
+        with self.__changing__():
+            os.remove(self.full_path)
+            self.__forget_whole__()
+            with self.db:
+                self.db.execute("DELETE FROM paths WHERE path = ?", (self.path,))
+                count = self.db.execute("SELECT COUNT(*) FROM paths WHERE node_id = ? ", (self.node_id,)).fetchone()[0]
+                if count == 0:
+                    self.blocks.truncate(0)
+                    writer = FileDataCache.block_writers.get(self.cachebase)
+                    if writer:
+                        writer.discard(self.node_id)
+                    if self.store:
+                        self.blocks.release(self.db)
+                    self.db.execute("DELETE FROM blocks WHERE node_id = ? ", (self.node_id,))
+                    self.db.execute("DELETE FROM chunks WHERE node_id = ? ", (self.node_id,))
+                    self.db.execute("DELETE FROM nodes WHERE id = ? ", (self.node_id,))
+                    with FileDataCache.block_maps_lock:
+                        FileDataCache.block_maps.pop((self.cachebase, self.node_id), None)
+                    if self.evictor:
+                        self.evictor.forget(self.node_id)
+                    if self.ram:
+                        self.ram.forget(self.node_id)
+                    if self.mappings:
+                        self.mappings.retire(self.blocks)
+        if self.store:
+            self.store.sweep(self.db)
 
     @staticmethod
     def rmdir(cache_base, path):
@@ -206,9 +2975,6 @@ class FileDataCache:
             pass
 
     def rename(self, new_name):
-        with self.db:
-            self.db.execute("INSERT OR REPLACE INTO paths (path) values (?)", (self.path,))
-
         new_full_path = self.cache_file(new_name)
             
         try:
@@ -218,6 +2984,16 @@ class FileDataCache:
 
         os.rename(self.full_path, new_full_path)
 
+        with self.db:
+            self.db.execute("DELETE FROM paths WHERE path = ?", (self.path,))
+            # Whatever was cached at new_name was just replaced
+            self.db.execute("INSERT OR REPLACE INTO paths (node_id, path) values (?, ?)", (self.node_id, new_name))
+        whole = whole_files_of(self.db, self.cachebase)
+        if self.node_id in whole:
+            whole[self.node_id] = (new_name,) + whole[self.node_id][1:]
+        self.path = new_name
+        self.full_path = new_full_path
+
 
         
 
@@ -226,49 +3002,258 @@ def make_file_class(file_system):
     class CacheFile(object):
         direct_io = False
         keep_cache = False
+        # Contents of a file that only exists under the mount, e.g. the stats
+        virtual = None
+        # Contents of a small file read whole, see small_file
+        whole = None
     
+        @traced('file.open')
         def __init__(self, path, flags, *mode):
             self.path = path
+            if path == STATS_PATH:
+                if flags & (os.O_WRONLY | os.O_RDWR):
+                    raise OSError(errno.EACCES, os.strerror(errno.EACCES), path)
+                self.virtual = file_system.render_stats()
+                self.direct_io = True
+                return
+
             self.pp = file_system._physical_path(self.path)
             print('>> file<%s>.open(flags=%d, mode=%s)' % (self.pp, flags, mode))
+            if file_system.prewarm:
+                file_system.prewarm.stop()
+
+            monitor = file_system.monitor
+            if monitor and not monitor.online:
+                return self.__open_cached__(flags)
+
+            self.writing = bool(flags & (os.O_WRONLY | os.O_RDWR | os.O_CREAT))
+            if self.writing:
+                file_system.start_writing(path)
+            try:
+                if len(mode) > 0:
+                    self.f = os.open(self.pp, flags, mode[0])
+                else:
+                    self.f = os.open(self.pp, flags)
+            except OSError, e:
+                if self.writing:
+                    file_system.stop_writing(path)
+                if monitor and monitor.failed(e):
+                    return self.__open_cached__(flags)
+                raise
+
+            st = os.fstat(self.f)
+            if (not self.writing and st.st_size <= file_system.small_file and
+                not (file_system.writeback and file_system.writeback.is_dirty(st.st_ino))):
+                self.whole = FileDataCache.read_whole(file_system.cache, path, st)
+                # Pages the kernel has from earlier opens are only good if the file didn't change
+                valid = self.whole != None
+                if self.whole == None:
+                    self.whole, valid = self.__fetch_whole__(path, flags, st)
+                if self.whole != None:
+                    if file_system.access_log:
+                        file_system.access_log.add(st.st_ino, 0, len(self.whole))
+                    # Nothing left to ask the target or the cache for
+                    os.close(self.f)
+                    self.f = None
+                    self.size = len(self.whole)
+                    self.keep_cache = valid
+                    return
 
-            if len(mode) > 0:
-                self.f = os.open(self.pp, flags, mode[0])
+            self.data_cache = FileDataCache.handles.acquire(file_system.cache, path, st.st_ino, flags)
+
+            self.writeback = file_system.writeback
+            self.size = st.st_size
+            self.written = False
+            if self.writeback and self.writeback.is_dirty(st.st_ino):
+                # The target is behind the cache until the flushers catch up
+                if flags & os.O_TRUNC:
+                    self.writeback.truncate(self.data_cache.db, st.st_ino, 0)
+                self.size = max(self.size, self.writeback.extent(st.st_ino))
+                self.keep_cache = not flags & os.O_TRUNC
             else:
-                self.f = os.open(self.pp, flags)
+                sample = None
+                if file_system.verify == 'sample':
+                    sample = FileDataCache.sample(self.f, st.st_size)
+                self.keep_cache = self.data_cache.validate(st, sample)
 
-            inode_id = os.stat(self.pp).st_ino
-            self.data_cache = FileDataCache(file_system.cache_db, file_system.cache, path, flags, inode_id)
+            self.pattern = None
+            if file_system.readahead:
+                self.pattern = file_system.readahead.pattern()
 
-        def read(self, size, offset):
+        def __fetch_whole__(self, path, flags, st):
+            """
+            Reads a small file through the cache in one go, fetching
+            whatever of it is missing in a single read, and flags it as
+            cached whole.  Returns its contents, None if it changed while
+            being read, and whether what was cached of it was still good.
+            """
+            def fetch(size, offset):
+                buf = self.__read_target__(size, offset)
+                return buf, offset + len(buf) >= st.st_size
+
+            cache = FileDataCache.handles.acquire(file_system.cache, path, st.st_ino, flags)
+            try:
+                sample = None
+                if file_system.verify == 'sample':
+                    sample = FileDataCache.sample(self.f, st.st_size)
+                valid = cache.validate(st, sample)
+                # The handle may be pooled, its counts go back further than this open
+                hits, misses, waits = cache.hits, cache.misses, cache.waits
+                buf = cache.read_through(st.st_size, 0, fetch)
+                stats = file_system.stats
+                stats.add('read.hit_bytes', cache.hits - hits)
+                stats.add('read.miss_bytes', cache.misses - misses)
+                if cache.waits != waits:
+                    stats.add('read.shared_fetches', cache.waits - waits)
+                if len(buf) != st.st_size:
+                    # Changing as we speak, leave it to the usual path
+                    return None, valid
+                cache.mark_whole(st)
+                return buf, valid
+            finally:
+                FileDataCache.handles.release(cache)
+
+        def __open_cached__(self, flags):
+            """Opens the file while the target is offline, which works for reading fully cached ones"""
+            if flags & (os.O_WRONLY | os.O_RDWR | os.O_CREAT | os.O_TRUNC):
+                raise OSError(errno.EROFS, os.strerror(errno.EROFS), self.path)
             try:
-                buf = self.data_cache.read(size, offset)
+                self.data_cache = FileDataCache(None, file_system.cache, self.path, flags)
             except CacheMiss:
-                os.lseek(self.f, offset, os.SEEK_SET)
-                buf = os.read(self.f, size)
-                
-                self.data_cache.update(buf, offset, os.read(self.f, 1)=='')
+                raise OSError(errno.ENOTCONN, os.strerror(errno.ENOTCONN), self.path)
+            size = self.data_cache.complete()
+            self.writeback = file_system.writeback
+            if size != None and self.writeback and self.writeback.is_dirty(self.data_cache.node_id):
+                size = max(size, self.writeback.extent(self.data_cache.node_id))
+            if size == None:
+                self.data_cache.close()
+                raise OSError(errno.ENOTCONN, os.strerror(errno.ENOTCONN), self.path)
+            file_system.stats.add('offline.opens')
+            self.f = None
+            self.size = size
+            self.writing = False
+            self.written = False
+            self.pattern = None
+            self.keep_cache = True
+
+        @traced('file.read')
+        def read(self, size, offset):
+            if self.virtual != None:
+                return self.virtual[offset:offset + size]
+            if self.whole != None:
+                file_system.stats.add('read.ops')
+                return self.whole[offset:offset + size]
+
+            prefetched = 0
+            if self.pattern:
+                prefetched = self.pattern.ahead
+                ahead = self.pattern.access(offset, size)
+                if ahead:
+                    file_system.readahead.submit(self.pp, self.path, self.data_cache.node_id, *ahead)
+
+            hits, misses, waits = self.data_cache.hits, self.data_cache.misses, self.data_cache.waits
+            buf = self.data_cache.read_through(size, offset, self.__fetch__)
+            if file_system.access_log and buf:
+                file_system.access_log.add(self.data_cache.node_id, offset, len(buf))
+
+            stats = file_system.stats
+            hits = self.data_cache.hits - hits
+            stats.add('read.ops')
+            stats.add('read.hit_bytes', hits)
+            stats.add('read.miss_bytes', self.data_cache.misses - misses)
+            if self.data_cache.waits != waits:
+                stats.add('read.shared_fetches', self.data_cache.waits - waits)
+            if hits and offset + size <= prefetched:
+                stats.add('readahead.hit_bytes', hits)
             return buf
+
+        def __fetch__(self, size, offset):
+            if self.f == None:
+                # Opened offline, everything up to self.size is cached
+                if offset >= self.size:
+                    return '', True
+                raise OSError(errno.ENOTCONN, os.strerror(errno.ENOTCONN), self.path)
+            buf = self.__read_target__(size, offset)
+            end = offset + len(buf)
+            if len(buf) < size:
+                if self.writeback and end < self.size:
+                    # A hole the target hasn't seen yet, unflushed writes lie past it
+                    buf += '\0' * (min(offset + size, self.size) - end)
+                    return buf, offset + len(buf) >= self.size
+                self.size = end
+                return buf, True
+            # EOF comes from the size known to this handle, not a probe read
+            self.size = max(self.size, end)
+            return buf, end == self.size
         
+        def __read_target__(self, size, offset):
+            """Reads the target file for the cache, every fetch of a handle comes down to this"""
+            with span('target.read'):
+                buf = pread(self.f, size, offset)
+            file_system.stats.add('target.read_bytes', len(buf))
+            return buf
+
+        @traced('file.write')
         def write(self, buf, offset):
 #            print('>> file<%s>.write(len(buf)=%d, offset=%s)' % (self.path, len(buf), offset))
-            os.lseek(self.f, offset, os.SEEK_SET)
-            os.write(self.f, buf)
+            self.written = True
+            file_system.stats.add('write.ops')
+            file_system.stats.add('write.bytes', len(buf))
+            if self.writeback:
+                # The cache is all there will be of this write for a while
+                self.data_cache.fill(offset, offset + len(buf), self.size, self.__fetch__)
+                self.size = max(self.size, offset + len(buf))
+                self.data_cache.update(buf, offset, offset + len(buf) == self.size)
+                blocks = None
+                if FileDataCache.block_writers.get(file_system.cache):
+                    blocks = self.data_cache.blocks
+                self.writeback.record(self.data_cache.db, self.data_cache.node_id, self.path, offset, len(buf), blocks)
+                return len(buf)
+
+            with span('target.write'):
+                pwrite(self.f, buf, offset)
+            file_system.stats.add('target.written_bytes', len(buf))
 
-            end = os.stat(self.pp).st_size
-            self.data_cache.update(buf, offset, offset + len(buf) == end)
+            self.size = max(self.size, offset + len(buf))
+            self.data_cache.update(buf, offset, offset + len(buf) == self.size)
 
             return len(buf)
 
 
+        @traced('file.release')
         def release(self, flags):
+            if self.virtual != None:
+                return 0
             print('>> file<%s>.release()' % self.path)
-            os.close(self.f)
-            self.data_cache.close()
-            self.data_cache.report()
+            if self.whole != None:
+                return 0
+            if self.written and not self.writeback:
+                self.data_cache.remember(os.fstat(self.f))
+            if self.f != None:
+                os.close(self.f)
+            FileDataCache.handles.release(self.data_cache)
+            writer = FileDataCache.block_writers.get(file_system.cache)
+            if writer:
+                writer.flush(self.data_cache.db, [self.data_cache.node_id])
+            if self.writing:
+                file_system.stop_writing(self.path)
             return 0
 
+        @traced('file.flush')
         def flush(self):
+            if self.virtual != None or self.f == None:
+                return
+            if self.writeback:
+                # close() doesn't promise durability, the flushers will get to it
+                return
+            os.fsync(self.f)
+
+        @traced('file.fsync')
+        def fsync(self, isfsyncfile):
+            if self.virtual != None or self.f == None:
+                return
+            if self.writeback:
+                self.writeback.flush(self.data_cache.db, self.data_cache.node_id)
             os.fsync(self.f)
 
     return CacheFile
@@ -278,48 +3263,242 @@ class CacheFS(fuse.Fuse):
         fuse.Fuse.__init__(self, *args, **kwargs)
         self.file_class = make_file_class(self)
         self.caches = {}
+        self.readahead = None
+        self.writeback = None
+        self.metadata = None
+        self.verify = 'stat'
+        self.stats = Stats()
+        # Watches the target, None if it is assumed always reachable
+        self.monitor = None
+        # Where the Chrome trace is written, if tracing
+        self.trace = None
+        self.access_log = None
+        self.prewarm = None
+        # Files at most this big are read whole on open
+        self.small_file = 0
+        # Descriptor holding the cache's in_use lock, see lock_cache()
+        self.in_use = None
+        # Paths open for writing, their attributes are changing under us
+        self.writers = {}
+        self.writers_lock = threading.Lock()
+
+    @property
+    def cache_db(self):
+        return thread_db(self.cache)
 
     def _physical_path(self, path):
         phys_path = os.path.join(self.target, path.lstrip('/'))
         return phys_path
-    
+
+    def start_writing(self, path):
+        with self.writers_lock:
+            self.writers[path] = self.writers.get(path, 0) + 1
+        self.__invalidate__(path)
+
+    def stop_writing(self, path):
+        with self.writers_lock:
+            self.writers[path] -= 1
+            if not self.writers[path]:
+                del self.writers[path]
+        self.__invalidate__(path)
+
+    def __require_target__(self, path):
+        """Fails fast for changes to the target while it's offline"""
+        if self.monitor and not self.monitor.online:
+            raise OSError(errno.EROFS, os.strerror(errno.EROFS), path)
+
+    def __invalidate__(self, path, tree = False):
+        if self.metadata:
+            self.metadata.invalidate(self.cache_db, path, tree)
+
+    def __refingerprint__(self, path):
+        """
+        Our own changes to a file's size, times or links must not look
+        like the target changing behind our back at the next open.
+        """
+        try:
+            st = os.lstat(self._physical_path(path))
+        except OSError:
+            return
+        with self.cache_db:
+            self.cache_db.execute('UPDATE nodes SET size = ?, mtime = ?, ctime = ?, sample = NULL '
+                                  'WHERE id = ? AND size IS NOT NULL',
+                                  (st.st_size, st.st_mtime, st.st_ctime, st.st_ino))
+
+    def render_stats(self):
+        """Everything worth watching about this mount, as JSON"""
+        stats = self.stats.snapshot()
+        stats['uptime'] = time.time() - self.stats.started
+
+        cache = stats.setdefault('cache', {})
+        evictor = FileDataCache.evictors.get(self.cache)
+        if evictor:
+            cache.update(used_bytes=evictor.used, capacity_bytes=evictor.capacity,
+                         evictions=evictor.evictions, evicted_bytes=evictor.evicted_bytes)
+        else:
+            cache['used_bytes'] = sum(size for node_id, size in cached_sizes(self.cache_db, self.cache))
+        writer = FileDataCache.block_writers.get(self.cache)
+        if writer:
+            cache['commits'] = writer.commits
+        store = FileDataCache.stores.get(self.cache)
+        if store:
+            referenced, stored = store.usage(self.cache_db)
+            cache.update(dedup_referenced_bytes=referenced, dedup_stored_bytes=stored,
+                         dedup_ratio=float(referenced) / stored if stored else 1.0)
+        opened, idle = FileDataCache.handles.counts()
+        stats['handles'] = {'open': opened, 'idle': idle, 'reused': FileDataCache.handles.reused}
+        ram = FileDataCache.ram_caches.get(self.cache)
+        if ram:
+            stats['ram'] = {'used_bytes': ram.used, 'capacity_bytes': ram.capacity, 'hit_bytes': ram.hits}
+        mappings = FileDataCache.mappings.get(self.cache)
+        if mappings:
+            stats['mmap'] = {'mapped_files': mappings.count(), 'mappings': mappings.mapped}
+        shared = FileDataCache.shared.get(self.cache)
+        if shared:
+            stats['shared'] = {'reloads': shared.reloads}
+
+        if self.readahead:
+            stats.setdefault('readahead', {}).update(fetched_bytes=self.readahead.fetched,
+                                                     queued_bytes=self.readahead.pending)
+        if self.prewarm:
+            stats['prewarm'] = {'fetched_bytes': self.prewarm.fetched,
+                                'running': self.prewarm.thread.is_alive()}
+        if self.writeback:
+            stats['writeback'] = {'dirty_bytes': self.writeback.dirty_bytes(),
+                                  'pushed_bytes': self.writeback.pushed,
+                                  'lost_bytes': self.writeback.lost}
+        if self.monitor:
+            stats.setdefault('target', {}).update(online=self.monitor.online,
+                                                  transitions=self.monitor.transitions)
+        if tracer:
+            stats['latency'] = tracer.latencies()
+        return json.dumps(stats, indent=2, sort_keys=True) + '\n'
+
+    def __virtual_stat__(self, path):
+        mode = stat.S_IFDIR | 0555 if path == STATS_DIR else stat.S_IFREG | 0444
+        now = time.time()
+        return os.stat_result((mode, 0, 0, 2 if path == STATS_DIR else 1,
+                               os.getuid(), os.getgid(), 0, now, now, self.stats.started))
+
+    def __cached__(self, kind, path, fetch):
+        """Answers from the metadata cache, calling fetch() and caching its result on a miss"""
+        op = {'attr': 'getattr', 'dir': 'readdir', 'link': 'readlink'}[kind]
+        self.stats.add(op + '.ops')
+        if self.monitor and not self.monitor.online:
+            return self.__offline__(kind, path)
+        if not self.metadata or path in self.writers:
+            return self.__fetch__(kind, path, fetch)
+        found, value = self.metadata.get(kind, path)
+        self.stats.add(op + ('.hits' if found else '.misses'))
+        if not found:
+            try:
+                value = self.__fetch__(kind, path, fetch)
+            except OSError, e:
+                if e.errno == errno.ENOENT:
+                    self.metadata.put(self.cache_db, 'attr', path, None)
+                raise
+            self.metadata.put(self.cache_db, kind, path, value)
+        elif value == None:
+            raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+        return value
+
+    def __fetch__(self, kind, path, fetch):
+        """Calls fetch(), answering from what was last known if the target turns out to be unreachable"""
+        try:
+            return fetch()
+        except OSError, e:
+            if self.monitor and self.monitor.failed(e):
+                return self.__offline__(kind, path)
+            raise
+
+    def __offline__(self, kind, path):
+        """Answers from the last known state of the target, however old"""
+        self.stats.add('offline.lookups')
+        found, value = False, None
+        if self.metadata:
+            found, value = self.metadata.get(kind, path, stale=True)
+        if not found:
+            raise OSError(errno.ENOTCONN, os.strerror(errno.ENOTCONN), path)
+        if value == None:
+            raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+        return value
+
+    @traced('fs.getattr')
     def getattr(self, path):
+        if path in (STATS_DIR, STATS_PATH):
+            return self.__virtual_stat__(path)
         try:
            pp = self._physical_path(path)
            # Hide non-public files (except root)
 
-           return os.lstat(pp)
+           st = self.__cached__('attr', path, lambda: os.lstat(pp))
+           if self.writeback and stat.S_ISREG(st.st_mode):
+               size = self.writeback.extent(st.st_ino)
+               if size > st.st_size:
+                   st = os.stat_result(st[:stat.ST_SIZE] + (size,) + st[stat.ST_SIZE + 1:])
+           return st
         except Exception, e:
            debug(str(e))
            raise e
 
+    @traced('fs.readdir')
     def readdir(self, path, offset):
+        if path == STATS_DIR:
+            for r in ('..', '.', os.path.basename(STATS_PATH)):
+                yield fuse.Direntry(r)
+            return
         phys_path = self._physical_path(path).rstrip('/') + '/'
         for r in ('..', '.'):
             yield fuse.Direntry(r)
-        for r in os.listdir(phys_path):
+        for r in self.__cached__('dir', path, lambda: os.listdir(phys_path)):
             virt_path = r
             debug('readdir yield: ' + virt_path)
             yield fuse.Direntry(virt_path)
 
+    @traced('fs.readlink')
     def readlink(self, path):
 #        print('>> readlink("%s")' % path)
-        phys_resolved = os.readlink(self._physical_path(path))
+        phys_resolved = self.__cached__('link', path, lambda: os.readlink(self._physical_path(path)))
         debug('   resolves to physical "%s"' % phys_resolved)
         return phys_resolved
 
 
+    def __settle_writeback__(self, path):
+        """
+        Pushes (or, for the last link, drops) unflushed writes of path so
+        the flushers never write through a name that is about to change.
+        """
+        if not self.writeback:
+            return
+        try:
+            st = os.lstat(self._physical_path(path))
+        except OSError:
+            return
+        if st.st_nlink <= 1:
+            self.writeback.truncate(self.cache_db, st.st_ino, 0)
+        else:
+            self.writeback.flush(self.cache_db, st.st_ino)
+
+    @traced('fs.unlink')
     def unlink(self, path):
+        self.__require_target__(path)
 #        print('>> unlink("%s")' % path)
+        self.__settle_writeback__(path)
         os.remove(self._physical_path(path))
+        self.__invalidate__(path)
+        FileDataCache.handles.forget(self.cache, path)
         try:
-            FileDataCache(self.cache_db, self.cache, path).unlink()
+            cache = FileDataCache(self.cache_db, self.cache, path)
+            cache.unlink()
+            cache.close()
         except:
             pass
         return 0
 
     # Note: utime is deprecated in favour of utimens.
+    @traced('fs.utime')
     def utime(self, path, times):
+        self.__require_target__(path)
         """
         Sets the access and modification times on a file.
         times: (atime, mtime) pair. Both ints, in seconds since epoch.
@@ -327,51 +3506,93 @@ class CacheFS(fuse.Fuse):
         """
         debug('>> utime("%s", %s)' % (path, times))
         os.utime(self._physical_path(path), times)
+        self.__invalidate__(path)
+        self.__refingerprint__(path)
         return 0
 
+    @traced('fs.access')
     def access(self, path, flags):
-        path = self._physical_path(path)
-        os.access(path, flags)
+        # Permissions are left to the kernel, this only has to notice missing paths
+        self.getattr(path)
 
+    @traced('fs.mkdir')
     def mkdir(self, path, mode):
+        self.__require_target__(path)
         print('>> mkdir("%s")' % path)
-        path = self._physical_path(path)
-        os.mkdir(path, mode)
+        os.mkdir(self._physical_path(path), mode)
+        self.__invalidate__(path)
         
+    @traced('fs.rmdir')
     def rmdir(self, path):
+        self.__require_target__(path)
         print('>> rmdir("%s")' % path)
         os.rmdir( self._physical_path(path) )
+        self.__invalidate__(path, tree=True)
+        FileDataCache.handles.forget(self.cache, path, tree=True)
         FileDataCache.rmdir(self.cache, path)
 
+    @traced('fs.symlink')
     def symlink(self, target, name):
+        self.__require_target__(name)
         print('>> symlink("%s", "%s")' % (target, name))
         os.symlink(self._physical_path(target), self._physical_path(name))
+        self.__invalidate__(name)
 
+    @traced('fs.link')
     def link(self, target, name):
+        self.__require_target__(name)
         print('>> link(%s, %s)' % (target, name))
         os.link(self._physical_path(target), self._physical_path(name))
-        FileDataCache(self.cache_db, self.cache, name, None, os.stat(self._physical_path(name)).st_ino)
+        self.__invalidate__(target)
+        self.__invalidate__(name)
+        self.__refingerprint__(name)
+        FileDataCache(self.cache_db, self.cache, name, None, os.stat(self._physical_path(name)).st_ino).close()
 
+    @traced('fs.rename')
     def rename(self, old_name, new_name):
+        self.__require_target__(old_name)
         print('>> rename(%s, %s)' % (old_name, new_name))
+        if self.writeback:
+            self.__settle_writeback__(new_name)
+            self.writeback.flush(self.cache_db, os.lstat(self._physical_path(old_name)).st_ino)
         os.rename(self._physical_path(old_name),
                   self._physical_path(new_name))
+        self.__invalidate__(old_name, tree=True)
+        self.__invalidate__(new_name, tree=True)
+        self.__refingerprint__(new_name)
+        FileDataCache.handles.forget(self.cache, old_name, tree=True)
+        FileDataCache.handles.forget(self.cache, new_name, tree=True)
         try:
             fdc = FileDataCache(self.cache_db, self.cache, old_name)
             fdc.rename(new_name)
+            fdc.close()
         except :
             pass
         
+    @traced('fs.chmod')
     def chmod(self, path, mode):
+        self.__require_target__(path)
         os.chmod(self._physical_path(path), mode)
+        self.__invalidate__(path)
+        self.__refingerprint__(path)
         
+    @traced('fs.chown')
     def chown(self, path, user, group):
+        self.__require_target__(path)
         os.chown(self._physical_path(path), user, group)
+        self.__invalidate__(path)
+        self.__refingerprint__(path)
 	
+    @traced('fs.truncate')
     def truncate(self, path, len):
+        self.__require_target__(path)
+        if self.writeback:
+            self.writeback.truncate(self.cache_db, os.lstat(self._physical_path(path)).st_ino, len)
         f = open(self._physical_path(path), "a")
         f.truncate(len)
         f.close()
+        self.__invalidate__(path)
+        self.__refingerprint__(path)
         try:
             cache = FileDataCache(self.cache_db, self.cache, path)
             cache.open()
@@ -380,13 +3601,179 @@ class CacheFS(fuse.Fuse):
         except:
             pass
 
+    def fsinit(self):
+        """
+        Starts everything that runs in the background.  Unless told to
+        stay in the foreground (-f) libfuse forks into the background
+        before calling this, and only the thread that forked carries on
+        in the child, so none of it may be started any earlier.
+        """
+        # In a shared cache every change is committed, and announced, under the node's lock
+        if self.commit_interval > 0 and not FileDataCache.shared.get(self.cache):
+            FileDataCache.block_writers[self.cache] = BlockWriter(self.cache, self.commit_interval)
+        if self.writeback:
+            self.writeback = WriteBack(self.cache, self.target, self.writeback_delay)
+            self.writeback.load(self.cache_db)
+            evictor = FileDataCache.evictors.get(self.cache)
+            if evictor:
+                evictor.pinned = self.writeback.is_dirty
+        if self.probe_interval > 0:
+            self.monitor = TargetMonitor(self.target, self.probe_interval, self.probe_timeout)
+        if self.prewarm:
+            self.access_log = AccessLog(self.cache)
+            self.prewarm = Prewarm(self.cache, self.target, self.access_log.hot_set(self.prewarm))
+        if self.readahead_max > 0:
+            self.readahead = Readahead(self.cache,
+                                       min(128 * 1024, self.readahead_max),
+                                       self.readahead_max,
+                                       self.readahead_limit)
+        if tracer:
+            t = threading.Thread(target=self.__dump_trace__, name="trace-dump")
+            t.daemon = True
+            t.start()
+
+    def __dump_trace__(self):
+        """Writes the trace out on every SIGUSR1, however many threads libfuse runs"""
+        while True:
+            wait_signal(signal.SIGUSR1)
+            try:
+                tracer.dump(self.trace)
+            except Exception, e:
+                print "Error dumping the trace: %s" % e
+
+    def fsdestroy(self):
+        FileDataCache.handles.clear()
+        if self.prewarm:
+            self.prewarm.stop()
+            self.prewarm.join()
+        if self.access_log:
+            self.access_log.close()
+        if self.readahead:
+            self.readahead.stop()
+        if self.writeback:
+            self.writeback.stop(self.cache_db)
+        writer = FileDataCache.block_writers.get(self.cache)
+        if writer:
+            writer.stop(self.cache_db)
+        if self.monitor:
+            self.monitor.stop()
+        if tracer:
+            tracer.dump(self.trace)
+        if self.in_use != None:
+            os.close(self.in_use)
+
+
+if hasattr(os, 'pread'):
+    pread = os.pread
+    pwrite = os.pwrite
+else:
+    # Python 2 has no positional I/O in os, go to libc for it
+    import ctypes
+    import ctypes.util
+
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    libc_pread = getattr(libc, 'pread64', libc.pread)
+    libc_pread.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int64]
+    libc_pread.restype = ctypes.c_ssize_t
+    libc_pwrite = getattr(libc, 'pwrite64', libc.pwrite)
+    libc_pwrite.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_size_t, ctypes.c_int64]
+    libc_pwrite.restype = ctypes.c_ssize_t
+
+    def pread(fd, size, offset):
+        """Reads up to size bytes at offset without moving fd's file position"""
+        buf = ctypes.create_string_buffer(size)
+        n = libc_pread(fd, buf, size, offset)
+        if n < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        return buf.raw[:n]
+
+    def pwrite(fd, data, offset):
+        """Writes data at offset without moving fd's file position"""
+        n = libc_pwrite(fd, data, len(data), offset)
+        if n < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        return n
+
+try:
+    import ctypes
+    import ctypes.util
+    libc_fallocate = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True).fallocate64
+    libc_fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+except (ImportError, OSError, AttributeError):
+    libc_fallocate = None
+
+def punch_hole(fd, offset, length):
+    """Gives the space of [offset, offset+length) in fd back to the file system, where it can"""
+    FALLOC_FL_KEEP_SIZE, FALLOC_FL_PUNCH_HOLE = 0x01, 0x02
+    if libc_fallocate != None:
+        libc_fallocate(fd, FALLOC_FL_KEEP_SIZE | FALLOC_FL_PUNCH_HOLE, offset, length)
+
+if hasattr(signal, 'sigwait'):
+    def block_signal(signum):
+        signal.pthread_sigmask(signal.SIG_BLOCK, [signum])
+
+    def wait_signal(signum):
+        signal.sigwait([signum])
+else:
+    # Python 2 only runs signal handlers in the main thread, which
+    # libfuse keeps in its loop, so signals are waited for in a thread
+    # of their own instead, through libc
+    libc_signals = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    sigset_t = ctypes.c_ulong * (128 / ctypes.sizeof(ctypes.c_ulong))
+
+    def sigset_of(signum):
+        sigset = sigset_t()
+        libc_signals.sigemptyset(ctypes.byref(sigset))
+        libc_signals.sigaddset(ctypes.byref(sigset), signum)
+        return sigset
+
+    def block_signal(signum):
+        """Holds signum back from the calling thread, and from every thread it starts from then on"""
+        SIG_BLOCK = 0
+        e = libc_signals.pthread_sigmask(SIG_BLOCK, ctypes.byref(sigset_of(signum)), None)
+        if e:
+            raise OSError(e, os.strerror(e))
+
+    def wait_signal(signum):
+        """Waits for signum, which every thread has to hold back, to be sent to the process"""
+        received = ctypes.c_int()
+        e = libc_signals.sigwait(ctypes.byref(sigset_of(signum)), ctypes.byref(received))
+        if e:
+            raise OSError(e, os.strerror(e))
+
+def parse_size(text):
+    """Parses a byte count with an optional K/M/G/T suffix"""
+    text = str(text).strip().upper().rstrip('B')
+    for power, suffix in enumerate('KMGT'):
+        if text.endswith(suffix):
+            return int(float(text[:-1]) * 1024 ** (power + 1))
+    return int(text)
 
 def open_db(cache_dir):
-    return sqlite3.connect(os.path.join(cache_dir, "metadata.db"), isolation_level="DEFERRED")
+    db = sqlite3.connect(os.path.join(cache_dir, "metadata.db"), isolation_level="DEFERRED", timeout=30)
+    db.execute("PRAGMA synchronous=NORMAL")
+    return db
+
+thread_state = threading.local()
+
+def thread_db(cache_dir):
+    """
+    The calling thread's connection to cache_dir's metadata.db.  SQLite
+    connections can't be shared between threads, so each gets its own.
+    """
+    dbs = getattr(thread_state, 'dbs', None)
+    if dbs == None:
+        dbs = thread_state.dbs = {}
+    if cache_dir not in dbs:
+        dbs[cache_dir] = open_db(cache_dir)
+    return dbs[cache_dir]
 
 def create_db(cache_dir):
-    open_db(cache_dir)
-    cache_db = sqlite3.connect(os.path.join(cache_dir, "metadata.db"), isolation_level="DEFERRED")
+    cache_db = open_db(cache_dir)
+    # WAL lets lookups on one thread proceed while another commits
+    cache_db.execute("PRAGMA journal_mode=WAL")
 
     cache_db.execute("""
 CREATE TABLE IF NOT EXISTS paths (
@@ -402,10 +3789,21 @@ CREATE TABLE IF NOT EXISTS paths (
     cache_db.execute("""
 CREATE TABLE IF NOT EXISTS nodes (
   id        INTEGER PRIMARY KEY,
-  last_use  INTEGER
+  last_use  INTEGER,
+  size      INTEGER,
+  mtime     REAL,
+  ctime     REAL,
+  sample    STRING,
+  whole     INTEGER
 )
 """
                      )
+    # Caches made before nodes carried a fingerprint
+    columns = [row[1] for row in cache_db.execute("PRAGMA table_info(nodes)")]
+    for column, kind in (('size', 'INTEGER'), ('mtime', 'REAL'), ('ctime', 'REAL'), ('sample', 'STRING'),
+                         ('whole', 'INTEGER')):
+        if column not in columns:
+            cache_db.execute("ALTER TABLE nodes ADD COLUMN %s %s" % (column, kind))
     
     
     cache_db.execute("""
@@ -417,51 +3815,189 @@ CREATE TABLE IF NOT EXISTS blocks (
   FOREIGN KEY(node_id) REFERENCES nodes(id)
 )"""
                      )
-#    cache_db.execute('create index if not exists meta on blocks (path_id, offset, end)') 
-    cache_db.execute("PRAGMA synchronous=OFF")
-    cache_db.execute("PRAGMA journal_mode=OFF")
+    cache_db.execute("""
+CREATE TABLE IF NOT EXISTS chunks (
+  node_id    INTEGER PRIMARY KEY,
+  eof        INTEGER,
+  bitmap     BLOB,
+  lengths    BLOB,
+  hashes     BLOB,
+  FOREIGN KEY(node_id) REFERENCES nodes(id)
+)"""
+                     )
+    columns = [row[1] for row in cache_db.execute("PRAGMA table_info(chunks)")]
+    for column in ('lengths', 'hashes'):
+        if column not in columns:
+            cache_db.execute("ALTER TABLE chunks ADD COLUMN %s BLOB" % column)
+    cache_db.execute("""
+CREATE TABLE IF NOT EXISTS chunk_store (
+  hash       BLOB PRIMARY KEY,
+  refs       INTEGER,
+  length     INTEGER
+)"""
+                     )
+    cache_db.execute("CREATE INDEX IF NOT EXISTS chunk_store_refs ON chunk_store(refs)")
+    cache_db.execute("""
+CREATE TABLE IF NOT EXISTS dirty (
+  node_id    INTEGER NOT NULL,
+  offset     INTEGER,
+  end        INTEGER,
+  FOREIGN KEY(node_id) REFERENCES nodes(id)
+)"""
+                     )
+    cache_db.execute("""
+CREATE TABLE IF NOT EXISTS metadata (
+  kind       STRING,
+  path       STRING,
+  value      STRING,
+  expires    REAL,
+  PRIMARY KEY(kind, path)
+)"""
+                     )
+    cache_db.execute("""
+CREATE TABLE IF NOT EXISTS settings (
+  name       STRING PRIMARY KEY,
+  value      STRING
+)"""
+                     )
+    cache_db.execute('CREATE INDEX IF NOT EXISTS blocks_node ON blocks (node_id, offset)')
 
     return cache_db
 
 
-def main():
-    usage='%prog MOUNTPOINT -o target=SOURCE cache=SOURCE [options]'
-    server = CacheFS(version='CacheFS %s' % CACHE_FS_VERSION,
-                     usage=usage,
-                     dash_s_do='setsingle')
-
-    server.parser.add_option(
-        mountopt="cache", metavar="PATH",
-        default=None,
-        help="Path to place the cache")
-
-    # Wire server.target to command line options
-    server.parser.add_option(
-        mountopt="target", metavar="PATH",
-        default=None,
-        help="Path to be cached")
+def lock_cache(cachebase, shared):
+    """
+    Claims the cache in cachebase for a mount or a warm, taking the lock
+    on <cache>/in_use: shared with the others using the cache if it is
+    shared between mounts, exclusive otherwise.  Returns the descriptor
+    holding it, to be kept open for as long as the cache is used, or None
+    if the cache is already used in a way that excludes this.
+    """
+    fd = os.open(os.path.join(cachebase, "in_use"), os.O_RDWR | os.O_CREAT, 0644)
+    try:
+        fcntl.flock(fd, (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | fcntl.LOCK_NB)
+    except IOError, e:
+        os.close(fd)
+        if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+            return None
+        raise
+    return fd
 
 
-    server.parse(values=server, errex=1)
+def setup(server):
+    """
+    Readies the cache for server, from the options parsed into it.
+    Nothing may be started in the background yet, see CacheFS.fsinit().
+    """
+    global tracer
 #    try:
     server.target = os.path.abspath(server.target)
-    try:
-        cache_dir = server.cache
-    except:
+    cache_dir = server.cache
+    if not cache_dir:
         import hashlib
         cache_dir = os.path.join(os.path.expanduser("~"),
                                  ".cachefs",
                                  hashlib.md5(server.target).hexdigest())
-    server.multithreaded = 0
     server.cache = os.path.abspath(cache_dir)
     try:
-        os.mkdir(server.cache)
+        os.makedirs(server.cache)
     except OSError:
         pass
     
-    server.cache_db = create_db(cache_dir)
-    
-        
+    cache_db = create_db(server.cache)
+    # Before anything is changed: warm or another mount may be at it
+    server.in_use = lock_cache(server.cache, server.shared or shared_of(cache_db, server.cache) != None)
+    if server.in_use == None:
+        server.parser.error("%s is already in use, only a cache mounted with shared can be used "
+                            "by several mounts or warmed meanwhile" % server.cache)
+    with cache_db:
+        cache_db.execute("INSERT OR REPLACE INTO settings VALUES ('target', ?)", (server.target,))
+    if server.chunk_size:
+        chunk_size = parse_size(server.chunk_size)
+        if chunk_size < 4096 or chunk_size & (chunk_size - 1):
+            server.parser.error("chunk_size must be a power of two of at least 4K")
+        if chunk_size != chunk_size_of(cache_db, server.cache):
+            if (cache_db.execute('SELECT 1 FROM blocks LIMIT 1').fetchone() or
+                cache_db.execute('SELECT 1 FROM chunks LIMIT 1').fetchone()):
+                server.parser.error("%s already holds data stored with chunk_size %s" %
+                                    (server.cache, chunk_size_of(cache_db, server.cache) or 'unset'))
+            with cache_db:
+                cache_db.execute("INSERT OR REPLACE INTO settings VALUES ('chunk_size', ?)", (str(chunk_size),))
+            FileDataCache.chunk_sizes[server.cache] = chunk_size
+    if server.compress:
+        if server.compress not in CODECS:
+            server.parser.error("compress must be one of %s" % ', '.join(sorted(CODECS)))
+        if not chunk_size_of(cache_db, server.cache):
+            server.parser.error("compress needs chunk_size")
+        if server.compress != codec_of(cache_db, server.cache):
+            if cache_db.execute('SELECT 1 FROM chunks LIMIT 1').fetchone():
+                server.parser.error("%s already holds data stored with compress %s" %
+                                    (server.cache, codec_of(cache_db, server.cache) or 'unset'))
+            with cache_db:
+                cache_db.execute("INSERT OR REPLACE INTO settings VALUES ('compression', ?)", (server.compress,))
+            FileDataCache.codecs[server.cache] = server.compress
+    if server.dedup:
+        if not chunk_size_of(cache_db, server.cache):
+            server.parser.error("dedup needs chunk_size")
+        if store_of(cache_db, server.cache) == None:
+            if cache_db.execute('SELECT 1 FROM chunks LIMIT 1').fetchone():
+                server.parser.error("%s already holds data stored without dedup" % server.cache)
+            with cache_db:
+                cache_db.execute("INSERT OR REPLACE INTO settings VALUES ('dedup', '1')")
+            FileDataCache.stores[server.cache] = ChunkStore(server.cache)
+    if server.shared and shared_of(cache_db, server.cache) == None:
+        with cache_db:
+            cache_db.execute("INSERT OR REPLACE INTO settings VALUES ('shared', '1')")
+        FileDataCache.shared[server.cache] = SharedCache(server.cache)
+    shared = shared_of(cache_db, server.cache)
+    if shared and server.writeback:
+        server.parser.error("writeback can't be used on a shared cache")
+    cache_db.close()
+
+    server.commit_interval = float(server.commit_interval)
+    server.writeback_delay = float(server.writeback_delay)
+    server.probe_interval = float(server.probe_interval)
+    server.probe_timeout = float(server.probe_timeout)
+    server.readahead_max = parse_size(server.readahead_max)
+    server.readahead_limit = parse_size(server.readahead_limit)
+    server.prewarm = parse_size(server.prewarm) if server.prewarm else 0
+
+    meta_ttl = float(server.meta_ttl)
+    if meta_ttl > 0:
+        server.metadata = MetadataCache(meta_ttl, float(server.negative_ttl))
+        server.metadata.load(server.cache_db)
+        # Let the kernel hold on to entries and attributes too, unless told otherwise
+        for opt in ('entry_timeout', 'attr_timeout'):
+            if opt not in server.fuse_args.optdict:
+                server.fuse_args.add(opt, str(meta_ttl))
+
+    if server.cache_size:
+        evictor = Evictor(server.cache, parse_size(server.cache_size), server.eviction)
+        evictor.load(server.cache_db)
+        FileDataCache.evictors[server.cache] = evictor
+    # For warm to keep to
+    with server.cache_db:
+        if server.cache_size:
+            server.cache_db.executemany("INSERT OR REPLACE INTO settings VALUES (?, ?)",
+                                        [('cache_size', str(parse_size(server.cache_size))),
+                                         ('eviction', server.eviction)])
+        else:
+            server.cache_db.execute("DELETE FROM settings WHERE name IN ('cache_size', 'eviction')")
+
+    if server.trace:
+        server.trace = os.path.abspath(server.trace)
+        tracer = Tracer()
+        # Dumped on SIGUSR1 by a thread fsinit() starts, every other one has to hold it back
+        block_signal(signal.SIGUSR1)
+
+    if server.ram_cache and parse_size(server.ram_cache) > 0:
+        FileDataCache.ram_caches[server.cache] = RamCache(parse_size(server.ram_cache))
+
+    if server.mmap_reads and parse_size(server.mmap_reads) > 0:
+        FileDataCache.mappings[server.cache] = Mappings(parse_size(server.mmap_reads))
+
+    server.small_file = parse_size(server.small_file)
+    FileDataCache.handles.capacity = int(server.idle_handles)
 
     #except AttributeError as e:
     #    print e
@@ -470,16 +4006,319 @@ def main():
     #except AttributeError as e:
     #    pass
 
+def main():
+    usage='%prog MOUNTPOINT -o target=SOURCE cache=SOURCE [options]'
+    server = CacheFS(version='CacheFS %s' % CACHE_FS_VERSION,
+                     usage=usage,
+                     dash_s_do='setsingle')
+
+    server.parser.add_option(
+        mountopt="cache", metavar="PATH",
+        default=None,
+        help="Path to place the cache")
+
+    # Wire server.target to command line options
+    server.parser.add_option(
+        mountopt="target", metavar="PATH",
+        default=None,
+        help="Path to be cached")
+
+    server.parser.add_option(
+        mountopt="readahead_max", metavar="SIZE",
+        default="64M",
+        help="Largest readahead window for sequential reads, 0 disables readahead [default: %default]")
+
+    server.parser.add_option(
+        mountopt="readahead_limit", metavar="SIZE",
+        default="256M",
+        help="Most bytes of readahead queued at once [default: %default]")
+
+    server.parser.add_option(
+        mountopt="chunk_size", metavar="SIZE",
+        default=None,
+        help="Cache file data in fixed chunks of this size (a power of two, e.g. 1M) instead of arbitrary "
+             "byte ranges.  Only takes effect on a cache that is still empty, which keeps it from then on")
+
+    server.parser.add_option(
+        mountopt="compress", metavar="CODEC",
+        default=None,
+        help="Compress cached chunks with zlib or lz4, storing those that don't compress as they are.  "
+             "Needs chunk_size, and like it only takes effect on a cache that is still empty")
+
+    server.parser.add_option(
+        mountopt="dedup", action="store_true",
+        default=False,
+        help="Store chunks with the same contents only once, however many files they are cached for.  "
+             "Needs chunk_size, and like it only takes effect on a cache that is still empty")
+
+    server.parser.add_option(
+        mountopt="shared", action="store_true",
+        default=False,
+        help="Let other mounts (processes) use the same cache at the same time.  The cache stays "
+             "shared from then on")
+
+    server.parser.add_option(
+        mountopt="prewarm", metavar="SIZE",
+        default=None,
+        help="Log what is read and, at mount, fetch back up to this much of what was read most "
+             "(e.g. 2G) until something is opened, off if not given")
+
+    server.parser.add_option(
+        mountopt="small_file", metavar="SIZE",
+        default="64K",
+        help="Read files up to this size whole when they are opened, 0 turns it off [default: %default]")
+
+    server.parser.add_option(
+        mountopt="idle_handles", metavar="COUNT",
+        default="256",
+        help="How many handles of files nobody has open are kept ready for the next open [default: %default]")
+
+    server.parser.add_option(
+        mountopt="commit_interval", metavar="SECONDS",
+        default="1",
+        help="How often newly cached ranges are committed to metadata.db, 0 commits every one right away [default: %default]")
+
+    server.parser.add_option(
+        mountopt="cache_size", metavar="SIZE",
+        default=None,
+        help="Most space to use on the cache volume, unbounded if not given")
+
+    server.parser.add_option(
+        mountopt="ram_cache", metavar="SIZE",
+        default=None,
+        help="Keep up to this much of the hottest cached data in memory as well, off if not given")
+
+    server.parser.add_option(
+        mountopt="mmap_reads", metavar="SIZE",
+        default=None,
+        help="Serve cache hits of files whose cache file is at least this big (e.g. 4M) from a memory "
+             "mapping of it instead of reading it, off if not given")
+
+    server.parser.add_option(
+        mountopt="eviction", metavar="POLICY",
+        default="lru",
+        help="What to drop when the cache is full: lru, lfu or arc [default: %default]")
+
+    server.parser.add_option(
+        mountopt="meta_ttl", metavar="SECONDS",
+        default="30",
+        help="How long stat results, listings and symlinks from the target are trusted, 0 disables caching them [default: %default]")
+
+    server.parser.add_option(
+        mountopt="negative_ttl", metavar="SECONDS",
+        default="5",
+        help="How long a missing path is remembered as missing [default: %default]")
+
+    server.parser.add_option(
+        mountopt="verify", metavar="stat|sample",
+        default="stat",
+        help="How files are checked for changes made behind cachefs' back when opened: "
+             "their size and times, or those plus a hash of a few samples of their content [default: %default]")
+
+    server.parser.add_option(
+        mountopt="writeback", action="store_true",
+        default=False,
+        help="Acknowledge writes once they are in the cache and push them to the target in the background")
+
+    server.parser.add_option(
+        mountopt="writeback_delay", metavar="SECONDS",
+        default="1",
+        help="How long writes sit in the cache, to be coalesced, before being pushed [default: %default]")
+
+    server.parser.add_option(
+        mountopt="probe_interval", metavar="SECONDS",
+        default="5",
+        help="How often the target is checked for being reachable; while it isn't, fully cached files and "
+             "known metadata are served from the cache. 0 disables offline mode [default: %default]")
+
+    server.parser.add_option(
+        mountopt="probe_timeout", metavar="SECONDS",
+        default="2",
+        help="How long the target has to answer a check [default: %default]")
+
+    server.parser.add_option(
+        mountopt="trace", metavar="PATH",
+        default=None,
+        help="Time every operation, reporting latencies in the stats and writing a Chrome trace to PATH on unmount or SIGUSR1")
+
+    server.parse(values=server, errex=1)
+    setup(server)
+
     print 'Setting up CacheFS %s ...' % CACHE_FS_VERSION
     print '  Target       : %s' % server.target
     print '  Cache        : %s' % server.cache
+    print '  Readahead    : %s' % server.readahead_max
+    print '  Small files  : %s' % (server.small_file and 'read whole up to %d bytes' % server.small_file or 'off')
+    print '  Chunk size   : %s' % (FileDataCache.chunk_sizes.get(server.cache) or 'off (byte ranges)')
+    print '  Compression  : %s' % (FileDataCache.codecs.get(server.cache) or 'off')
+    print '  Dedup        : %s' % (FileDataCache.stores.get(server.cache) and 'on' or 'off')
+    print '  Shared       : %s' % (FileDataCache.shared.get(server.cache) and 'yes' or 'no')
+    print '  Cache size   : %s (%s)' % (server.cache_size or 'unbounded', server.eviction)
+    print '  RAM cache    : %s' % (server.ram_cache or 'off')
+    print '  mmap reads   : %s' % (server.cache in FileDataCache.mappings and 'files from %s' % server.mmap_reads or 'off')
+    print '  Prewarm      : %s' % (server.prewarm and 'up to %d bytes' % server.prewarm or 'off')
+    print '  Write-back   : %s' % (server.writeback and 'on' or 'off')
+    print '  Metadata TTL : %ss' % server.meta_ttl
+    print '  Offline mode : %s' % (server.probe_interval > 0 and 'on' or 'off')
+    print '  Trace        : %s' % (server.trace or 'off')
     print '  Mount Point  : %s' % os.path.abspath(server.fuse_args.mountpoint)
     print
     print 'Unmount through:'
     print '  fusermount -u %s' % server.fuse_args.mountpoint
     print
     print 'Done.'
+    # Connections can't be carried over the fork into the background
+    for db in getattr(thread_state, 'dbs', {}).values():
+        db.close()
+    thread_state.dbs = {}
     server.main()
 
+def warm(argv):
+    """
+    cachefs.py warm CACHE_DIR TARGET_PATH: pulls a tree from the target
+    straight into the cache, the same way reading it through the mount
+    would record it, only in large sequential chunks and in parallel.
+    """
+    import argparse
+    import fnmatch
+
+    parser = argparse.ArgumentParser(prog='cachefs.py warm',
+                                     description='Fill a cache with a tree from its target ahead of time')
+    parser.add_argument('cache_dir')
+    parser.add_argument('target_path', help='file or directory under the target to fetch')
+    parser.add_argument('--target', help='root of the target the cache mirrors, '
+                        'defaults to the one it was last mounted with')
+    parser.add_argument('--include', action='append', metavar='GLOB',
+                        help='only fetch files whose path under the target matches, may be repeated')
+    parser.add_argument('--max-bytes', default=None, metavar='SIZE',
+                        help='stop once this much has been fetched')
+    parser.add_argument('--fetch-size', default='4M', metavar='SIZE',
+                        help='how much to read from the target at a time')
+    parser.add_argument('--cache-size', default=None, metavar='SIZE',
+                        help='evict to keep the cache within this, '
+                        'defaults to the cache_size it was last mounted with')
+    parser.add_argument('-j', '--jobs', type=int, default=4)
+    args = parser.parse_args(argv)
+
+    cachebase = os.path.abspath(args.cache_dir)
+    if not os.path.isdir(cachebase):
+        os.makedirs(cachebase)
+    db = create_db(cachebase)
+    root = args.target
+    if root == None:
+        row = db.execute("SELECT value FROM settings WHERE name = 'target'").fetchone()
+        if row == None:
+            parser.error("%s has never been mounted, pass --target" % cachebase)
+        root = row[0]
+    root = os.path.abspath(root)
+    start = os.path.abspath(args.target_path)
+    if start != root and not start.startswith(root.rstrip('/') + '/'):
+        parser.error("%s is not under the target %s" % (start, root))
+    # A mount that doesn't share the cache would overwrite what is warmed
+    in_use = lock_cache(cachebase, shared_of(db, cachebase) != None)
+    if in_use == None:
+        parser.error("%s is mounted, only a cache mounted with shared can be warmed meanwhile" % cachebase)
+
+    files = []
+    if os.path.isdir(start):
+        tree = os.walk(start)
+    else:
+        tree = [(os.path.dirname(start), [], [os.path.basename(start)])]
+    for dirpath, dirnames, filenames in tree:
+        dirnames.sort()
+        for name in sorted(filenames):
+            full = os.path.join(dirpath, name)
+            path = '/' + os.path.relpath(full, root)
+            if args.include and not any(fnmatch.fnmatch(path.lstrip('/'), g) for g in args.include):
+                continue
+            st = os.lstat(full)
+            if stat.S_ISREG(st.st_mode):
+                files.append((path, full, st))
+
+    capacity, eviction = args.cache_size, 'lru'
+    for name, value in db.execute("SELECT name, value FROM settings WHERE name IN ('cache_size', 'eviction')"):
+        if name == 'eviction':
+            eviction = value
+        elif capacity == None:
+            capacity = value
+    if capacity:
+        evictor = Evictor(cachebase, parse_size(capacity), eviction)
+        evictor.load(db)
+        FileDataCache.evictors[cachebase] = evictor
+
+    budget = parse_size(args.max_bytes) if args.max_bytes else None
+    fetch_size = parse_size(args.fetch_size)
+    lock = threading.Lock()
+    queue = Queue.Queue()
+    for entry in files:
+        queue.put(entry)
+    progress = {'files': 0, 'bytes': 0, 'errors': 0}
+    began = time.time()
+
+    def worker():
+        while True:
+            with lock:
+                if budget != None and progress['bytes'] >= budget:
+                    return
+            try:
+                path, full, st = queue.get_nowait()
+            except Queue.Empty:
+                return
+            # Taken off the budget up front, so the other workers don't overshoot it
+            reserved = 0
+            try:
+                cache = FileDataCache(thread_db(cachebase), cachebase, path, os.O_RDWR, st.st_ino)
+                f = os.open(full, os.O_RDONLY)
+                try:
+                    st = os.fstat(f)
+                    cache.validate(st)
+                    end = st.st_size
+                    with lock:
+                        if budget != None:
+                            end = min(end, budget - progress['bytes'])
+                        progress['bytes'] += end
+                        reserved = end
+                    fetched = fetch_range(cache, f, 0, end, fetch_size, st.st_size)
+                    # Known, though already stale, so the file can be found offline
+                    with cache.db:
+                        cache.db.execute("INSERT OR IGNORE INTO metadata VALUES ('attr', ?, ?, 0)",
+                                         (path, MetadataCache.encode('attr', st)))
+                finally:
+                    os.close(f)
+                    cache.close()
+                with lock:
+                    progress['files'] += 1
+                    progress['bytes'] += fetched - reserved
+            except (OSError, IOError), e:
+                print >> sys.stderr, "warm: %s: %s" % (path, e)
+                with lock:
+                    progress['errors'] += 1
+                    progress['bytes'] -= reserved
+
+    def report(final = False):
+        elapsed = max(time.time() - began, 1e-6)
+        with lock:
+            line = "%d/%d files, %.1f MiB, %.1f MiB/s, %d errors" % (
+                progress['files'], len(files), progress['bytes'] / 1048576.0,
+                progress['bytes'] / 1048576.0 / elapsed, progress['errors'])
+        sys.stderr.write(("\r%s\n" if final else "\r%s") % line)
+        sys.stderr.flush()
+
+    threads = [threading.Thread(target=worker) for i in range(max(1, args.jobs))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        while t.is_alive():
+            t.join(1)
+            report()
+    report(final=True)
+    if capacity:
+        del FileDataCache.evictors[cachebase]
+    os.close(in_use)
+    return 1 if progress['errors'] else 0
+
 if __name__ == '__main__':
+    if sys.argv[1:2] == ['warm']:
+        sys.exit(warm(sys.argv[2:]))
     main()
@@ -1,9 +1,16 @@
 #!/usr/bin/env python
+import errno
+import json
 import random
+import signal
+import time
 import unittest
+import cachefs
 import shutil
+import threading
+import traceback
 import os
-from cachefs import FileDataCache, CacheMiss, create_db, open_db
+from cachefs import FileDataCache, BlockMap, ChunkMap, RamCache, AccessPattern, Readahead, Evictor, WriteBack, MetadataCache, BlockWriter, Stats, Tracer, TargetMonitor, CacheMiss, AccessLog, Prewarm, HandlePool, Mappings, create_db, store_of, whole_files_of, open_db, make_file_class, pread, pwrite, warm, STATS_PATH
 test_base = ".test_dir"
 cache_base = os.path.join(test_base, 'cache.db')
 try:
@@ -325,6 +332,1455 @@ class TestFileDataCache(unittest.TestCase):
         for i in range(1000):
             self.cache.read(0, 10)
 
+    def test_blocks_persisted(self):
+        inputs = (('', b'54321'),
+                  ('             ', b'54321'),
+                  ('    ', b'1234567890'))
+        for space, data in inputs:
+            self.cache.update(data, len(space))
+        self.cache.truncate(16)
+
+        self.assertEqual(BlockMap.load(self.db, self.cache.node_id).known(),
+                         self.cache.known_offsets())
+
+    def test_read_through_gaps(self):
+        target = b'abcdefghijklmnopqrstuvwxyz'
+        fetched = []
+        def fetch(size, offset):
+            fetched.append((offset, size))
+            buf = target[offset:offset + size]
+            return buf, offset + size >= len(target)
+
+        self.cache.update(target[5:10], 5)
+        self.cache.update(target[15:20], 15)
+
+        self.assertEqual(self.cache.read_through(20, 2, fetch), target[2:22])
+        self.assertEqual(fetched, [(2, 3), (10, 5), (20, 2)])
+        self.assertEqual(self.cache.known_offsets(), {2: 20})
+
+    def test_read_through_eof(self):
+        target = b'0123456789'
+        def fetch(size, offset):
+            buf = target[offset:offset + size]
+            return buf, offset + size >= len(target)
+
+        self.assertEqual(self.cache.read_through(100, 4, fetch), target[4:])
+        self.assertEqual(self.cache.read(100, 4), target[4:])
+
+    def test_truncate_grow(self):
+        target = b'0123456789'
+        def fetch(size, offset):
+            buf = target[offset:offset + size]
+            return buf, offset + size >= len(target)
+
+        self.assertEqual(self.cache.read_through(100, 0, fetch), target)
+        target += '\0' * 10
+        self.cache.truncate(20)
+        self.assertEqual(self.cache.read_through(100, 0, fetch), target)
+        self.assertEqual(BlockMap.load(self.db, self.cache.node_id).rows(), [(0, 20, True)])
+
+    def test_rename(self):
+        self.cache.update(b'0123456789', 0)
+        old_path, node_id = self.cache.path, self.cache.node_id
+        self.cache.rename(old_path + '_renamed')
+        self.cache.close()
+        self.assertRaises(CacheMiss, FileDataCache, self.db, cache_base, old_path)
+
+        cache = FileDataCache(self.db, cache_base, old_path + '_renamed')
+        self.assertEqual(cache.node_id, node_id)
+        def fetch(size, offset):
+            self.fail('fetched %d bytes at %d' % (size, offset))
+        self.assertEqual(cache.read_through(10, 0, fetch), b'0123456789')
+        self.assertEqual(cache.hits, 10)
+        cache.close()
+
+    def test_update_past_last(self):
+        def fetch(size, offset):
+            return '\0' * size, False
+
+        self.cache.update('x' * 100, 0, True)
+        self.cache.update('y' * 10, 200, True)
+        self.assertEqual(BlockMap.load(self.db, self.cache.node_id).rows(),
+                         [(0, 100, False), (200, 210, True)])
+        self.assertEqual(self.cache.read_through(4096, 0, fetch), 'x' * 100 + '\0' * 100 + 'y' * 10)
+
+    def test_concurrent_misses(self):
+        target = os.urandom(100000)
+        fetched = []
+        def fetch(size, offset):
+            fetched.append((offset, size))
+            time.sleep(0.1)
+            buf = target[offset:offset + size]
+            return buf, offset + size >= len(target)
+
+        results = []
+        def reader():
+            cache = FileDataCache(None, cache_base, self.cache.path, os.O_RDWR, self.cache.node_id)
+            results.append(cache.read_through(50000, 1000, fetch))
+        readers = [threading.Thread(target=reader) for i in range(8)]
+        for t in readers:
+            t.start()
+        for t in readers:
+            t.join()
+        self.assertEqual(results, [target[1000:51000]] * 8)
+        self.assertEqual(fetched, [(1000, 50000)])
+
+    def test_wait_for_prefetch(self):
+        # A readahead fetch of [0, 10) is under way
+        key = (cache_base, self.cache.node_id)
+        mine, done = FileDataCache.in_flight.claim(key, 0, 10)
+        self.assertTrue(mine)
+        fetched = []
+        def fetch(size, offset):
+            fetched.append((offset, size))
+            return b'x' * size, False
+        results = []
+        reader = threading.Thread(target=lambda: results.append(self.cache.read_through(4, 2, fetch)))
+        reader.start()
+        time.sleep(0.1)
+        self.assertEqual(results, [])
+        self.cache.update(b'0123456789', 0)
+        FileDataCache.in_flight.release(key, 0, 10, done)
+        reader.join()
+        self.assertEqual(results, [b'2345'])
+        self.assertEqual(fetched, [])
+        self.assertEqual(self.cache.waits, 1)
+
+    def test_validate(self):
+        filename = os.path.join(cache_base, self._testMethodName)
+        st = os.stat(filename)
+        self.assertFalse(self.cache.validate(st))
+        self.cache.update(b'0123456789', 0)
+        self.assertTrue(self.cache.validate(st))
+
+        with open(filename, 'ab') as f:
+            f.write(b'changed')
+        self.assertFalse(self.cache.validate(os.stat(filename)))
+        self.assertEqual(self.cache.known_offsets(), {})
+        self.assertTrue(self.cache.validate(os.stat(filename)))
+
+    def test_validate_sample(self):
+        filename = os.path.join(cache_base, self._testMethodName)
+        st = os.stat(filename)
+        self.cache.validate(st, 'a')
+        self.cache.update(b'0123456789', 0)
+        self.assertTrue(self.cache.validate(st, 'a'))
+        self.assertFalse(self.cache.validate(st, 'b'))
+        self.assertEqual(self.cache.known_offsets(), {})
+
+
+class TestBlockMap(unittest.TestCase):
+    def test_find(self):
+        blocks = BlockMap([(0, 10, False), (20, 30, True)])
+        self.assertEqual(blocks.find(0), (0, 10, False))
+        self.assertEqual(blocks.find(9), (0, 10, False))
+        self.assertEqual(blocks.find(10), (None, None, False))
+        self.assertEqual(blocks.find(25), (20, 10, True))
+        self.assertEqual(blocks.find(30), (None, None, False))
+
+    def test_add_touching(self):
+        blocks = BlockMap([(0, 10, False), (20, 30, True)])
+        merged, replaced = blocks.add(10, 20, False)
+        self.assertEqual(merged, (0, 30, True))
+        self.assertEqual(replaced, [0, 20])
+        self.assertEqual(len(blocks), 1)
+
+    def test_add_empty(self):
+        blocks = BlockMap()
+        self.assertEqual(blocks.add(5, 5, True), None)
+        self.assertEqual(len(blocks), 0)
+
+    def test_segments(self):
+        blocks = BlockMap([(5, 10, False), (20, 30, True)])
+        self.assertEqual(blocks.segments(0, 40),
+                         [(0, 5, False), (5, 5, True), (10, 10, False), (20, 10, True)])
+        self.assertEqual(blocks.segments(6, 8), [(6, 2, True)])
+
+    def test_truncate(self):
+        blocks = BlockMap([(0, 10, False), (20, 30, False)])
+        blocks.truncate(5)
+        self.assertEqual(blocks.known(), {0: 5})
+        self.assertEqual(blocks.find(0), (0, 5, True))
+
+    def test_truncate_grow(self):
+        blocks = BlockMap([(0, 10, True)])
+        blocks.truncate(20)
+        self.assertEqual(blocks.find(0), (0, 10, False))
+        self.assertEqual(blocks.segments(0, 20), [(0, 10, True), (10, 10, False)])
+
+    def test_add_past_last(self):
+        blocks = BlockMap([(0, 10, True)])
+        blocks.add(20, 30, True)
+        self.assertEqual(blocks.rows(), [(0, 10, False), (20, 30, True)])
+        self.assertEqual(blocks.segments(0, 40), [(0, 10, True), (10, 10, False), (20, 10, True)])
+
+class TestChunkMap(unittest.TestCase):
+    def test_add(self):
+        chunks = ChunkMap(16)
+        self.assertEqual(chunks.add(8, 40, False), True)
+        self.assertEqual(chunks.known(), {16: 16})
+        self.assertEqual(chunks.add(16, 32, False), None)
+        self.assertEqual(chunks.find(20), (16, 16, False))
+        self.assertEqual(chunks.find(8), (None, None, False))
+
+    def test_last(self):
+        chunks = ChunkMap(16)
+        chunks.add(0, 16, False)
+        chunks.add(16, 20, True)
+        self.assertEqual(chunks.find(3), (0, 20, True))
+        self.assertEqual(chunks.size, 20)
+        self.assertEqual(chunks.segments(0, 64), [(0, 20, True)])
+        # Growing past a known end without knowing the new one
+        chunks.add(20, 40, False)
+        self.assertEqual(chunks.known(), {0: 32})
+        self.assertEqual(chunks.segments(24, 64), [(24, 8, True), (32, 32, False)])
+
+    def test_segments(self):
+        chunks = ChunkMap(16)
+        chunks.add(16, 32, False)
+        chunks.add(48, 64, False)
+        self.assertEqual(chunks.segments(8, 56),
+                         [(8, 8, False), (16, 16, True), (32, 16, False), (48, 8, True)])
+
+    def test_truncate(self):
+        chunks = ChunkMap(16)
+        chunks.add(0, 64, False)
+        chunks.truncate(20)
+        self.assertEqual(chunks.known(), {0: 20})
+        self.assertEqual(chunks.find(0), (0, 20, True))
+        self.assertEqual(chunks.size, 20)
+        self.assertEqual(len(chunks), 2)
+
+    def test_align(self):
+        chunks = ChunkMap(16)
+        chunks.add(0, 16, False)
+        self.assertEqual(chunks.align(5, 17), (0, 32))
+        self.assertEqual(chunks.partial(4, 40), [(32, 48)])
+        self.assertEqual(chunks.partial(20, 24), [(16, 32)])
+
+    def test_persisted(self):
+        chunks = ChunkMap(16)
+        chunks.add(0, 32, False)
+        chunks.add(160, 170, True)
+        with db:
+            chunks.save(db, 12345)
+        loaded = ChunkMap.load(db, 12345, 16)
+        self.assertEqual(loaded.known(), {0: 32, 160: 10})
+        self.assertEqual(loaded.size, 42)
+
+    def test_stored_lengths(self):
+        chunks = ChunkMap(16, packed=True)
+        chunks.store(0, 5, False)
+        chunks.store(1, 16, True)
+        chunks.add(0, 32, False)
+        self.assertEqual(chunks.size, 21)
+        self.assertEqual(chunks.stored_length(1), (16, True, None))
+        with db:
+            chunks.save(db, 12346)
+        loaded = ChunkMap.load(db, 12346, 16, True)
+        self.assertEqual(loaded.stored_length(0), (5, False, None))
+        self.assertEqual(loaded.size, 21)
+        loaded.truncate(16)
+        self.assertEqual(loaded.stored_length(1), None)
+        self.assertEqual(loaded.size, 5)
+
+
+class CacheTestCase(unittest.TestCase):
+    """
+    Gives each test a cache of its own kind, made under test_base with
+    settings, and a target of target_size random bytes to fetch from.
+    """
+    name = None
+    settings = []
+    target_size = 3 * 4096
+
+    def setUp(self):
+        self.cachebase = os.path.abspath(os.path.join(test_base, self.name))
+        if not os.path.isdir(self.cachebase):
+            os.makedirs(self.cachebase)
+            created = create_db(self.cachebase)
+            with created:
+                created.executemany('INSERT INTO settings VALUES (?, ?)', self.settings)
+            created.close()
+        self.db = open_db(self.cachebase)
+        self.target = os.urandom(self.target_size)
+        self.fetched = []
+        self.node_id = hash(self._testMethodName) & 0xffffff
+
+    def open(self, name = None, db = None):
+        """A FileDataCache of the test's node, or of another one called name"""
+        if name == None:
+            path, node_id = '/' + self._testMethodName, self.node_id
+        else:
+            path, node_id = '/%s_%s' % (self._testMethodName, name), hash((self._testMethodName, name)) & 0xffffff
+        return FileDataCache(self.db if db == None else db, self.cachebase, path, os.O_RDWR, node_id)
+
+    def fetch(self, size, offset):
+        self.fetched.append((offset, size))
+        buf = self.target[offset:offset + size]
+        return buf, offset + len(buf) == len(self.target)
+
+
+class TestChunkedCache(CacheTestCase):
+    name = 'chunked'
+    settings = [('chunk_size', '4096')]
+    target_size = 3 * 4096 + 100
+
+    def setUp(self):
+        CacheTestCase.setUp(self)
+        self.cache = self.open()
+
+    def test_aligned_misses(self):
+        self.assertTrue(isinstance(self.cache.blocks, ChunkMap))
+        self.assertEqual(self.cache.read_through(10, 5000, self.fetch), self.target[5000:5010])
+        self.assertEqual(self.fetched, [(4096, 4096)])
+        self.assertEqual(self.cache.read_through(4000, 6000, self.fetch), self.target[6000:10000])
+        self.assertEqual(self.fetched, [(4096, 4096), (8192, 4096)])
+        self.assertEqual(self.cache.read_through(8192, 8192, self.fetch), self.target[8192:])
+        self.assertEqual(self.cache.known_offsets(), {4096: len(self.target) - 4096})
+
+    def test_fill(self):
+        self.cache.fill(4000, 4200, len(self.target), self.fetch)
+        self.assertEqual(self.fetched, [(0, 4096), (4096, 4096)])
+        self.cache.update('x' * 200, 4000)
+        self.assertEqual(self.cache.read(8192, 0), self.target[:4000] + 'x' * 200 + self.target[4200:8192])
+
+
+class TestCompressedCache(CacheTestCase):
+    name = 'compressed'
+    settings = [('chunk_size', '4096'), ('compression', 'zlib')]
+
+    def setUp(self):
+        CacheTestCase.setUp(self)
+        # A compressible chunk, one of noise and a short last one
+        self.target = 'abcd' * 1024 + os.urandom(4096) + 'x' * 100
+        self.cache = self.open()
+
+    def test_read_through(self):
+        self.assertEqual(self.cache.read_through(100, 4050, self.fetch), self.target[4050:4150])
+        self.assertEqual(self.cache.read_through(len(self.target), 0, self.fetch), self.target)
+        self.assertEqual(self.cache.read(10, 8190), self.target[8190:8200])
+        self.assertEqual(self.cache.blocks.stored_length(1), (4096, True, None))
+        self.assertFalse(self.cache.blocks.stored_length(0)[1])
+        self.assertTrue(self.cache.blocks.size < len(self.target) / 2 + 4096)
+
+    def test_update(self):
+        self.cache.read_through(len(self.target), 0, self.fetch)
+        self.cache.update('y' * 200, 4000)
+        expected = self.target[:4000] + 'y' * 200 + self.target[4200:]
+        self.assertEqual(self.cache.read(len(expected), 0), expected)
+        # A write into a chunk that isn't cached isn't either
+        other = FileDataCache(self.db, self.cachebase, '/other', os.O_RDWR, 4242)
+        other.update('z' * 10, 100)
+        self.assertEqual(other.known_offsets(), {})
+
+    def test_truncate(self):
+        self.cache.read_through(len(self.target), 0, self.fetch)
+        self.cache.truncate(4100)
+        self.assertEqual(self.cache.read(4100, 0), self.target[:4100])
+        self.cache.truncate(5000)
+        self.assertEqual(self.cache.read(5000, 0), self.target[:4100] + '\0' * 900)
+        self.assertEqual(self.cache.blocks.size, sum(self.cache.blocks.stored_length(chunk)[0] for chunk in (0, 1)))
+
+    def test_write_past_end(self):
+        self.cache.read_through(len(self.target), 0, self.fetch)
+        self.cache.update('z' * 100, 3 * 4096, True)
+        expected = self.target + '\0' * 3996 + 'z' * 100
+        self.assertEqual(self.cache.read(len(expected), 0), expected)
+
+    def test_corrupt_chunk(self):
+        self.cache.read_through(len(self.target), 0, self.fetch)
+        pwrite(self.cache.cache, 'junk', 0)
+        with self.assertRaises(IOError) as raised:
+            self.cache.read(10, 0)
+        self.assertEqual(raised.exception.errno, errno.EIO)
+
+    def test_rewrite_is_immediate(self):
+        writer = FileDataCache.block_writers[self.cachebase] = BlockWriter(self.cachebase, interval=60)
+        try:
+            self.cache.read_through(len(self.target), 0, self.fetch)
+            writer.flush(self.db)
+            self.cache.update('y' * 200, 4000)
+            # Not waiting for the writer: the bytes are in the file already
+            persisted = ChunkMap.load(self.db, self.cache.node_id, 4096, packed=True)
+            for chunk in (0, 1):
+                self.assertEqual(persisted.stored_length(chunk), self.cache.blocks.stored_length(chunk))
+        finally:
+            del FileDataCache.block_writers[self.cachebase]
+            writer.stop(self.db)
+
+
+class TestDedupCache(CacheTestCase):
+    name = 'dedup'
+    settings = [('chunk_size', '4096'), ('dedup', '1')]
+    target_size = 2 * 4096 + 100
+
+    def setUp(self):
+        CacheTestCase.setUp(self)
+        self.store = store_of(self.db, self.cachebase)
+
+    def refs(self):
+        return sorted(refs for refs, in self.db.execute('SELECT refs FROM chunk_store'))
+
+    def test_twins(self):
+        one, two = self.open('one'), self.open('two')
+        self.assertEqual(one.read_through(len(self.target), 0, self.fetch), self.target)
+        self.assertEqual(two.read_through(len(self.target), 0, self.fetch), self.target)
+        self.assertEqual(self.refs(), [2, 2, 2])
+        self.assertEqual(self.store.usage(self.db), (2 * len(self.target), len(self.target)))
+        digest = one.blocks.stored_length(0)[2]
+        self.assertTrue(os.path.exists(self.store.path(digest)))
+
+        one.update('x' * 10, 0)
+        self.assertEqual(two.read(len(self.target), 0), self.target)
+        self.assertEqual(one.read(20, 0), 'x' * 10 + self.target[10:20])
+        with self.db:
+            one.blocks.save(self.db, one.node_id)
+        self.assertEqual(self.refs(), [1, 1, 2, 2])
+
+        two.unlink()
+        one.truncate(0)
+        self.store.sweep(self.db)
+        self.assertEqual(self.refs(), [])
+        self.assertFalse(os.path.exists(self.store.path(digest)))
+
+    def test_persisted(self):
+        one = self.open('one')
+        one.read_through(len(self.target), 0, self.fetch)
+        with self.db:
+            one.blocks.save(self.db, one.node_id)
+        loaded = ChunkMap.load(self.db, one.node_id, 4096, True, True)
+        self.assertEqual(loaded.stored_length(2), one.blocks.stored_length(2))
+        self.assertEqual(loaded.size, len(self.target))
+        one.unlink()
+        self.assertEqual(self.refs(), [])
+
+
+class TestSharedCache(CacheTestCase):
+    name = 'shared'
+    settings = [('shared', '1')]
+
+    def setUp(self):
+        CacheTestCase.setUp(self)
+        self.cache = self.open()
+
+    def elsewhere(self, work):
+        """Runs work(db) in another process, the way another mount of the cache would"""
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                FileDataCache.block_maps = {}
+                FileDataCache.shared = {}
+                work(open_db(self.cachebase))
+                status = 0
+            except:
+                traceback.print_exc()
+            os._exit(status)
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+
+    def test_invalidated(self):
+        self.assertEqual(self.cache.read_through(len(self.target), 0, self.fetch), self.target)
+        self.elsewhere(lambda db: self.open(db=db).truncate(0))
+        self.assertEqual(self.cache.read_through(len(self.target), 0, self.fetch), self.target)
+        self.assertEqual(self.fetched, [(0, len(self.target))] * 2)
+
+    def test_not_cached_whole(self):
+        self.cache.read_through(len(self.target), 0, self.fetch)
+        self.cache.mark_whole(os.fstat(self.cache.cache))
+        self.assertEqual(whole_files_of(self.db, self.cachebase), {})
+
+    def test_sees_other_ranges(self):
+        reloads = self.cache.shared.reloads
+        self.elsewhere(lambda db: self.open(db=db).read_through(4096, 4096, self.fetch))
+        self.assertEqual(self.cache.read_through(4096, 4096, self.fetch), self.target[4096:8192])
+        self.assertEqual(self.fetched, [])
+        self.assertEqual(self.cache.shared.reloads, reloads + 1)
+
+        # Changes made here don't make it reload its own map
+        self.cache.update('x' * 10, 0)
+        self.assertEqual(self.cache.read(10, 0), 'x' * 10)
+        self.assertEqual(self.cache.shared.reloads, reloads + 1)
+
+    def test_unlinked_elsewhere(self):
+        other = self.open()
+        self.assertEqual(self.cache.read_through(len(self.target), 0, self.fetch), self.target)
+        fds = [self.cache.cache, other.cache]
+        self.elsewhere(lambda db: self.open(db=db).unlink())
+        self.assertEqual(self.cache.read_through(len(self.target), 0, self.fetch), self.target)
+        # The other handle finds the map reloaded already, its file still has to change
+        self.assertEqual(other.read_through(len(self.target), 0, self.fetch), self.target)
+        self.assertEqual([self.cache.cache, other.cache], fds)
+        for fd in fds:
+            self.assertEqual(os.fstat(fd).st_nlink, 1)
+        self.assertEqual(self.fetched, [(0, len(self.target))] * 2)
+
+    def test_locked_across_mounts(self):
+        shared = self.cache.shared
+        shared.acquire(self.node_id, True)
+        start = time.time()
+        def work(db):
+            other = self.open(db=db).shared
+            other.acquire(self.node_id)
+            assert time.time() - start >= 0.2
+            other.release(self.node_id)
+        threading.Timer(0.2, shared.release, (self.node_id,)).start()
+        self.elsewhere(work)
+
+        # Readers of one mount share the lock
+        shared.acquire(self.node_id)
+        shared.acquire(self.node_id)
+        shared.release(self.node_id)
+        shared.release(self.node_id)
+        self.assertEqual(shared.holders, {})
+
+
+class TestRamCache(unittest.TestCase):
+    def setUp(self):
+        self.ram = RamCache(3 * RamCache.block_size)
+        self.block = os.urandom(RamCache.block_size)
+
+    def test_lru(self):
+        for index in range(3):
+            self.ram.put(1, index, self.block, 0)
+        self.assertEqual(self.ram.get(1, 0), self.block)
+        self.ram.put(1, 3, self.block, 0)
+        self.assertEqual(self.ram.get(1, 1), None)
+        self.assertEqual(self.ram.get(1, 0), self.block)
+        self.assertEqual(self.ram.used, 3 * RamCache.block_size)
+
+    def test_write(self):
+        self.ram.put(1, 0, b'0123456789', 0)
+        self.ram.write(1, 8, b'abcd')
+        self.assertEqual(self.ram.get(1, 0), b'01234567abcd')
+        self.ram.write(1, 20, b'x')
+        self.assertEqual(self.ram.get(1, 0), None)
+        self.ram.write(1, RamCache.block_size, self.block)
+        self.assertEqual(self.ram.get(1, 1), self.block)
+
+    def test_stale_put(self):
+        generation = self.ram.generation(1)
+        self.ram.write(1, 0, b'new')
+        self.ram.put(1, 0, b'old', generation)
+        self.assertEqual(self.ram.get(1, 0), None)
+
+    def test_truncate(self):
+        self.ram.put(1, 0, self.block, 0)
+        self.ram.put(1, 1, self.block, 0)
+        self.ram.truncate(1, 100)
+        self.assertEqual(self.ram.get(1, 0), self.block[:100])
+        self.assertEqual(self.ram.get(1, 1), None)
+        self.ram.forget(1)
+        self.assertEqual(self.ram.used, 0)
+
+
+class TestRamTier(CacheTestCase):
+    name = 'ram'
+
+    def setUp(self):
+        CacheTestCase.setUp(self)
+        self.ram = FileDataCache.ram_caches[self.cachebase] = RamCache(1024 * 1024)
+        self.cache = self.open()
+
+    def tearDown(self):
+        del FileDataCache.ram_caches[self.cachebase]
+
+    def test_hits_from_memory(self):
+        data = os.urandom(100000)
+        self.cache.update(data, 0, True)
+        self.assertEqual(self.cache.read_through(1000, 70000, None), data[70000:71000])
+        self.assertEqual(self.ram.get(self.cache.node_id, 1), data[RamCache.block_size:])
+        # Served from memory even once the cache file is gone
+        os.ftruncate(self.cache.cache, 0)
+        self.assertEqual(self.cache.read_through(100, 99950, None), data[99950:])
+
+    def test_consistent(self):
+        self.cache.update(b'0123456789', 0, True)
+        self.assertEqual(self.cache.read_through(10, 0, None), b'0123456789')
+        self.cache.update(b'ab', 4, False)
+        self.assertEqual(self.cache.read_through(10, 0, None), b'0123ab6789')
+        self.cache.truncate(5)
+        self.assertEqual(self.cache.read_through(10, 0, None), b'0123a')
+        self.cache.unlink()
+        self.assertEqual(self.ram.used, 0)
+
+
+class TestMappings(CacheTestCase):
+    name = 'mapped'
+    target_size = 4 * 4096
+
+    def setUp(self):
+        CacheTestCase.setUp(self)
+        self.mappings = FileDataCache.mappings[self.cachebase] = Mappings(8192, capacity = 2)
+
+    def tearDown(self):
+        del FileDataCache.mappings[self.cachebase]
+
+    def test_hits(self):
+        cache = self.open('one')
+        cache.update(self.target[:4096], 0)
+        # Too small to be worth it
+        self.assertEqual(cache.read(100, 10), self.target[10:110])
+        self.assertEqual(cache.blocks.mapped, None)
+
+        cache.update(self.target[4096:12288], 4096)
+        self.assertEqual(cache.read(8192, 100), self.target[100:8292])
+        self.assertEqual(len(cache.blocks.mapped), 12288)
+        # Grown since, mapped again
+        cache.update(self.target[12288:], 12288)
+        self.assertEqual(cache.read(4096, 12288), self.target[12288:])
+        self.assertEqual(len(cache.blocks.mapped), len(self.target))
+        self.assertEqual(self.mappings.mapped, 2)
+
+    def test_truncated(self):
+        cache = self.open('one')
+        cache.update(self.target, 0, True)
+        self.assertEqual(cache.read(4096, 8192), self.target[8192:12288])
+        cache.truncate(100)
+        self.assertEqual(cache.blocks.mapped, None)
+        self.assertEqual(cache.read(100, 0), self.target[:100])
+        self.assertEqual(cache.blocks.mapped, None)
+        self.assertRaises(CacheMiss, cache.read, 4096, 8192)
+
+    def test_capacity(self):
+        caches = [self.open(name) for name in ('one', 'two', 'three')]
+        for cache in caches:
+            cache.update(self.target, 0, True)
+            self.assertEqual(cache.read(10, 9000), self.target[9000:9010])
+        self.assertEqual([cache.blocks.mapped != None for cache in caches], [False, True, True])
+        self.assertEqual(self.mappings.count(), 2)
+        self.assertEqual(caches[0].read(10, 9000), self.target[9000:9010])
+
+
+class TestHandlePool(unittest.TestCase):
+    def setUp(self):
+        self.cachebase = os.path.abspath(cache_base)
+        self.pool = HandlePool(2)
+
+    def test_shared(self):
+        one = self.pool.acquire(self.cachebase, '/pool/a', 101)
+        two = self.pool.acquire(self.cachebase, '/pool/a', 101)
+        self.assertTrue(one is two)
+        self.pool.release(one)
+        self.assertEqual(self.pool.counts(), (1, 0))
+        self.pool.release(two)
+        self.assertEqual(self.pool.counts(), (0, 1))
+        self.assertNotEqual(one.cache, None)
+        self.assertTrue(self.pool.acquire(self.cachebase, '/pool/a', 101) is one)
+        self.assertEqual(self.pool.reused, 2)
+        # Another inode at the same path is another handle
+        self.assertFalse(self.pool.acquire(self.cachebase, '/pool/a', 102) is one)
+
+    def test_idle_bound(self):
+        handles = [self.pool.acquire(self.cachebase, '/pool/%d' % n, 200 + n) for n in range(3)]
+        for cache in handles:
+            self.pool.release(cache)
+        self.assertEqual(self.pool.counts(), (0, 2))
+        self.assertEqual(handles[0].cache, None)
+        self.assertNotEqual(handles[2].cache, None)
+        self.pool.clear()
+        self.assertEqual(handles[2].cache, None)
+
+    def test_forget(self):
+        opened = self.pool.acquire(self.cachebase, '/pool/dir/a', 301)
+        idle = self.pool.acquire(self.cachebase, '/pool/dir/b', 302)
+        self.pool.release(idle)
+        self.pool.forget(self.cachebase, '/pool/dir', tree=True)
+        self.assertEqual(idle.cache, None)
+        self.assertNotEqual(opened.cache, None)
+        self.assertFalse(self.pool.acquire(self.cachebase, '/pool/dir/a', 301) is opened)
+        self.pool.release(opened)
+        self.assertEqual(opened.cache, None)
+
+    def test_maps_follow_handles(self):
+        key = (self.cachebase, 401)
+        cache = self.pool.acquire(self.cachebase, '/pool/map', 401)
+        cache.read_through(10, 0, lambda size, offset: (b'0123456789', True))
+        other = self.pool.acquire(self.cachebase, '/pool/map2', 401)
+        self.assertTrue(other.blocks is cache.blocks)
+        self.pool.release(other)
+        self.pool.release(cache)
+        self.pool.clear()
+        self.assertEqual(other.cache, None)
+        self.assertFalse(key in FileDataCache.block_maps)
+
+        # Loaded again, from the database
+        cache = self.pool.acquire(self.cachebase, '/pool/map', 401)
+        self.assertEqual(cache.read(10, 0), b'0123456789')
+        self.assertEqual(cache.hits, 10)
+        self.pool.release(cache)
+        self.pool.clear()
+        self.assertFalse(key in FileDataCache.block_maps)
+
+
+class TestReadahead(unittest.TestCase):
+    def test_pattern_sequential(self):
+        pattern = AccessPattern(16, 64)
+        self.assertEqual(pattern.access(0, 4), None)
+        self.assertEqual(pattern.access(4, 4), (8, 16))
+        self.assertEqual(pattern.access(8, 4), None)
+        self.assertEqual(pattern.access(12, 4), None)
+        self.assertEqual(pattern.access(16, 4), (24, 28))
+        self.assertEqual(pattern.access(20, 4), None)
+
+    def test_pattern_random(self):
+        pattern = AccessPattern(16, 64)
+        self.assertEqual(pattern.access(0, 4), None)
+        self.assertEqual(pattern.access(100, 4), None)
+        self.assertEqual(pattern.access(50, 4), None)
+        self.assertEqual(pattern.window, 0)
+
+    def test_prefetch(self):
+        target = os.path.join(cache_base, self._testMethodName)
+        data = os.urandom(3 * Readahead.chunk_size + 10)
+        with open(target, 'wb') as f:
+            f.write(data)
+        node_id = os.stat(target).st_ino
+        path = os.path.join(test_base, self._testMethodName)
+
+        readahead = Readahead(cache_base, 16, 64, 2 * len(data), threads=1)
+        self.assertTrue(readahead.submit(target, path, node_id, 0, len(data) + 100))
+        self.assertFalse(readahead.submit(target, path, node_id, 0, len(data)))
+        readahead.wait()
+        readahead.stop()
+
+        cache = FileDataCache(db, cache_base, path, os.O_RDWR, node_id)
+        self.assertEqual(cache.known_offsets(), {0: len(data)})
+        self.assertEqual(cache.read(len(data) + 100, 0), data)
+
+class TestEvictor(unittest.TestCase):
+    def make_cache(self, name):
+        filename = os.path.join(cache_base, name)
+        open(filename, 'a+').close()
+        return FileDataCache(db, cache_base, os.path.join(test_base, name),
+                             os.O_RDWR, os.stat(filename).st_ino)
+
+    def setUp(self):
+        self.evictor = FileDataCache.evictors[cache_base] = Evictor(cache_base, 25, self.policy)
+
+    def tearDown(self):
+        del FileDataCache.evictors[cache_base]
+
+    policy = 'lru'
+
+    def fill(self):
+        a, b, c = [self.make_cache(self._testMethodName + n) for n in 'abc']
+        a.update(b'0123456789', 0)
+        b.update(b'0123456789', 0)
+        a.read_through(10, 0, None)
+        c.update(b'0123456789', 0)
+        return a, b, c
+
+    def test_capacity(self):
+        a, b, c = self.fill()
+        self.assertEqual(self.evictor.used, 20)
+        self.assertEqual(self.evictor.evictions, 1)
+        self.assertEqual(b.known_offsets(), {})
+        self.assertEqual(os.fstat(b.cache).st_size, 0)
+        self.assertEqual(BlockMap.load(db, b.node_id).known(), {})
+        self.assertEqual(a.read(10, 0), b'0123456789')
+
+    def test_oversized_node(self):
+        a = self.make_cache(self._testMethodName)
+        a.update(b'x' * 30, 0)
+        self.assertEqual(a.known_offsets(), {})
+        self.assertEqual(self.evictor.used, 0)
+
+
+    def test_dropped_while_read(self):
+        a = self.make_cache(self._testMethodName)
+        a.update(b'0123456789', 0, True)
+        read_cached = a.__read_cached__
+        def dropped_first(*args):
+            self.evictor.drop(db, a.node_id)
+            return read_cached(*args)
+        a.__read_cached__ = dropped_first
+        fetched = []
+        def fetch(size, offset):
+            fetched.append((offset, size))
+            return b'0123456789'[offset:offset + size], offset + size >= 10
+        self.assertEqual(a.read_through(10, 0, fetch), b'0123456789')
+        self.assertEqual(fetched, [(0, 10)])
+
+
+class TestEvictorLFU(TestEvictor):
+    policy = 'lfu'
+
+
+class TestEvictorARC(TestEvictor):
+    policy = 'arc'
+
+class TestWriteBack(unittest.TestCase):
+    def setUp(self):
+        self.target = os.path.join(test_base, 'target')
+        try:
+            os.makedirs(self.target)
+        except OSError:
+            pass
+        self.path = '/' + self._testMethodName
+        self.target_file = os.path.join(self.target, self._testMethodName)
+        with open(self.target_file, 'wb') as f:
+            f.write(b'0123456789')
+        self.node_id = os.stat(self.target_file).st_ino
+        self.cache = FileDataCache(db, cache_base, self.path, os.O_RDWR, self.node_id)
+        self.writeback = WriteBack(cache_base, self.target, delay=60, threads=1)
+
+    def write(self, buf, offset):
+        self.cache.update(buf, offset)
+        self.writeback.record(db, self.node_id, self.path, offset, len(buf))
+
+    def target_data(self):
+        with open(self.target_file, 'rb') as f:
+            return f.read()
+
+    def test_flush(self):
+        self.write(b'abc', 2)
+        self.write(b'xyz', 12)
+        self.assertEqual(self.target_data(), b'0123456789')
+        self.assertEqual(self.writeback.extent(self.node_id), 15)
+
+        self.writeback.flush(db, self.node_id)
+        self.assertEqual(self.target_data(), b'01abc56789\0\0xyz')
+        self.assertFalse(self.writeback.is_dirty(self.node_id))
+        self.assertEqual(db.execute('SELECT COUNT(*) FROM dirty WHERE node_id = ?',
+                                    (self.node_id,)).fetchone()[0], 0)
+
+    def test_truncate(self):
+        self.write(b'abc', 2)
+        self.write(b'xyz', 12)
+        self.writeback.truncate(db, self.node_id, 4)
+        self.writeback.flush(db, self.node_id)
+        self.assertEqual(self.target_data(), b'01ab456789')
+
+    def test_replay(self):
+        self.write(b'abcd', 4)
+        replay = WriteBack(cache_base, self.target, delay=0, threads=1)
+        replay.load(db)
+        replay.stop(db)
+        self.assertEqual(self.target_data(), b'0123abcd89')
+
+    def test_replay_deferred_blocks(self):
+        writer = FileDataCache.block_writers[cache_base] = BlockWriter(cache_base, interval=60)
+        try:
+            self.cache.update(b'abcd', 4)
+            self.writeback.record(db, self.node_id, self.path, 4, 4, self.cache.blocks)
+        finally:
+            # What a crash leaves: the rows, no map in memory
+            del FileDataCache.block_writers[cache_base]
+            writer.discard(self.node_id)
+            writer.stop(db)
+        FileDataCache.block_maps.pop((cache_base, self.node_id))
+        replay = WriteBack(cache_base, self.target, delay=0, threads=1)
+        replay.load(db)
+        replay.stop(db)
+        self.assertEqual(self.target_data(), b'0123abcd89')
+
+    def test_failing_node_holds_up_nothing(self):
+        writeback = WriteBack(cache_base, self.target, delay=0.01, threads=1)
+        writeback.max_delay = 60
+        # Backed off to max_delay at its first failure
+        writeback.failures[self.node_id + 1] = 20
+        # Gone from the target, so every push fails
+        missing = self.path + '_missing'
+        other = FileDataCache(db, cache_base, missing, os.O_RDWR, self.node_id + 1)
+        other.update(b'abcd', 0)
+        writeback.record(db, self.node_id + 1, missing, 0, 4)
+        for i in range(100):
+            if writeback.failures[self.node_id + 1] > 20:
+                break
+            time.sleep(0.01)
+        self.cache.update(b'abcd', 4)
+        writeback.record(db, self.node_id, self.path, 4, 4)
+        for i in range(100):
+            if self.target_data() != b'0123456789':
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.target_data(), b'0123abcd89')
+
+        start = time.time()
+        writeback.stop(db)
+        self.assertTrue(time.time() - start < 5)
+        self.assertTrue(writeback.is_dirty(self.node_id + 1))
+        self.assertEqual(db.execute('SELECT COUNT(*) FROM dirty WHERE node_id = ?',
+                                    (self.node_id + 1,)).fetchone()[0], 1)
+
+    def test_uncached_is_abandoned(self):
+        writeback = WriteBack(cache_base, self.target, delay=0, threads=1)
+        writeback.record(db, self.node_id, self.path, 4, 4)
+        for i in range(100):
+            if not writeback.is_dirty(self.node_id):
+                break
+            time.sleep(0.01)
+        writeback.stop(db)
+        self.assertFalse(writeback.is_dirty(self.node_id))
+        self.assertEqual(writeback.lost, 4)
+        self.assertEqual(self.target_data(), b'0123456789')
+
+class TestMetadataCache(unittest.TestCase):
+    def setUp(self):
+        self.metadata = MetadataCache(60, 60)
+        self.path = '/' + self._testMethodName
+
+    def test_attr(self):
+        self.assertEqual(self.metadata.get('attr', self.path), (False, None))
+        st = os.stat(cache_base)
+        self.metadata.put(db, 'attr', self.path, st)
+        found, cached = self.metadata.get('attr', self.path)
+        self.assertTrue(found)
+        self.assertEqual(cached.st_ino, st.st_ino)
+        self.assertEqual(cached.st_mtime, st.st_mtime)
+
+    def test_persisted(self):
+        self.metadata.put(db, 'dir', self.path, ['a', 'b\xff'])
+        self.metadata.put(db, 'link', self.path + '/a', '../b')
+        self.metadata.put(db, 'attr', self.path + '/c', None)
+
+        reloaded = MetadataCache(60, 60)
+        reloaded.load(db)
+        self.assertEqual(reloaded.get('dir', self.path), (True, ['a', 'b\xff']))
+        self.assertEqual(reloaded.get('link', self.path + '/a'), (True, '../b'))
+        self.assertEqual(reloaded.get('attr', self.path + '/c'), (True, None))
+
+    def test_expires(self):
+        metadata = MetadataCache(60, -1)
+        metadata.put(db, 'attr', self.path, None)
+        self.assertEqual(metadata.get('attr', self.path), (False, None))
+
+    def test_stale(self):
+        metadata = MetadataCache(-1, -1)
+        metadata.put(db, 'dir', self.path, ['a'])
+        metadata.put(db, 'attr', self.path + '/b', None)
+        self.assertEqual(metadata.get('dir', self.path), (False, None))
+        self.assertEqual(metadata.get('dir', self.path, stale=True), (True, ['a']))
+
+        # Only what is known to exist outlives a remount
+        reloaded = MetadataCache(60, 60)
+        reloaded.load(db)
+        self.assertEqual(reloaded.get('dir', self.path, stale=True), (True, ['a']))
+        self.assertEqual(reloaded.get('attr', self.path + '/b', stale=True), (False, None))
+
+    def test_invalidate(self):
+        self.metadata.put(db, 'dir', self.path, ['a'])
+        self.metadata.put(db, 'attr', self.path + '/a', None)
+        self.metadata.put(db, 'dir', self.path + '/a', [])
+        self.metadata.put(db, 'dir', self.path + '/a/b', [])
+
+        self.metadata.invalidate(db, self.path + '/a')
+        self.assertEqual(self.metadata.get('dir', self.path), (False, None))
+        self.assertEqual(self.metadata.get('attr', self.path + '/a'), (False, None))
+        self.assertEqual(self.metadata.get('dir', self.path + '/a/b'), (True, []))
+
+        self.metadata.invalidate(db, self.path + '/a', tree=True)
+        self.assertEqual(self.metadata.get('dir', self.path + '/a/b'), (False, None))
+
+        reloaded = MetadataCache(60, 60)
+        reloaded.load(db)
+        self.assertEqual(reloaded.get('dir', self.path + '/a/b'), (False, None))
+
+class TestTargetMonitor(unittest.TestCase):
+    def setUp(self):
+        self.monitor = TargetMonitor(os.path.abspath(test_base), interval=60, timeout=0.2)
+
+    def tearDown(self):
+        self.monitor.stop()
+
+    def test_probe(self):
+        self.assertTrue(self.monitor.probe())
+        self.monitor.target = os.path.join(self.monitor.target, 'missing')
+        self.assertFalse(self.monitor.probe())
+        self.assertFalse(self.monitor.online)
+        self.assertEqual(self.monitor.transitions, 1)
+
+    def test_hung(self):
+        self.monitor.check = lambda: time.sleep(1)
+        start = time.time()
+        self.assertFalse(self.monitor.probe())
+        self.assertTrue(time.time() - start < 0.5)
+
+    def test_failed(self):
+        self.assertFalse(self.monitor.failed(OSError(errno.ENOENT, 'gone')))
+        self.assertTrue(self.monitor.online)
+        self.assertTrue(self.monitor.failed(OSError(errno.ENOTCONN, 'unreachable')))
+        self.assertFalse(self.monitor.online)
+        self.assertTrue(self.monitor.probe())
+
+class TestBlockWriter(unittest.TestCase):
+    def setUp(self):
+        filename = os.path.join(cache_base, self._testMethodName)
+        open(filename, 'a+').close()
+        self.writer = FileDataCache.block_writers[cache_base] = BlockWriter(cache_base, interval=60)
+        self.cache = FileDataCache(db, cache_base, os.path.join(test_base, self._testMethodName),
+                                   os.O_RDWR, os.stat(filename).st_ino)
+
+    def tearDown(self):
+        del FileDataCache.block_writers[cache_base]
+        self.writer.stop(db)
+
+    def persisted(self):
+        return BlockMap.load(db, self.cache.node_id).known()
+
+    def test_deferred(self):
+        for i in range(10):
+            self.cache.update(b'0123456789', i * 10)
+        self.assertEqual(self.persisted(), {})
+        self.writer.flush(db)
+        self.assertEqual(self.persisted(), {0: 100})
+        self.assertEqual(self.writer.commits, 1)
+
+    def test_shrink_is_immediate(self):
+        self.cache.update(b'0123456789', 0)
+        self.writer.flush(db)
+        self.cache.update(b'0123456789', 10)
+        self.cache.truncate(5)
+        self.assertEqual(self.persisted(), {0: 5})
+        self.writer.flush(db)
+        self.assertEqual(self.persisted(), {0: 5})
+
+    def test_threshold(self):
+        writer = BlockWriter(cache_base, interval=60, max_pending=5)
+        FileDataCache.block_writers[cache_base] = writer
+        for i in range(5):
+            self.cache.update(b'0123456789', i * 20)
+        for i in range(100):
+            if writer.commits:
+                break
+            time.sleep(0.01)
+        writer.stop(db)
+        self.assertEqual(writer.commits, 1)
+        self.assertEqual(len(self.persisted()), 5)
+
+class TestTracer(unittest.TestCase):
+    def test_latencies(self):
+        tracer = Tracer()
+        for i in range(980):
+            tracer.record('fs.getattr', 0, 0.0001)
+        for i in range(20):
+            tracer.record('fs.getattr', 0, 0.1)
+        latencies = tracer.latencies()['fs.getattr']
+        self.assertEqual(latencies['count'], 1000)
+        self.assertTrue(0.1 <= latencies['p50_ms'] < 0.13, latencies)
+        self.assertTrue(100 <= latencies['p99_ms'] < 130, latencies)
+        self.assertTrue(100 <= latencies['p999_ms'] < 130, latencies)
+
+    def test_dump(self):
+        tracer = Tracer(max_events=2)
+        for name in ('db.lookup', 'cache.read', 'target.read'):
+            with tracer.span(name):
+                pass
+        path = os.path.join(test_base, 'trace.json')
+        tracer.dump(path)
+        with open(path) as f:
+            trace = json.load(f)
+        self.assertEqual([(e['name'], e['cat'], e['ph']) for e in trace['traceEvents']],
+                         [('cache.read', 'cache', 'X'), ('target.read', 'target', 'X')])
+        self.assertEqual(trace['otherData']['latencies']['db.lookup']['count'], 1)
+
+
+class TestFS(object):
+    """The parts of CacheFS that CacheFile relies on"""
+    def __init__(self, target, cache):
+        self.target = target
+        self.cache = cache
+        self.readahead = None
+        self.writeback = None
+        self.verify = 'stat'
+        self.stats = Stats()
+        self.monitor = None
+        self.access_log = None
+        self.prewarm = None
+        self.small_file = 0
+        self.file_class = make_file_class(self)
+
+    def render_stats(self):
+        return json.dumps(self.stats.snapshot())
+
+    def _physical_path(self, path):
+        return os.path.join(self.target, path.lstrip('/'))
+
+    def start_writing(self, path):
+        pass
+
+    def stop_writing(self, path):
+        pass
+
+
+class TestCacheFile(unittest.TestCase):
+    def setUp(self):
+        self.fs = TestFS(os.path.join(test_base, 'target'), os.path.abspath(cache_base))
+        try:
+            os.makedirs(self.fs.target)
+        except OSError:
+            pass
+        self.path = '/' + self._testMethodName
+        with open(self.fs._physical_path(self.path), 'wb') as f:
+            f.write(b'0123456789')
+
+    def test_pread_pwrite(self):
+        f = os.open(self.fs._physical_path(self.path), os.O_RDWR)
+        try:
+            self.assertEqual(pwrite(f, b'ab', 3), 2)
+            self.assertEqual(pread(f, 4, 2), b'2ab5')
+            self.assertEqual(pread(f, 4, 8), b'89')
+            self.assertEqual(os.lseek(f, 0, os.SEEK_CUR), 0)
+        finally:
+            os.close(f)
+
+    def test_eof_from_size(self):
+        f = self.fs.file_class(self.path, os.O_RDONLY)
+        self.assertEqual(f.read(10, 0), b'0123456789')
+        self.assertEqual(f.data_cache.misses, 10)
+        self.assertEqual(f.read(4096, 0), b'0123456789')
+        self.assertEqual(f.read(4096, 6), b'6789')
+        self.assertEqual(f.data_cache.misses, 10)
+        f.release(0)
+
+    def test_write_through(self):
+        f = self.fs.file_class(self.path, os.O_RDWR)
+        self.assertEqual(f.write(b'abc', 8), 3)
+        self.assertEqual(f.read(4096, 8), b'abc')
+        self.assertEqual(f.data_cache.misses, 0)
+        f.release(0)
+        with open(self.fs._physical_path(self.path), 'rb') as t:
+            self.assertEqual(t.read(), b'01234567abc')
+
+    def test_stats(self):
+        f = self.fs.file_class(self.path, os.O_RDWR)
+        f.read(4, 0)
+        f.read(8, 2)
+        f.write(b'ab', 0)
+        f.release(0)
+        stats = self.fs.stats.snapshot()
+        self.assertEqual(stats['read'], {'ops': 2, 'hit_bytes': 2, 'miss_bytes': 10})
+        self.assertEqual(stats['write'], {'ops': 1, 'bytes': 2})
+        self.assertEqual(stats['target'], {'read_bytes': 10, 'written_bytes': 2})
+
+    def test_stats_file(self):
+        self.fs.stats.add('read.ops', 3)
+        f = self.fs.file_class(STATS_PATH, os.O_RDONLY)
+        self.assertTrue(f.direct_io)
+        self.assertEqual(json.loads(f.read(4096, 0)), {'read': {'ops': 3}})
+        self.assertEqual(f.read(4096, 4096), b'')
+        f.release(0)
+        with self.assertRaises(OSError) as e:
+            self.fs.file_class(STATS_PATH, os.O_WRONLY)
+        self.assertEqual(e.exception.errno, errno.EACCES)
+
+    def test_offline(self):
+        other = self.path + '.partial'
+        with open(self.fs._physical_path(other), 'wb') as f:
+            f.write(b'0123456789')
+        f = self.fs.file_class(self.path, os.O_RDONLY)
+        f.read(4096, 0)
+        f.release(0)
+        f = self.fs.file_class(other, os.O_RDONLY)
+        f.read(4, 0)
+        f.release(0)
+
+        self.fs.monitor = TargetMonitor(self.fs.target, interval=60)
+        self.fs.monitor.online = False
+        try:
+            os.rename(self.fs.target, self.fs.target + '.away')
+            try:
+                f = self.fs.file_class(self.path, os.O_RDONLY)
+                self.assertEqual(f.read(4096, 0), b'0123456789')
+                self.assertEqual(f.read(4096, 10), b'')
+                f.release(0)
+                for path, flags, err in ((self.path, os.O_RDWR, errno.EROFS),
+                                         (other, os.O_RDONLY, errno.ENOTCONN),
+                                         ('/never_seen', os.O_RDONLY, errno.ENOTCONN)):
+                    with self.assertRaises(OSError) as e:
+                        self.fs.file_class(path, flags)
+                    self.assertEqual(e.exception.errno, err)
+            finally:
+                os.rename(self.fs.target + '.away', self.fs.target)
+        finally:
+            self.fs.monitor.stop()
+            self.fs.monitor = None
+
+    def test_traced(self):
+        cachefs.tracer = Tracer()
+        try:
+            f = self.fs.file_class(self.path, os.O_RDONLY)
+            f.read(4, 0)
+            f.read(4, 0)
+            f.release(0)
+            latencies = cachefs.tracer.latencies()
+        finally:
+            cachefs.tracer = None
+        self.assertEqual(latencies['file.read']['count'], 2)
+        self.assertEqual(latencies['target.read']['count'], 1)
+        self.assertEqual(latencies['cache.read']['count'], 1)
+        for name in ('file.open', 'file.release', 'db.lookup', 'block.merge'):
+            self.assertTrue(name in latencies, name)
+
+    def test_small_file(self):
+        self.fs.small_file = 64
+        try:
+            f = self.fs.file_class(self.path, os.O_RDONLY)
+            self.assertEqual(f.read(4096, 4), b'456789')
+            f.release(0)
+            self.assertEqual(self.fs.stats.snapshot()['target']['read_bytes'], 10)
+
+            # Cached whole, read back without going to the target or the database
+            cachefs.tracer = Tracer()
+            try:
+                f = self.fs.file_class(self.path, os.O_RDONLY)
+                self.assertEqual(f.read(4, 0), b'0123')
+                f.release(0)
+                latencies = cachefs.tracer.latencies()
+            finally:
+                cachefs.tracer = None
+            self.assertEqual(f.f, None)
+            self.assertEqual(sorted(latencies), ['cache.read', 'file.open', 'file.read', 'file.release'])
+            self.assertEqual(self.fs.stats.snapshot()['target']['read_bytes'], 10)
+
+            # A write through the mount drops the flag
+            f = self.fs.file_class(self.path, os.O_RDWR)
+            f.write(b'ab', 0)
+            f.release(0)
+            st = os.stat(self.fs._physical_path(self.path))
+            self.assertEqual(FileDataCache.read_whole(self.fs.cache, self.path, st), None)
+            f = self.fs.file_class(self.path, os.O_RDONLY)
+            self.assertEqual(f.read(10, 0), b'ab23456789')
+            f.release(0)
+            self.assertEqual(FileDataCache.read_whole(self.fs.cache, self.path, st), b'ab23456789')
+            # Counted once each, though the pooled handle saw both opens
+            read = self.fs.stats.snapshot()['read']
+            self.assertEqual((read['hit_bytes'], read['miss_bytes']), (10, 10))
+        finally:
+            self.fs.small_file = 0
+
+    def test_writes_skip_block_maps_lock(self):
+        f = self.fs.file_class(self.path, os.O_RDWR)
+        try:
+            f.write(b'ab', 0)
+            done = threading.Event()
+            def write():
+                f.write(b'cd', 2)
+                done.set()
+            # Opening other files holds it, writes to this one shouldn't wait for them
+            with FileDataCache.block_maps_lock:
+                t = threading.Thread(target=write)
+                t.start()
+                finished = done.wait(5)
+            t.join()
+            self.assertTrue(finished)
+        finally:
+            f.release(0)
+
+    def test_small_file_changed(self):
+        self.fs.small_file = 64
+        try:
+            f = self.fs.file_class(self.path, os.O_RDONLY)
+            self.assertFalse(f.keep_cache)
+            f.release(0)
+            f = self.fs.file_class(self.path, os.O_RDONLY)
+            self.assertTrue(f.keep_cache)
+            f.release(0)
+
+            # Changed behind our back, the kernel's pages are stale
+            with open(self.fs._physical_path(self.path), 'wb') as f:
+                f.write(b'abcdefghijk')
+            f = self.fs.file_class(self.path, os.O_RDONLY)
+            self.assertFalse(f.keep_cache)
+            self.assertEqual(f.read(4096, 0), b'abcdefghijk')
+            f.release(0)
+        finally:
+            self.fs.small_file = 0
+
+class TestMount(unittest.TestCase):
+    # What parsing the command line leaves in a CacheFS
+    options = {'cache': None, 'target': None, 'readahead_max': '64M', 'readahead_limit': '256M',
+               'chunk_size': None, 'compress': None, 'dedup': False, 'shared': False, 'prewarm': '1M',
+               'small_file': '64K', 'idle_handles': '256', 'commit_interval': '1', 'cache_size': None,
+               'ram_cache': None, 'mmap_reads': None, 'eviction': 'lru', 'meta_ttl': '0', 'negative_ttl': '5',
+               'verify': 'stat', 'writeback': True, 'writeback_delay': '1', 'probe_interval': '5',
+               'probe_timeout': '2', 'trace': None}
+
+    def server(self):
+        server = cachefs.CacheFS()
+        for name, value in self.options.items():
+            setattr(server, name, value)
+        server.cache = os.path.join(test_base, 'mount')
+        server.target = test_base
+        return server
+
+    def test_threads_started_in_background(self):
+        server = self.server()
+        threads = set(threading.enumerate())
+        cachefs.setup(server)
+        self.assertEqual(set(threading.enumerate()), threads)
+
+        # Without -f libfuse forks into the background, and only then calls fsinit
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                server.fsinit()
+                names = set(t.name for t in threading.enumerate())
+                for name in ('block-writer', 'writeback-0', 'target-monitor', 'readahead-0'):
+                    assert name in names, name
+                # Has nothing to prewarm, so may well be done already
+                assert server.prewarm.thread.ident != None
+                server.fsdestroy()
+                status = 0
+            except:
+                traceback.print_exc()
+            os._exit(status)
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        FileDataCache.block_writers.pop(server.cache, None)
+        os.close(server.in_use)
+
+    def test_trace_dumped_on_signal(self):
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                server = self.server()
+                server.trace = os.path.join(test_base, 'trace.json')
+                cachefs.setup(server)
+                server.fsinit()
+                # libfuse keeps the main thread in C, where Python can't run a
+                # signal handler, as does waiting for a lock
+                dumped = []
+                done = threading.Lock()
+                done.acquire()
+                def check():
+                    # Once the main thread is waiting
+                    time.sleep(0.1)
+                    os.kill(os.getpid(), signal.SIGUSR1)
+                    for i in range(100):
+                        if os.path.exists(server.trace):
+                            dumped.append(True)
+                            break
+                        time.sleep(0.01)
+                    done.release()
+                threading.Thread(target=check).start()
+                done.acquire()
+                assert dumped
+                server.fsdestroy()
+                status = 0
+            except:
+                traceback.print_exc()
+            os._exit(status)
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+
+
+class TestWarm(unittest.TestCase):
+    def test_warm(self):
+        target = os.path.abspath(os.path.join(test_base, 'warm_target'))
+        cache = os.path.abspath(os.path.join(test_base, 'warm_cache'))
+        os.makedirs(os.path.join(target, 'sub'))
+        files = {'a.txt': os.urandom(100),
+                 'sub/b.bin': os.urandom(3 * 4096 + 5),
+                 'sub/c.txt': b''}
+        for name, data in files.items():
+            with open(os.path.join(target, name), 'wb') as f:
+                f.write(data)
+
+        self.assertEqual(warm([cache, os.path.join(target, 'sub'), '--target', target,
+                               '--include', '*.bin', '--fetch-size', '4096', '-j', '2']), 0)
+        warmed = open_db(cache)
+        self.assertEqual([p for p, in warmed.execute('SELECT path FROM paths')], ['/sub/b.bin'])
+        cached = FileDataCache(warmed, cache, '/sub/b.bin')
+        self.assertEqual(cached.known_offsets(), {0: len(files['sub/b.bin'])})
+        self.assertEqual(cached.read(8192, 8192), files['sub/b.bin'][8192:])
+
+    def test_refused_while_mounted(self):
+        target = os.path.abspath(os.path.join(test_base, 'mounted_target'))
+        cache = os.path.abspath(os.path.join(test_base, 'mounted_cache'))
+        for d in (target, cache):
+            os.makedirs(d)
+        with open(os.path.join(target, 'a.txt'), 'wb') as f:
+            f.write(os.urandom(100))
+        mounted = cachefs.lock_cache(cache, False)
+        try:
+            with self.assertRaises(SystemExit):
+                warm([cache, target, '--target', target])
+        finally:
+            os.close(mounted)
+        self.assertEqual(warm([cache, target, '--target', target]), 0)
+
+    def test_within_cache_size(self):
+        target = os.path.abspath(os.path.join(test_base, 'bounded_target'))
+        cache = os.path.abspath(os.path.join(test_base, 'bounded_cache'))
+        for d in (target, cache):
+            os.makedirs(d)
+        for name in ('a.bin', 'b.bin'):
+            with open(os.path.join(target, name), 'wb') as f:
+                f.write(os.urandom(6000))
+        # What mounting with -o cache_size=8K leaves behind
+        with create_db(cache) as mounted:
+            mounted.execute("INSERT INTO settings VALUES ('cache_size', '8192')")
+        self.assertEqual(warm([cache, target, '--target', target, '-j', '1']), 0)
+        self.assertEqual([size for node_id, size in cachefs.cached_sizes(open_db(cache), cache)], [6000])
+        self.assertFalse(cache in FileDataCache.evictors)
+
+
+class TestPrewarm(unittest.TestCase):
+    def setUp(self):
+        self.cachebase = os.path.abspath(os.path.join(test_base, 'prewarm_cache', self._testMethodName))
+        self.target = os.path.abspath(os.path.join(test_base, 'prewarm_target'))
+        for d in (self.cachebase, self.target):
+            if not os.path.isdir(d):
+                os.makedirs(d)
+        create_db(self.cachebase).close()
+        self.log = AccessLog(self.cachebase)
+
+    def test_runs(self):
+        self.log.add(1, 0, 10)
+        self.log.add(2, 0, 10)
+        self.log.add(1, 10, 10)
+        self.log.add(1, 100, 10)
+        self.assertEqual([r[1:] for r in self.log.records()], [(1, 0, 20), (2, 0, 10), (1, 100, 10)])
+
+    def test_trimmed(self):
+        log = AccessLog(self.cachebase, 10 * AccessLog.record.size)
+        for n in range(15):
+            log.add(n, 0, 1)
+        self.assertEqual([r[1] for r in log.records()], range(6, 15))
+
+    def test_hot_set(self):
+        now = time.time()
+        for t, node_id, offset, size in [(now - 10, 1, 0, 100), (now - 5, 2, 0, 50), (now - 1, 1, 50, 100),
+                                         (now, 3, 0, 10), (now - 1, 2, 0, 50)]:
+            self.log.__write__(node_id, [t, offset, offset + size])
+        self.assertEqual(self.log.hot_set(1000, now), [(1, 0, 150), (2, 0, 50), (3, 0, 10)])
+        # Node 3 was read once, the others twice and node 2 more lately
+        self.assertEqual(self.log.hot_set(160, now), [(1, 0, 110), (2, 0, 50)])
+
+    def cached(self):
+        path = '/' + self._testMethodName
+        with open(self.target + path, 'wb') as f:
+            f.write(os.urandom(3 * 4096))
+        st = os.stat(self.target + path)
+        cache = FileDataCache(open_db(self.cachebase), self.cachebase, path, os.O_RDWR, st.st_ino)
+        cache.remember(st)
+        return cache, st.st_ino
+
+    def test_prewarm(self):
+        cache, node_id = self.cached()
+
+        prewarm = Prewarm(self.cachebase, self.target, [(node_id, 4096, 8192), (node_id + 1, 0, 10)])
+        prewarm.join()
+        self.assertEqual(prewarm.fetched, 4096)
+        self.assertEqual(cache.known_offsets(), {4096: 4096})
+
+        prewarm = Prewarm(self.cachebase, self.target, [])
+        prewarm.stop()
+        prewarm.join()
+        self.assertEqual(prewarm.fetched, 0)
+
+    def test_changed(self):
+        cache, node_id = self.cached()
+        cache.update('x' * 4096, 0)
+        with open(self.target + cache.path, 'ab') as f:
+            f.write('more')
+        prewarm = Prewarm(self.cachebase, self.target, [(node_id, 0, 8192)])
+        prewarm.join()
+        self.assertEqual(prewarm.fetched, 0)
+        self.assertEqual(cache.known_offsets(), {})
+
 if __name__ == '__main__':
 #    import cProfile
 #    cProfile.run('unittest.main()')